@@ -1,21 +1,36 @@
 import argparse
+import copy
 from pprint import pformat
 import tempfile
+import time
 import json
 import os
+import re
 from .log import log
 from bucko import config
+from bucko.blob_cache import get_blob_cache
+from bucko.blob_cache import MAX_SIZE as MAX_BLOB_CACHE_SIZE
+from bucko.cache import cache_dir, fingerprint, TTLCache
+from bucko import koji_builder
 from bucko import odcs_manager
+from bucko import preflight
+from bucko import scm
+from bucko import trace
+from bucko import transport
 from bucko.container_publisher import ContainerPublisher
 from bucko.repo_compose import RepoCompose
 from bucko.publisher import Publisher
-from bucko.koji_builder import KojiBuilder
+from bucko.koji_builder import KojiBuilder, METADATA_TTL
 from bucko.registry import Registry
+from bucko.tokens import get_token_cache
 
 __version__ = '1.0.0'
 
 __all__ = ['log']
 
+# How long we will re-use an earlier build's result, in seconds.
+RESULT_TTL = 7 * 24 * 60 * 60
+
 
 def parse_ci_message(msg, compose_url):
     """
@@ -105,6 +120,48 @@ def write_metadata_file(filename, **kwargs):
     return filename
 
 
+def write_trace_files(compose_id):
+    """
+    Write this run's trace spans to a Chrome trace JSON file and a summary
+    table text file.
+
+    :returns: a list of the two file names
+    """
+    directory = tempfile.mkdtemp(suffix='.trace')
+    json_file = os.path.join(directory, compose_id + '-trace.json')
+    trace.write_chrome_trace(json_file)
+    summary_file = os.path.join(directory, compose_id + '-trace.txt')
+    with open(summary_file, 'w') as f:
+        f.write(trace.summary() + '\n')
+    return [json_file, summary_file]
+
+
+def publish_trace_files(publisher, compose_id):
+    """
+    Write and publish this run's trace files.
+
+    The trace is only for humans, so we log any failure and continue.
+    """
+    try:
+        for trace_file in write_trace_files(compose_id):
+            log.info('Trace data at %s' % publisher.publish(trace_file))
+    except Exception as e:
+        log.warning('could not publish trace data: %s' % e)
+
+
+def stage_props():
+    """
+    Return the seconds for each pipeline stage, for write_props_file().
+
+    For example, the "Koji build" stage becomes "stage_koji_build_seconds".
+    """
+    props = {}
+    for name, seconds in trace.stage_durations().items():
+        key = 'stage_%s_seconds' % re.sub(r'[^a-z0-9]+', '_', name.lower())
+        props[key] = '%.3f' % seconds
+    return props
+
+
 def write_props_file(**kwargs):
     """ Write data into a .props file for Jenkins to read. """
     if 'WORKSPACE' in os.environ:
@@ -115,6 +172,15 @@ def write_props_file(**kwargs):
                 props.write(key.upper() + '=' + str(value) + "\n")
 
 
+def get_koji_builder(kconf):
+    """ Construct a KojiBuilder object according to our [koji] settings. """
+    ttl = int(kconf.get('metadata_ttl', METADATA_TTL))
+    persist = config.parse_boolean(kconf.get('metadata_cache'))
+    session = config.parse_boolean(kconf.get('session_cache'))
+    return KojiBuilder(profile=kconf['profile'], metadata_ttl=ttl,
+                       persist_metadata=persist, persist_session=session)
+
+
 def get_compose(compose_url, configp):
     """ Construct a RepoCompose object according to our ConfigParser. """
     keys = dict(configp.items('keys'))
@@ -139,31 +205,175 @@ def get_branch(compose):
     return '%s-%s-%s-%s' % (name, version, bp_short, bp_version)
 
 
-def build_container(repo_urls, branch, parent_image, scratch, configp):
-    """ Build a container with Koji. """
-    kconf = dict(configp.items('koji', vars={'branch': branch}))
-    koji = KojiBuilder(profile=kconf['profile'])
-    parent = None
+def get_branch_settings(configp, branch, repo_url):
+    """
+    Determine the parent image and .repo files for one dist-git branch.
+
+    :param str branch: dist-git branch, eg. "ceph-4.0-rhel-8"
+    :param str repo_url: URL to the compose's own .repo file
+    :returns: two-element tuple: the parent image (str or None), and a set
+              of .repo file URLs for this build.
+    """
+    # Determine other settings for this branch
+    section = '%s-base' % branch  # eg "ceph-4.0-rhel-8-base"
+    parent_image = config.lookup(configp, section, 'parent_image', fatal=False)
     if parent_image:
-        registry_url = config.lookup(configp, 'registry', 'url')
-        registry = Registry(registry_url)
-        parent = registry.build(parent_image)  # bucko.build.Build
+        log.info('parent_image configured: %s' % parent_image)
+    repo_urls = config.get_repo_urls(configp, section)
+    for url in repo_urls:
+        log.info('Additional .repo configured: %s' % url)
+    repo_urls.add(repo_url)
+    return (parent_image, repo_urls)
+
+
+def get_odcs_manager(configp):
+    """ Construct an OdcsManager according to our ConfigParser's [odcs]. """
+    url = config.lookup(configp, 'odcs', 'url', fatal=False)
+    timeout = config.lookup(configp, 'odcs', 'timeout', fatal=False)
+    return odcs_manager.OdcsManager(
+        url=url or odcs_manager.ODCS_URL,
+        timeout=int(timeout or odcs_manager.COMPOSE_TIMEOUT))
+
+
+def start_odcs_compose(configp, branch, manager):
+    """
+    Start generating an ODCS compose for this branch's odcs_tag, if any.
+
+    ODCS composes can take many minutes, so we wait for them in the
+    background while we prepare the rest of the build. If the tag has not
+    changed since an earlier compose, we re-use that compose instead.
+
+    :param manager: OdcsManager to generate the compose
+    :returns: a Future for the compose's .repo URL, or None if this branch
+              has no odcs_tag setting.
+    """
+    section = '%s-base' % branch  # eg "ceph-4.0-rhel-8-base"
+    odcs_tag = config.lookup(configp, section, 'odcs_tag', fatal=False)
+    if not odcs_tag:
+        return None
+    log.info('odcs_tag configured: %s' % odcs_tag)
+    kconf = dict(configp.items('koji', vars={'branch': branch}))
+    koji = get_koji_builder(kconf)
+    arches = koji.get_target_arches(kconf['target'])
+    event = koji.get_last_event()
+    saved = odcs_manager.find_compose(odcs_tag, arches, koji)
+    return manager.submit(odcs_tag, arches, event, saved)
+
+
+def get_result_store():
+    """ Return the cache of earlier builds' results, keyed by their inputs. """
+    path = os.path.join(cache_dir(), 'build-results.json')
+    return TTLCache(RESULT_TTL, path)
+
+
+def get_registry(configp):
+    """ Construct a Registry object according to our [registry] settings. """
+    registry_url = config.lookup(configp, 'registry', 'url')
+    persist = config.lookup_boolean(configp, 'registry', 'token_cache')
+    blob_cache = None
+    if config.lookup_boolean(configp, 'registry', 'blob_cache'):
+        size = config.lookup(configp, 'registry', 'blob_cache_size',
+                             fatal=False)
+        max_size = int(size) * 1024 * 1024 if size else MAX_BLOB_CACHE_SIZE
+        blob_cache = get_blob_cache(max_size)
+    return Registry(registry_url, get_token_cache(persist), blob_cache)
+
+
+def get_parent_build(configp, parent_image):
+    """ Look up the Koji build for this parent image in our registry. """
+    if not parent_image:
+        return None
+    registry = get_registry(configp)
+    image = registry.resolve_image(parent_image)
+    if image != parent_image:
+        log.info('parent_image %s is %s' % (parent_image, image))
+    return registry.build(image)  # bucko.build.Build
+
+
+def prepare_build(repo_urls, branch, parent_image, scratch, configp, store,
+                  force=False, odcs_compose=None):
+    """
+    Determine a container build's inputs and check them before we submit
+    the build to Koji.
+
+    If "store" already has a result for a successful build of these exact
+    inputs, we skip the build (unless "force" is True). The inputs include
+    the dist-git commit that the SCM ref points to now, so a new dist-git
+    commit always gets a new build. If we cannot resolve the ref to a
+    commit, we always build.
+
+    If "odcs_compose" is a Future from start_odcs_compose(), we wait for
+    that compose here and add its .repo URL to this build.
+
+    :returns: four-element tuple: the KojiBuilder, the fingerprint of this
+              build's inputs, a copy of the stored result, and the keyword
+              arguments for KojiBuilder.build_container(). If we can re-use
+              the stored result, the arguments are None. If not, the result
+              is None.
+    """
+    kconf = dict(configp.items('koji', vars={'branch': branch}))
+    koji = get_koji_builder(kconf)
+    parent = get_parent_build(configp, parent_image)
+    if odcs_compose:
+        with trace.stage('wait for ODCS compose'):
+            odcs_repo_url = odcs_compose.result()
+        log.info('Adding odcs repo url %s' % odcs_repo_url)
+        repo_urls = repo_urls | {odcs_repo_url}
+    commit_scm = scm.resolve(kconf['scm'])
+    if commit_scm:
+        log.info('%s is %s' % (kconf['scm'], commit_scm))
+    else:
+        log.info('Not re-using earlier builds of %s' % kconf['scm'])
+    key = fingerprint(scm=commit_scm or kconf['scm'],
+                      target=kconf['target'],
+                      branch=branch,
+                      repos=repo_urls,
+                      scratch=scratch,
+                      koji_parent_build=parent)
+    result = store.get(key)
+    if result and commit_scm and not force:
+        task_id = result['koji_task']
+        if koji.task_succeeded(task_id):
+            log.info('Re-using Koji task %s for identical inputs (%s)'
+                     % (task_id, key))
+            return (koji, key, copy.deepcopy(result), None)
+        store.invalidate(key)
+    # Fail now, rather than many minutes into the OSBS build, if any of the
+    # Yum repositories are missing.
+    with trace.stage('pre-flight checks'):
+        arches = koji.get_target_arches(kconf['target']).split()
+        preflight.check(repo_urls, arches)
+    build_args = {'scm': commit_scm or kconf['scm'],
+                  'target': kconf['target'],
+                  'branch': branch,
+                  'repos': repo_urls,
+                  'scratch': scratch,
+                  'koji_parent_build': parent}
+    return (koji, key, None, build_args)
+
+
+def submit_build(koji, build_args):
+    """
+    Submit a container build from prepare_build() to Koji.
+
+    :returns: the Koji task ID
+    """
     log.info('Building container at %s' % koji.session.baseurl)
-    task_id = koji.build_container(scm=kconf['scm'],
-                                   target=kconf['target'],
-                                   branch=branch,
-                                   repos=repo_urls,
-                                   scratch=scratch,
-                                   koji_parent_build=parent)
-    # Show information to the console.
-    koji.watch_task(task_id)
+    with trace.stage('submit Koji build'):
+        return koji.build_container(**build_args)
+
+
+def finish_build(koji, task_id, branch, scratch, configp):
+    """ Untag a successful Koji build and return information about it. """
+    kconf = dict(configp.items('koji', vars={'branch': branch}))
 
     # Untag the build from the -candidate tag:
     # There's no "skip_tag" parameter for buildContainer, so we must
     # immediately untag it ourselves.
     # CLOUDBLD-5091 is the RFE to add skip-tag.
     if not scratch:
-        koji.untag_task_result(task_id)
+        with trace.stage('untag Koji build'):
+            koji.untag_task_result(task_id)
 
     # Return information about this build.
     result = {'koji_task': task_id}
@@ -176,6 +386,117 @@ def build_container(repo_urls, branch, parent_image, scratch, configp):
     return result
 
 
+def build_container(repo_urls, branch, parent_image, scratch, configp,
+                    force=False, odcs_compose=None):
+    """ Build a container with Koji. """
+    store = get_result_store()
+    koji, key, result, build_args = prepare_build(repo_urls, branch,
+                                                  parent_image, scratch,
+                                                  configp, store, force,
+                                                  odcs_compose)
+    if result:
+        return result
+    task_id = submit_build(koji, build_args)
+    # Show information to the console.
+    with trace.stage('Koji build'):
+        koji.watch_task(task_id)
+    result = finish_build(koji, task_id, branch, scratch, configp)
+    store.set(key, copy.deepcopy(result))
+    return result
+
+
+def build_containers(builds, scratch, configp, force=False):
+    """
+    Build several containers with Koji at the same time.
+
+    We prepare every build first, so that a failure in any branch's checks
+    stops the run before we submit anything. Then we submit every build,
+    and we watch all the tasks together. All the branches must use the same
+    Koji profile.
+
+    :param list builds: (branch, parent_image, repo_urls, odcs_compose)
+                        tuples. "odcs_compose" is a Future or None.
+    :returns: generator that yields a (branch, result) tuple as soon as each
+              build finishes. We yield re-used results after we submit
+              every new build.
+    """
+    # Check the profiles before we submit anything.
+    profiles = {}
+    for branch, _, _, _ in builds:
+        kconf = dict(configp.items('koji', vars={'branch': branch}))
+        profiles[branch] = kconf['profile']
+    if len(set(profiles.values())) > 1:
+        raise RuntimeError('branches use different Koji profiles: %s'
+                           % ', '.join('%s (%s)' % item
+                                       for item in sorted(profiles.items())))
+    store = get_result_store()
+    prepared = []
+    reused = []
+    koji = None
+    for branch, parent_image, repo_urls, odcs_compose in builds:
+        koji, key, result, build_args = prepare_build(
+            repo_urls, branch, parent_image, scratch, configp, store, force,
+            odcs_compose)
+        if result:
+            reused.append((branch, result))
+            continue
+        prepared.append((branch, key, build_args))
+    tasks = {}
+    try:
+        for branch, key, build_args in prepared:
+            tasks[submit_build(koji, build_args)] = (branch, key)
+    except Exception:
+        # Do not leave the other branches' builds running unwatched.
+        for task_id in tasks:
+            log.warning('Canceling Koji task %s' % task_id)
+            koji.cancel_task(task_id)
+        raise
+    # Publish the re-used results only after we submitted every new build.
+    for branch, result in reused:
+        yield (branch, result)
+    if not tasks:
+        return
+    failed = []
+    # The branches' builds overlap, so record one span from the start of
+    # the watch until the last task finished.
+    start = time.monotonic()
+    end = start
+    try:
+        for task_id, success in koji.watch_tasks(list(tasks)):
+            end = time.monotonic()
+            branch, key = tasks[task_id]
+            if not success:
+                log.error('buildContainer task %s for %s failed'
+                          % (task_id, branch))
+                failed.append(task_id)
+                continue
+            result = finish_build(koji, task_id, branch, scratch, configp)
+            store.set(key, copy.deepcopy(result))
+            yield (branch, result)
+    finally:
+        trace.record('Koji build', trace.STAGE, start, end - start,
+                     branches=sorted(branch for branch, _ in tasks.values()))
+    if failed:
+        raise RuntimeError('failed buildContainer tasks: %s' % failed)
+
+
+def publish_container(container_pub, branch, metadata):
+    """ Publish this Koji build to our registry, if we have one. """
+    if container_pub and 'repository' in metadata:
+        source_image = metadata['repository']
+        dest_namespace, _ = branch.split('-', 1)  # eg "ceph"
+        _, unique_tag = source_image.split(':', 1)  # OSBS unique build tag
+        for tag in ('latest', unique_tag):
+            dest_repo = container_pub.publish(source_image,
+                                              dest_namespace,
+                                              branch,
+                                              tag)
+            if dest_repo:
+                # Add the new location to metadata['repositories'] so that we
+                # record it in the -osbs.json file.
+                metadata['repositories'].append(dest_repo)
+
+
 def parse_args():
     """ Return parsed cmdline arguments. """
     parser = argparse.ArgumentParser()
@@ -184,6 +505,13 @@ def parse_args():
                         help='HTTP(S) URL to a product Pungi compose.')
     parser.add_argument('--scratch', action='store_true',
                         help='scratch-build container image')
+    parser.add_argument('--branch', action='append', dest='branches',
+                        help='dist-git branch to build. Repeat this to '
+                        'build several branches at the same time. '
+                        '(default: the branch for this compose)')
+    parser.add_argument('--force', action='store_true',
+                        help='build even if an earlier build had identical '
+                        'inputs')
     return parser.parse_args()
 
 
@@ -196,73 +524,99 @@ def main():
         raise SystemExit(err)
     compose_url = args.compose
 
+    # Time every HTTP request on our shared transport.
+    transport.add_hook(trace.http_request)
+
     # Load config file
     configp = config.load()
 
+    odcs = get_odcs_manager(configp)
+    try:
+        run(args, compose_url, configp, odcs)
+    finally:
+        # If we failed, do not wait for any ODCS composes before we exit.
+        odcs.shutdown()
+        # Later runs resume our Koji sessions from their last call numbers.
+        koji_builder.save_sessions()
+
+
+def run(args, compose_url, configp, odcs):
+    """
+    Build and publish containers for this compose.
+
+    :param odcs: OdcsManager for the branches' odcs_tag composes
+    """
     # Load compose
-    c = get_compose(compose_url, configp)
+    with trace.stage('load compose'):
+        c = get_compose(compose_url, configp)
+
+    # Determine scm and brew target branch names
+    branches = args.branches or [get_branch(c)]
+
+    # Start any ODCS composes first, because they take the longest.
+    with trace.stage('start ODCS composes'):
+        odcs_composes = {}
+        for branch in branches:
+            odcs_composes[branch] = start_odcs_compose(configp, branch, odcs)
 
     # Generate .repo file
     log.info('Generating .repo file for %s compose' % c.info.release.short)
-    filename = c.write_yum_repo_file()
+    with trace.stage('write .repo file'):
+        filename = c.write_yum_repo_file()
 
     # Publish the .repo file
     p = get_publisher(configp)
     log.info('Publishing .repo file to %s' % p.push_url)
-    repo_url = p.publish(filename)
+    with trace.stage('publish .repo file'):
+        repo_url = p.publish(filename)
     log.info('Published %s' % repo_url)
 
-    # Determine scm and brew target branch name
-    branch = get_branch(c)
-
-    # Determine other settings for this branch
-    section = '%s-base' % branch  # eg "ceph-4.0-rhel-8-base"
-    parent_image = config.lookup(configp, section, 'parent_image', fatal=False)
-    if parent_image:
-        log.info('parent_image configured: %s' % parent_image)
-    repo_urls = config.get_repo_urls(configp, section)
-    for url in repo_urls:
-        log.info('Additional .repo configured: %s' % url)
-    repo_urls.add(repo_url)
-
-    odcs_tag = config.lookup(configp, section, 'odcs_tag', fatal=False)
-    if odcs_tag:
-        log.info('odcs_tag configured: %s' % odcs_tag)
-        kconf = dict(configp.items('koji', vars={'branch': branch}))
-        koji = KojiBuilder(profile=kconf['profile'])
-        arches = koji.get_target_arches(kconf['target'])
-        odcs_repo_url = odcs_manager.generate(odcs_tag, arches)
-        log.info('Adding odcs repo url %s' % odcs_repo_url)
-        repo_urls.add(odcs_repo_url)
+    # Determine other settings for each branch
+    builds = []
+    with trace.stage('branch settings'):
+        for branch in branches:
+            parent_image, repo_urls = get_branch_settings(configp, branch,
+                                                          repo_url)
+            builds.append((branch, parent_image, repo_urls,
+                           odcs_composes[branch]))
+
+    # Do the Koji build(s)
+    if len(builds) == 1:
+        branch, parent_image, repo_urls, odcs_compose = builds[0]
+        metadata = build_container(repo_urls, branch, parent_image,
+                                   args.scratch, configp, args.force,
+                                   odcs_compose)
+        results = [(branch, metadata)]
+    else:
+        results = build_containers(builds, args.scratch, configp, args.force)
 
-    # Do a Koji build
-    metadata = build_container(repo_urls, branch, parent_image, args.scratch,
-                               configp)
-
-    # Publish this Koji build to our registry
     container_pub = get_container_publisher(configp)
-    if container_pub and 'repository' in metadata:
-        source_image = metadata['repository']
-        dest_namespace, _ = branch.split('-', 1)  # eg "ceph"
-        _, unique_tag = source_image.split(':', 1)  # OSBS unique build tag
-        for tag in ('latest', unique_tag):
-            dest_repo = container_pub.publish(source_image,
-                                              dest_namespace,
-                                              branch,
-                                              tag)
-            if dest_repo:
-                # Add the new location to metadata['repositories'] so that we
-                # record it in the -osbs.json file below.
-                metadata['repositories'].append(dest_repo)
-
-    # Store and publish our information about this build
-    metadata['compose_url'] = compose_url
-    metadata['compose_id'] = c.info.compose.id
-    json_file = write_metadata_file(c.info.compose.id + '-osbs.json',
-                                    **metadata)
-    json_url = p.publish(json_file)
-    log.info('OSBS JSON data at %s' % json_url)
-    write_props_file(**metadata)
+    props = None
+    for branch, metadata in results:
+        # Publish this Koji build to our registry
+        with trace.stage('publish container'):
+            publish_container(container_pub, branch, metadata)
+
+        # Store and publish our information about this build
+        metadata['compose_url'] = compose_url
+        metadata['compose_id'] = c.info.compose.id
+        if len(builds) == 1:
+            json_name = c.info.compose.id + '-osbs.json'
+        else:
+            json_name = '%s-%s-osbs.json' % (c.info.compose.id, branch)
+        with trace.stage('publish metadata'):
+            json_file = write_metadata_file(json_name, **metadata)
+            json_url = p.publish(json_file)
+        log.info('OSBS JSON data at %s' % json_url)
+        if branch == branches[0]:
+            props = metadata
+
+    # Publish the timing information for this run
+    log.info('Time spent:\n%s' % trace.summary())
+    if props is not None:
+        props = dict(props, **stage_props())
+        write_props_file(**props)
+    publish_trace_files(p, c.info.compose.id)
 
 
 class BuckoError(Exception):
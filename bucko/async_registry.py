@@ -0,0 +1,365 @@
+import asyncio
+import base64
+import hashlib
+import json
+import posixpath
+from bucko.registry import BaseRegistry
+from bucko.registry import MANIFEST_LIST, MANIFEST_V2
+from bucko.registry import MAX_SIGNATURES, SIGNATURE_WINDOW
+from bucko.registry import config_build, decode_signatures, platform_matches
+from bucko.registry import token_params
+
+"""
+asyncio container registry client, for fanning out many registry queries on
+one event loop.
+
+This requires aiohttp. Like PyYAML for signatures, we only import it when
+you use this module, so you only need to install aiohttp for async queries.
+
+File I/O (the token cache, podman's auth file and registries.d) and gpg
+would block the event loop, so we run them in the loop's default executor.
+"""
+
+# Number of concurrent requests for one AsyncRegistry.
+MAX_CONCURRENCY = 32
+
+# Number of open connections to each registry host.
+LIMIT_PER_HOST = 8
+
+
+class Response(object):
+    """
+    A finished HTTP response: status, headers, and the whole body.
+    """
+
+    def __init__(self, status, headers, body, error=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.error = error
+
+    def raise_for_status(self):
+        """ Raise aiohttp.ClientResponseError for a 4xx or 5xx status. """
+        if self.error:
+            raise self.error
+
+
+class AsyncRegistry(BaseRegistry):
+    """
+    asyncio version of bucko.registry.Registry.
+
+    It shares the token cache, podman's auth file, and registries.d lookaside
+    settings with Registry. Use it as an async context manager:
+
+        async with AsyncRegistry('https://registry.example.com') as registry:
+            builds = await registry.builds(['rhel7:7.5-ondeck', 'rhel8:8.6'])
+
+    :param int max_concurrency: maximum number of requests in flight.
+    :param int limit_per_host: maximum connections to each host.
+    """
+
+    def __init__(self, baseurl, token_cache=None,
+                 max_concurrency=MAX_CONCURRENCY,
+                 limit_per_host=LIMIT_PER_HOST):
+        super(AsyncRegistry, self).__init__(baseurl, token_cache)
+        self.max_concurrency = max_concurrency
+        self.limit_per_host = limit_per_host
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+        headers = {'Accept': MANIFEST_V2}
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             headers=headers)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    @property
+    def auth(self):
+        """ Returns aiohttp BasicAuth if we have a saved credential. """
+        import aiohttp
+        credential = self.load_credentials(self.hostname)
+        if not credential:
+            return None
+        username, password = credential
+        return aiohttp.BasicAuth(username, password)
+
+    @property
+    def hostname(self):
+        return self.host.split(':', 1)[0]
+
+    async def run_blocking(self, func, *args):
+        """ Run func(*args) in a thread, so it does not block our loop. """
+        # asyncio.get_running_loop() is new in Python 3.7.
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def fetch(self, method, url, **kwargs):
+        """
+        Send one HTTP request, waiting for a free slot in our semaphore.
+
+        :returns: Response
+        """
+        import aiohttp
+        async with self.semaphore:
+            async with self.session.request(method, url, **kwargs) as r:
+                body = await r.read()
+                error = None
+                try:
+                    r.raise_for_status()
+                except aiohttp.ClientResponseError as e:
+                    error = e
+                return Response(r.status, r.headers, body, error)
+
+    # Tokens
+
+    async def find_realm(self):
+        """
+        Find this registry's token realm from the /v2/ base endpoint.
+
+        :returns: a (realm, service) tuple, or None if this registry does not
+                  require tokens.
+        """
+        realm = self.tokens.get_realm(self.host)
+        if realm:
+            return realm
+        r = await self.fetch('GET', self.baseurl + '/')
+        if r.status != 401:
+            r.raise_for_status()
+            return None
+        (realm, service) = self.find_realm_service(r)
+        await self.run_blocking(self.tokens.set_realm, self.host, realm,
+                                service)
+        return (realm, service)
+
+    async def store_tokens(self, realm, service, repositories):
+        """
+        Get and store one JWT Bearer token for several repositories.
+
+        :returns: the token
+        """
+        params = token_params(service, repositories)
+        auth = await self.run_blocking(lambda: self.auth)
+        r = await self.fetch('GET', realm, params=params, auth=auth)
+        r.raise_for_status()
+        return await self.run_blocking(self.save_token, repositories,
+                                       json.loads(r.body))
+
+    async def prefetch_tokens(self, repositories):
+        """
+        Get tokens for many repositories with as few realm requests as
+        possible.
+        """
+        batches = self.missing_tokens(repositories)
+        if not batches:
+            return
+        realm = await self.find_realm()
+        if not realm:
+            return
+        await asyncio.gather(*[self.store_tokens(realm[0], realm[1], batch)
+                               for batch in batches])
+
+    async def token(self, repository):
+        """
+        Return a valid JWT Bearer token for this repository, or None if we
+        do not know the realm yet.
+        """
+        token = self.tokens.get(self.host, repository)
+        if token:
+            return token
+        realm = self.tokens.get_realm(self.host)
+        if realm:
+            return await self.store_tokens(realm[0], realm[1], [repository])
+        return None
+
+    async def _request(self, method, repository, endpoint,
+                       additional_headers={}, retry=True):
+        """
+        Send a request to a docker distribution API endpoint URL, with a
+        Bearer token if the registry requires one.
+
+        :returns: Response
+        """
+        url = posixpath.join(self.baseurl, repository, endpoint)
+        token = await self.token(repository)
+        if not token:
+            r = await self.fetch(method, url, headers=additional_headers)
+            if r.status != 401:
+                r.raise_for_status()
+                return r
+            (realm, service) = self.find_realm_service(r)
+            await self.run_blocking(self.tokens.set_realm, self.host, realm,
+                                    service)
+            token = await self.store_tokens(realm, service, [repository])
+        headers = {'Authorization': 'Bearer %s' % token}
+        headers.update(additional_headers)
+        r = await self.fetch(method, url, headers=headers)
+        if r.status == 401 and retry:
+            # The registry rejected our cached (possibly multi-scope) token.
+            await self.run_blocking(self.tokens.invalidate, self.host,
+                                    repository)
+            return await self._request(method, repository, endpoint,
+                                       additional_headers, retry=False)
+        r.raise_for_status()
+        return r
+
+    # Registry API
+
+    async def manifest(self, repository, reference, manifest_list=False):
+        """
+        Get the manifest information about this image.
+
+        :param str repository: repository to query, eg "rhel7"
+        :param str reference: tag name in the repository, "7.5-ondeck"
+        :param bool manifest_list: return the "fat manifests"
+        """
+        additional_headers = {}
+        if manifest_list:
+            additional_headers['Accept'] = MANIFEST_LIST
+        endpoint = 'manifests/%s' % reference
+        r = await self._request('GET', repository, endpoint,
+                                additional_headers)
+        return json.loads(r.body)
+
+    async def blob(self, repository, digest):
+        """
+        Get a (JSON) blob by digest.
+
+        :param str repository: eg "rhel7"
+        :param str digest: digest to query, eg "sha256:123abcd..."
+        """
+        endpoint = 'blobs/%s' % digest
+        r = await self._request('GET', repository, endpoint)
+        return json.loads(r.body)
+
+    async def config(self, repository, reference):
+        """ Return the config information for this image. """
+        manifest = await self.manifest(repository, reference)
+        return await self.blob(repository, manifest['config']['digest'])
+
+    async def build(self, image):
+        """
+        Return the Koji name-version-release information for this image.
+
+        :param str image: image name, eg. "rhel7:7.5-ondeck"
+        :returns: bucko.build.Build class
+        """
+        (repository, reference) = image.split(':', 1)
+        return config_build(await self.config(repository, reference))
+
+    async def builds(self, images):
+        """
+        Return the Koji name-version-release information for many images.
+
+        :param list images: image names, eg. ["rhel7:7.5-ondeck"]
+        :returns: list of bucko.build.Build classes, in the same order as
+                  "images"
+        """
+        images = list(images)
+        unique = list(dict.fromkeys(images))
+        await self.prefetch_tokens([image.split(':', 1)[0]
+                                    for image in unique])
+        results = await asyncio.gather(*[self.build(image)
+                                         for image in unique])
+        builds = dict(zip(unique, results))
+        return [builds[image] for image in images]
+
+    async def digest(self, repository, reference, platform=None):
+        """
+        Return the manifest digest that this reference points to.
+
+        See bucko.registry.Registry.digest().
+        """
+        headers = {'Accept': '%s, %s' % (MANIFEST_LIST, MANIFEST_V2)}
+        endpoint = 'manifests/%s' % reference
+        if not platform:
+            r = await self._request('HEAD', repository, endpoint, headers)
+            digest = r.headers.get('Docker-Content-Digest')
+            if digest:
+                return digest
+        r = await self._request('GET', repository, endpoint, headers)
+        data = json.loads(r.body)
+        if platform and data.get('mediaType') == MANIFEST_LIST:
+            for manifest in data['manifests']:
+                if platform_matches(manifest['platform'], platform):
+                    return manifest['digest']
+            raise RuntimeError('%s:%s has no %s manifest'
+                               % (repository, reference, platform))
+        digest = r.headers.get('Docker-Content-Digest')
+        if digest:
+            return digest
+        return 'sha256:' + hashlib.sha256(r.body).hexdigest()
+
+    async def signatures(self, image, platform='amd64'):
+        """
+        Return the GPG signature data for this image.
+
+        :param str image: image name, eg. "cp/ibm-ceph/ceph-5-rhel8:latest"
+        :param str platform: architecture to check, eg. "amd64"
+        :returns: list of signatures (bytes)
+        """
+        (repository, reference) = image.split(':', 1)
+        digest = await self.digest(repository, reference, platform)
+        return await self.digest_signatures(repository, digest)
+
+    async def digest_signatures(self, repository, digest):
+        """ Return the GPG signature data for this manifest digest. """
+        lookaside = await self.run_blocking(lambda: self.lookaside)
+        if lookaside:
+            return await self.lookaside_signatures(lookaside, repository,
+                                                   digest)
+        # No /etc/containers/registries.d for this host.
+        # Query the default "extensions" URL on this registry.
+        token = await self.token(repository)
+        headers = {'Authorization': 'Bearer %s' % token}
+        url = self.extensions_url(repository, digest)
+        r = await self.fetch('GET', url, headers=headers)
+        if r.status == 404:
+            return []
+        r.raise_for_status()
+        data = json.loads(r.body)
+        return [base64.b64decode(entry['content'])
+                for entry in data['signatures']]
+
+    async def lookaside_signatures(self, lookaside, repository, digest):
+        """
+        Return the GPG signature blobs for this digest from a lookaside URL,
+        SIGNATURE_WINDOW requests at a time.
+        """
+        template = self.signature_template(lookaside, repository, digest)
+        signatures = []
+        for start in range(1, MAX_SIGNATURES, SIGNATURE_WINDOW):
+            stop = min(start + SIGNATURE_WINDOW, MAX_SIGNATURES)
+            responses = await asyncio.gather(*[
+                self.fetch('GET', template.format(index=index))
+                for index in range(start, stop)])
+            for r in responses:
+                if r.status != 200:
+                    return signatures
+                signatures.append(r.body)
+        return signatures
+
+    async def signature_payloads(self, image, verify=False):
+        """
+        Return the JSON document payloads that GPG has signed.
+
+        :param bool verify: check every signature with one gpg process, and
+                            raise RuntimeError if any signature is not good.
+        :returns: list of dicts, one per signature/ref
+        """
+        signatures = await self.signatures(image)
+        return await self.run_blocking(decode_signatures, image, signatures,
+                                       verify)
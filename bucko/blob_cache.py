@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+from bucko.cache import cache_dir
+
+"""
+Content-addressed on-disk cache for container registry blobs and manifests.
+"""
+
+# Default size limit for the whole cache, in bytes.
+MAX_SIZE = 256 * 1024 * 1024
+
+# Process-wide blob caches, keyed by path.
+_blob_caches = {}
+
+
+def get_blob_cache(max_size=MAX_SIZE):
+    """
+    Return the process-wide blob cache in ~/.cache/bucko/blobs.
+
+    :param int max_size: evict the least-recently-used entries when the
+                         cache grows larger than this many bytes.
+    """
+    path = os.path.join(cache_dir(), 'blobs')
+    if path not in _blob_caches:
+        _blob_caches[path] = BlobCache(path, max_size)
+    blob_cache = _blob_caches[path]
+    blob_cache.max_size = max_size
+    return blob_cache
+
+
+class BlobCache(object):
+    """
+    Blobs and manifests keyed by their sha256 digest.
+
+    Content with a digest never changes, so we never need to revalidate
+    these entries with the registry. We store each entry in its own file,
+    "<path>/sha256/<hex>", and we use each file's mtime to evict the least
+    recently used entries.
+    """
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def filename(self, digest):
+        """
+        Return the file name for this digest, or None if we cannot cache it.
+
+        :param str digest: eg. "sha256:123abcd..."
+        """
+        algorithm, _, hexdigest = digest.partition(':')
+        if algorithm != 'sha256' or len(hexdigest) != 64:
+            return None
+        try:
+            int(hexdigest, 16)
+        except ValueError:
+            return None
+        return os.path.join(self.path, algorithm, hexdigest)
+
+    def get(self, digest):
+        """ Return the bytes for this digest, or None. """
+        filename = self.filename(digest)
+        if not filename:
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Mark this entry as recently used.
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def set(self, digest, data):
+        """
+        Store these bytes under this digest.
+
+        :returns: True if we stored the data, or False if the data does not
+                  match the digest.
+        """
+        filename = self.filename(digest)
+        if not filename:
+            return False
+        if hashlib.sha256(data).hexdigest() != digest.partition(':')[2]:
+            return False
+        os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+        tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+        self.evict()
+        return True
+
+    def entries(self):
+        """ Return a list of (mtime, size, filename) for every entry. """
+        entries = []
+        directory = os.path.join(self.path, 'sha256')
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            filename = os.path.join(directory, name)
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def size(self):
+        """ Return the total size of this cache, in bytes. """
+        return sum(size for (_, size, _) in self.entries())
+
+    def evict(self):
+        """ Delete the least recently used entries until we fit max_size. """
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for (_, size, _) in entries)
+            for (_, size, filename) in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(filename)
+                except FileNotFoundError:
+                    pass
+                total -= size
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+"""
+Helpers for bucko's small per-user on-disk caches.
+"""
+
+# Parsed configuration files, keyed by path.
+_files = {}
+
+
+def cache_dir():
+    """
+    Return the directory for bucko's cache files, creating it if necessary.
+
+    This is $XDG_CACHE_HOME/bucko, or ~/.cache/bucko.
+    """
+    base = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'bucko')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def read_json(path):
+    """
+    Read a JSON cache file.
+
+    :returns: the decoded data, or None if the file is missing or corrupt.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def read_file(path, loader):
+    """
+    Read and parse a configuration file, re-using the last result until the
+    file changes.
+
+    :param str path: file to read
+    :param loader: callable that parses an open file object, eg. json.load
+    :returns: the parsed data, or None if the file does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        _files.pop(path, None)
+        return None
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    entry = _files.get(path)
+    if entry and entry[0] == stamp and entry[1] == loader:
+        return entry[2]
+    try:
+        with open(path) as f:
+            data = loader(f)
+    except FileNotFoundError:
+        return None
+    _files[path] = (stamp, loader, data)
+    return data
+
+
+def write_private_json(path, data):
+    """
+    Atomically write JSON data to a file that only this user can read (0600).
+    """
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def fingerprint(**inputs):
+    """
+    Return a stable sha256 hex digest for these inputs.
+
+    Lists, tuples and sets are order-insensitive, and we compare all other
+    values (except None) by their str().
+    """
+    normalized = {}
+    for key, value in inputs.items():
+        if isinstance(value, (list, tuple, set, frozenset)):
+            value = sorted(str(item) for item in value)
+        elif value is not None:
+            value = str(value)
+        normalized[key] = value
+    data = json.dumps(normalized, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class TTLCache(object):
+    """
+    Simple key/value cache where each entry expires after "ttl" seconds.
+
+    Keys must be strings and values must be JSON-serializable. If "path" is
+    set, we also persist the entries to that (private) JSON file, so that
+    later bucko runs can share them.
+    """
+
+    def __init__(self, ttl, path=None):
+        self.ttl = ttl
+        self.path = path
+        self.entries = {}
+        if path:
+            self.entries = read_json(path) or {}
+
+    def get(self, key):
+        """ Return the unexpired value for this key, or None. """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.time():
+            self.invalidate(key)
+            return None
+        return value
+
+    def set(self, key, value):
+        """ Store a value for this key. """
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.save()
+
+    def invalidate(self, key=None):
+        """ Forget one key, or every key if key is None. """
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+        self.save()
+
+    def save(self):
+        if self.path:
+            write_private_json(self.path, self.entries)
@@ -27,6 +27,16 @@ def lookup(configp, section, option, fatal=True):
             raise SystemExit('Problem parsing .bucko.conf: %s' % e.message)
 
 
+def parse_boolean(value):
+    """ Return True if this setting's value means "yes". None is False. """
+    return str(value).lower() in ('yes', 'true', 'on', '1')
+
+
+def lookup_boolean(configp, section, option):
+    """ Look up an optional boolean option, defaulting to False. """
+    return parse_boolean(lookup(configp, section, option, fatal=False))
+
+
 def get_repo_urls(configp, section):
     """
     Return a set of URLs for this configparser section.
@@ -1,5 +1,6 @@
 import sys
 import subprocess
+from bucko import trace
 from bucko.log import log
 
 
@@ -95,7 +96,10 @@ def cmd(*args, **kwargs):
     log_cmd = kwargs.pop('log_cmd', True)
     if log_cmd:
         log.info('+ ' + ' '.join(args))
-    output = subprocess.check_output(args, **kwargs)
+    # Name the span after the program and subcommand, eg. "skopeo copy".
+    words = [arg for arg in args if arg != 'sudo' and '=' not in arg]
+    with trace.span(' '.join(words[:2]), 'cmd'):
+        output = subprocess.check_output(args, **kwargs)
     if PY2:
         return output
     return output.decode('utf-8')
@@ -1,28 +1,239 @@
+import fcntl
+import os
 import posixpath
+import time
 import koji
 from koji_cli.lib import activate_session
 from koji_cli.lib import watch_tasks
+from bucko import trace
+from bucko.log import log
+from bucko.cache import cache_dir, read_json, write_private_json, TTLCache
+try:
+    import gssapi
+except ImportError:
+    gssapi = None
 
 """ Use the Koji API to build a container image """
 
+# How long we will try to re-use a saved Koji session, in seconds.
+# The hub may expire a session sooner, so we always double-check it.
+SESSION_TTL = 12 * 60 * 60
 
-class KojiBuilder(object):
-    """ Simple Koji client that can barely build a container image. """
+# How long we will cache build target and tag information, in seconds.
+METADATA_TTL = 24 * 60 * 60
 
-    def __init__(self, profile):
-        self.profile = profile
+# Process-wide ClientSessions, keyed by Koji profile name.
+_sessions = {}
+
+# Process-wide build target and tag caches, keyed by Koji profile name.
+_metadata_caches = {}
+
+# Open lock files for the saved sessions that this process owns, keyed by
+# Koji profile name.
+_session_locks = {}
+
+# Koji profile names whose sessions we save for later bucko runs.
+_persistent_sessions = set()
+
+
+def get_session(profile):
+    """ Return the shared ClientSession for this Koji profile. """
+    if profile not in _sessions:
         mykoji = koji.get_profile_module(profile)
         opts = vars(mykoji.config)
-        self.session = mykoji.ClientSession(mykoji.config.server, opts)
+        session = mykoji.ClientSession(mykoji.config.server, opts)
+        trace_calls(session)
+        _sessions[profile] = session
+    return _sessions[profile]
+
+
+def trace_calls(session):
+    """ Record a trace span for each of this session's hub calls. """
+    call_method = session._callMethod
+
+    def _callMethod(name, args, kwargs=None, retry=True):
+        with trace.span('koji %s' % name, 'koji'):
+            return call_method(name, args, kwargs, retry)
+    session._callMethod = _callMethod
+
+
+def get_metadata_cache(profile, ttl=METADATA_TTL, persist=False):
+    """
+    Return the shared build target and tag cache for this Koji profile.
+
+    :param int ttl: number of seconds to cache each entry.
+    :param bool persist: also save the cache to disk for later bucko runs.
+    """
+    if profile not in _metadata_caches:
+        path = None
+        if persist:
+            path = os.path.join(cache_dir(), 'koji-metadata-%s.json' % profile)
+        _metadata_caches[profile] = TTLCache(ttl, path)
+    return _metadata_caches[profile]
+
+
+def login_principal(opts):
+    """
+    Return the name that activate_session() will log in with, or None if we
+    cannot tell.
+
+    For Kerberos, this is the profile's "principal" setting or the principal
+    in the default credential cache.
+
+    :param dict opts: Koji profile settings
+    """
+    authtype = opts.get('authtype')
+    if authtype == 'password':
+        return opts.get('user')
+    if authtype == 'ssl':
+        return opts.get('cert')
+    if opts.get('principal'):
+        return opts['principal']
+    if gssapi is None:
+        return None
+    try:
+        return str(gssapi.Credentials(usage='initiate').name)
+    except gssapi.exceptions.GSSError:
+        return None
+
+
+def session_file(profile):
+    """ Return the path to the saved session file for this profile. """
+    return os.path.join(cache_dir(), 'koji-session-%s.json' % profile)
+
+
+def lock_session_file(profile):
+    """
+    Take this profile's saved session for the rest of this process.
+
+    The hub rejects a call number that is lower than the last one it saw for
+    a session, so two processes must never use one saved session at once.
+
+    :returns: True if this process owns the saved session, False if another
+              process does.
+    """
+    if profile in _session_locks:
+        return True
+    f = open(session_file(profile) + '.lock', 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _session_locks[profile] = f
+    return True
+
+
+def save_session(profile, session):
+    """
+    Save this session's ID, key, principal and next call number for later
+    bucko runs, if this profile's sessions are persistent.
+
+    We keep the expiry time of the session that we already saved.
+    """
+    if profile not in _persistent_sessions:
+        return
+    if not session.logged_in or not session.sinfo:
+        return
+    if not lock_session_file(profile):
+        return
+    path = session_file(profile)
+    expires = time.time() + SESSION_TTL
+    saved = read_json(path)
+    if saved and saved.get('sinfo') == session.sinfo:
+        expires = saved.get('expires', expires)
+    data = {'server': session.baseurl,
+            'principal': login_principal(session.opts),
+            'sinfo': session.sinfo,
+            'callnum': session.callnum,
+            'expires': expires}
+    write_private_json(path, data)
+
+
+def save_sessions():
+    """
+    Save the next call numbers of all our logged-in sessions.
+
+    Call this after the last Koji call in this process.
+    """
+    for profile, session in _sessions.items():
+        save_session(profile, session)
+
+
+class KojiBuilder(object):
+    """
+    Simple Koji client that can barely build a container image.
+
+    :param int metadata_ttl: seconds to cache build target and tag
+                             information.
+    :param bool persist_metadata: save that information for later runs.
+    :param bool persist_session: save our logged-in session for later runs.
+    """
+
+    def __init__(self, profile, metadata_ttl=METADATA_TTL,
+                 persist_metadata=False, persist_session=False):
+        self.profile = profile
+        if persist_session:
+            _persistent_sessions.add(profile)
+        self.session = get_session(profile)
+        self.metadata = get_metadata_cache(profile, metadata_ttl,
+                                           persist_metadata)
+        self.task_results = {}
 
     def ensure_logged_in(self):
         """ Log in if we are not already logged in """
-        if not self.session.logged_in:
-            self.session.opts['noauth'] = False
-            # Log in ("activate") this session:
-            # Note: this can raise SystemExit if there is a problem, eg with
-            # Kerberos:
-            activate_session(self.session, self.session.opts)
+        if self.session.logged_in:
+            return
+        if self.resume_session():
+            return
+        self.session.opts['noauth'] = False
+        # Log in ("activate") this session:
+        # Note: this can raise SystemExit if there is a problem, eg with
+        # Kerberos:
+        activate_session(self.session, self.session.opts)
+        self.save_session()
+
+    def resume_session(self):
+        """
+        Re-use an authenticated session that we saved in an earlier run.
+
+        :returns: True if we resumed a valid session, False otherwise.
+        """
+        if self.profile not in _persistent_sessions:
+            return False
+        data = read_json(session_file(self.profile))
+        if not data:
+            return False
+        if data.get('server') != self.session.baseurl:
+            return False
+        principal = login_principal(self.session.opts)
+        if not principal or data.get('principal') != principal:
+            log.info('not resuming the saved %s session for %s'
+                     % (self.profile, data.get('principal')))
+            return False
+        if data.get('expires', 0) < time.time():
+            return False
+        if not lock_session_file(self.profile):
+            log.info('another bucko process is using the saved %s session'
+                     % self.profile)
+            return False
+        self.session.setSession(data['sinfo'])
+        # setSession() starts counting calls from zero again, but the hub
+        # remembers this session's last call number.
+        self.session.callnum = data.get('callnum', 0)
+        try:
+            user = self.session.getLoggedInUser()
+        except koji.GenericError:
+            user = None
+        if not user:
+            # The hub has expired this session.
+            self.session.setSession(None)
+            return False
+        return True
+
+    def save_session(self):
+        """ Save this session for later bucko runs. """
+        save_session(self.profile, self.session)
 
     def build_container(self, scm, target, branch, repos, scratch=True,
                         koji_parent_build=None):
@@ -45,7 +256,7 @@ class KojiBuilder(object):
         self.ensure_logged_in()
 
         # Sanity-check build target name:
-        if self.session.getBuildTarget(target) is None:
+        if self.get_build_target(target) is None:
             server = self.session.opts['server']
             msg = 'Build Target %s is not present in %s' % (target, server)
             raise RuntimeError(msg)
@@ -57,7 +268,16 @@ class KojiBuilder(object):
         if koji_parent_build:
             config['koji_parent_build'] = str(koji_parent_build)
 
-        return self.session.buildContainer(scm, target, config, priority=None)
+        task_id = self.session.buildContainer(scm, target, config,
+                                              priority=None)
+        self.save_session()
+        return task_id
+
+    def cancel_task(self, id_):
+        """ Cancel a Koji task that we submitted. """
+        self.ensure_logged_in()
+        self.session.cancelTask(id_)
+        self.save_session()
 
     def watch_task(self, id_, interval=5):
         """ Watch a Koji task ID, printing its state transitions to STDOUT """
@@ -68,14 +288,64 @@ class KojiBuilder(object):
         if task_result != 0:
             raise RuntimeError('failed buildContainer task')
 
+    def watch_tasks(self, ids, interval=5):
+        """
+        Watch several Koji task IDs together in one polling loop.
+
+        We query all the unfinished tasks' states in one multicall each time.
+
+        :param list ids: Koji task IDs
+        :param int interval: seconds to wait between each poll
+        :returns: generator that yields a (task ID, success) tuple as soon as
+                  each task finishes. "success" is a bool.
+        """
+        weburl = self.session.opts['weburl']
+        for id_ in ids:
+            url = posixpath.join(weburl, 'taskinfo?taskID=%s' % id_)
+            print('Watching Koji task %s' % url)
+        finished = [koji.TASK_STATES[name]
+                    for name in ('CLOSED', 'CANCELED', 'FAILED')]
+        states = {}
+        pending = list(ids)
+        while pending:
+            with self.session.multicall(strict=True) as m:
+                calls = [(id_, m.getTaskInfo(id_)) for id_ in pending]
+            for id_, call in calls:
+                state = call.result['state']
+                if states.get(id_) != state:
+                    name = koji.TASK_STATES[state]
+                    print('Koji task %s is %s' % (id_, name))
+                    states[id_] = state
+                if state in finished:
+                    pending.remove(id_)
+                    yield id_, state == koji.TASK_STATES['CLOSED']
+            if pending:
+                time.sleep(interval)
+
+    def task_succeeded(self, id_):
+        """ Return True if this Koji task has finished successfully. """
+        info = self.session.getTaskInfo(id_)
+        return bool(info) and info['state'] == koji.TASK_STATES['CLOSED']
+
+    def get_task_result(self, id_):
+        """ Return (and remember) the result of a finished Koji task.
+
+        A task's result never changes once it has finished, so we only ask
+        the hub once per task ID.
+        """
+        if id_ not in self.task_results:
+            self.task_results[id_] = self.session.getTaskResult(id_)
+        return self.task_results[id_]
+
     def get_repositories(self, id_, target):
         """ Get the list of repositories for a container task.
 
         The first item in this list is the OSBS unique tag's repo.
         https://osbs.readthedocs.io/en/latest/users.html#image-tags
         """
-        result = self.session.getTaskResult(id_)
-        repositories = result['repositories']
+        result = self.get_task_result(id_)
+        # Copy this list so that we don't reorder our cached task result.
+        repositories = list(result['repositories'])
         unique_repo = None
         for repository in repositories:
             _, tag = repository.split(':', 1)  # eg "5", "latest", etc
@@ -95,21 +365,31 @@ class KojiBuilder(object):
         return repositories
 
     def untag_task_result(self, task_id):
-        """ Untag the builds from this buildContainer task. """
-        result = self.session.getTaskResult(task_id)
-        build_ids = result['koji_builds']
-        for build_id in build_ids:
-            build_id = int(build_id)  # koji returns strs for some reason
-            weburl = self.session.opts['weburl']
+        """ Untag the builds from this buildContainer task.
+
+        We query all the builds' tags in one multicall, and then untag
+        everything in a second multicall.
+        """
+        result = self.get_task_result(task_id)
+        # koji returns strs for some reason
+        build_ids = [int(build_id) for build_id in result['koji_builds']]
+        weburl = self.session.opts['weburl']
+        with self.session.multicall(strict=True) as m:
+            calls = [m.listTags(build=build_id) for build_id in build_ids]
+        untags = []
+        for build_id, call in zip(build_ids, calls):
             url = posixpath.join(weburl, 'buildinfo?buildID=%s' % build_id)
             print('Checking %s for tags to untag' % url)
-            tags = self.session.listTags(build=build_id)
-            if tags:
-                self.ensure_logged_in()
-            for tag in tags:
-                tag_name = tag['name']
+            for tag in call.result:
+                untags.append((url, tag['name'], build_id))
+        if not untags:
+            return
+        self.ensure_logged_in()
+        with self.session.multicall(strict=True) as m:
+            for url, tag_name, build_id in untags:
                 print('Untagging %s from %s' % (url, tag_name))
-                self.session.untagBuild(tag_name, build_id, strict=False)
+                m.untagBuild(tag_name, build_id, strict=False)
+        self.save_session()
 
     def get_target_arches(self, target):
         """
@@ -118,7 +398,67 @@ class KojiBuilder(object):
         :param str target: eg. ceph-8.0-rhel-9-containers-candidate
         :returns: a space-separated list, like "x86_64 ppc64le s390x aarch64".
         """
-        result = self.session.getBuildTarget(target, strict=True)
-        build_tag = result['build_tag']
-        tag = self.session.getTag(build_tag, strict=True)
+        result = self.get_build_target(target)
+        if result is None:
+            raise koji.GenericError('No such build target: %s' % target)
+        tag = self.get_tag(result['build_tag'])
         return tag['arches']
+
+    def get_build_target(self, target):
+        """
+        Return (cached) information about a Koji build target.
+
+        :param str target: eg. ceph-8.0-rhel-9-containers-candidate
+        :returns: a dict, or None if this target does not exist.
+        """
+        key = 'target:%s' % target
+        info = self.metadata.get(key)
+        if info is None:
+            info = self.session.getBuildTarget(target)
+            if info is not None:
+                self.metadata.set(key, info)
+        return info
+
+    def get_tag(self, tag):
+        """
+        Return (cached) information about a Koji tag.
+
+        :param tag: tag name or ID, eg. "ceph-8.0-rhel-9-container-build"
+        :returns: a dict
+        """
+        key = 'tag:%s' % tag
+        info = self.metadata.get(key)
+        if info is None:
+            info = self.session.getTag(tag, strict=True)
+            self.metadata.set(key, info)
+        return info
+
+    def get_last_event(self):
+        """ Return the ID of the hub's most recent event. """
+        return self.session.getLastEvent()['id']
+
+    def tag_changed_since(self, tag, event):
+        """
+        Return True if this tag's contents may have changed since an event.
+
+        We check for tagged or untagged builds and inheritance changes in
+        this tag and in all the tags it inherits from.
+
+        :param str tag: eg. "ceph-8.0-rhel-9-candidate"
+        :param int event: Koji event ID
+        """
+        parents = self.session.getFullInheritance(tag)
+        tags = [tag] + [parent['name'] for parent in parents]
+        tables = ['tag_listing', 'tag_inheritance']
+        with self.session.multicall(strict=True) as m:
+            calls = [m.queryHistory(tables=tables, tag=name, afterEvent=event)
+                     for name in tags]
+        for call in calls:
+            for changes in call.result.values():
+                if changes:
+                    return True
+        return False
+
+    def invalidate_metadata(self):
+        """ Forget all cached build target and tag information. """
+        self.metadata.invalidate()
@@ -1,18 +1,249 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+import os
+import threading
+import time
+from bucko.cache import cache_dir, fingerprint, TTLCache
 from bucko.log import log
+from bucko.transport import retry
 from odcs.client import odcs
 
 ODCS_URL = 'https://odcs.engineering.redhat.com'
 
+# Sigkeys for our tag composes. The empty string means "unsigned".
+SIGKEYS = ['']
 
-def generate(tag, arches):
-    # On CLI:
-    # odcs --quiet --redhat create-tag --arch "x86_64 ppc64le s390x" --sigkey none ceph-6.0-rhel-9-candidate
-    # odcs --quiet --redhat create-tag --arch "x86_64 ppc64le s390x aarch64" --sigkey none ceph-8.0-rhel-9-candidate
-    source = odcs.ComposeSourceTag(tag, sigkeys=[''])
-    client = odcs.ODCS(ODCS_URL, auth_mech=odcs.AuthMech.Kerberos)
-    compose = client.request_compose(source, arches=arches.split())
-    log.info('waiting for %s to finish' % compose['toplevel_url'])
-    result = client.wait_for_compose(compose['id'])
-    if result['state_name'] != 'done':
-        raise RuntimeError(result)
-    return result['result_repofile']
+# Default number of seconds to wait for each compose.
+COMPOSE_TIMEOUT = 60 * 60
+
+# Default number of seconds between polls. We double this each time, up to
+# MAX_POLL_INTERVAL.
+POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 60
+
+# How long we will remember each compose, in seconds. ODCS removes composes
+# after one day by default.
+COMPOSE_TTL = 24 * 60 * 60
+
+# We only re-use a compose if ODCS will keep it for at least this many more
+# seconds, so that it outlives the container build.
+REUSE_MARGIN = 2 * 60 * 60
+
+
+def seconds_to_expire(compose):
+    """
+    Return the number of seconds until ODCS removes this compose.
+
+    :returns: seconds (float), or None if we cannot tell.
+    """
+    value = compose.get('time_to_expire')
+    if not value:
+        return None
+    try:
+        expires = datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+    except ValueError:
+        return None
+    expires = expires.replace(tzinfo=timezone.utc)
+    return (expires - datetime.now(timezone.utc)).total_seconds()
+
+
+def get_compose_store():
+    """ Return our record of earlier composes, keyed by compose_key(). """
+    path = os.path.join(cache_dir(), 'odcs-composes.json')
+    return TTLCache(COMPOSE_TTL, path)
+
+
+def compose_key(tag, arches):
+    """ Return a key for this tag, space-separated arches, and SIGKEYS. """
+    return fingerprint(tag=tag, arches=arches.split(), sigkeys=SIGKEYS)
+
+
+def find_compose(tag, arches, koji):
+    """
+    Find an earlier compose that we can re-use for this tag.
+
+    :param str tag: eg. "ceph-8.0-rhel-9-candidate"
+    :param str arches: space-separated list, eg "x86_64 ppc64le"
+    :param koji: KojiBuilder to check the tag's history
+    :returns: dict of information about the earlier compose, or None if we
+              have no compose, or if the tag has changed since then.
+    """
+    store = get_compose_store()
+    saved = store.get(compose_key(tag, arches))
+    if not saved:
+        return None
+    if koji.tag_changed_since(tag, saved['event']):
+        log.info('%s has changed since compose %s' % (tag,
+                                                      saved['compose_id']))
+        return None
+    return saved
+
+
+class OdcsManager(object):
+    """
+    Generate several ODCS tag composes at the same time.
+
+    We request each compose right away, so ODCS queues them all together.
+    Then each compose waits in its own thread, polls ODCS with exponential
+    backoff, and gives up after "timeout" seconds, or as soon as we call
+    shutdown().
+
+    :param str url: ODCS server URL
+    :param int timeout: seconds to wait for each compose
+    :param int interval: seconds to wait before the first poll
+    :param int max_interval: longest number of seconds between polls
+    :param auth_mech: odcs.AuthMech value
+    :param int max_workers: number of composes to wait for at once
+    """
+
+    def __init__(self, url=ODCS_URL, timeout=COMPOSE_TIMEOUT,
+                 interval=POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                 auth_mech=odcs.AuthMech.Kerberos, max_workers=4):
+        self.client = odcs.ODCS(url, auth_mech=auth_mech)
+        self.timeout = timeout
+        self.interval = interval
+        self.max_interval = max_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stopped = threading.Event()
+        # Our threads share one copy of the compose store.
+        self.store = get_compose_store()
+        self.store_lock = threading.Lock()
+
+    def shutdown(self):
+        """
+        Stop waiting for composes, without waiting for the threads.
+
+        Python joins the executor's threads when it exits, so a failed bucko
+        run must call this to exit promptly.
+        """
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
+
+    def check_stopped(self):
+        """ Raise RuntimeError if shutdown() has stopped us. """
+        if self.stopped.is_set():
+            raise RuntimeError('stopped waiting for ODCS composes')
+
+    def sleep(self, seconds):
+        """ Sleep, or raise RuntimeError as soon as shutdown() stops us. """
+        self.stopped.wait(seconds)
+        self.check_stopped()
+
+    def submit(self, tag, arches, event=None, saved=None):
+        """
+        Request a compose now, and wait for it in the background.
+
+        See generate() for the parameters.
+
+        :returns: a Future for the compose's .repo file URL
+        """
+        self.check_stopped()
+        future = Future()
+        if saved:
+            repofile = self.reuse(saved)
+            if repofile:
+                future.set_result(repofile)
+                return future
+        # On CLI:
+        # odcs --quiet --redhat create-tag --arch "x86_64 ppc64le s390x" --sigkey none ceph-6.0-rhel-9-candidate
+        # odcs --quiet --redhat create-tag --arch "x86_64 ppc64le s390x aarch64" --sigkey none ceph-8.0-rhel-9-candidate
+        source = odcs.ComposeSourceTag(tag, sigkeys=SIGKEYS)
+        compose = self.client.request_compose(source, arches=arches.split())
+        log.info('waiting for %s to finish' % compose['toplevel_url'])
+        return self.executor.submit(self.finish, tag, arches, event, compose)
+
+    def generate(self, tag, arches, event=None, saved=None):
+        """
+        Generate an ODCS compose for this tag and return the .repo file URL.
+
+        :param str tag: eg. "ceph-8.0-rhel-9-candidate"
+        :param str arches: space-separated list, eg "x86_64 ppc64le"
+        :param int event: Koji event ID from before this compose. If set, we
+                          record this compose so that later runs can re-use
+                          it.
+        :param dict saved: an earlier compose from find_compose(). We re-use
+                           it if ODCS still has it.
+        """
+        return self.submit(tag, arches, event, saved).result()
+
+    def reuse(self, saved):
+        """
+        Return the .repo file URL of an earlier compose, or None if we
+        cannot re-use that compose.
+
+        :param dict saved: an earlier compose from find_compose()
+        """
+        result = retry(self.client.get_compose, saved['compose_id'])
+        remaining = seconds_to_expire(result)
+        if result['state_name'] != 'done':
+            log.info('compose %s is %s' % (saved['compose_id'],
+                                           result['state_name']))
+        elif remaining is None or remaining < REUSE_MARGIN:
+            log.info('compose %s expires too soon to re-use (%s)'
+                     % (saved['compose_id'], result.get('time_to_expire')))
+        else:
+            log.info('re-using unchanged compose %s' % result['toplevel_url'])
+            return result['result_repofile']
+        return None
+
+    def finish(self, tag, arches, event, compose):
+        """
+        Wait for a compose that we requested, and record it for later runs.
+
+        :returns: the compose's .repo file URL
+        """
+        result = self.wait(compose)
+        if result['state_name'] != 'done':
+            raise RuntimeError(result)
+        if event is not None:
+            with self.store_lock:
+                self.store.set(compose_key(tag, arches), {
+                    'event': event,
+                    'compose_id': result['id'],
+                    'result_repofile': result['result_repofile'],
+                })
+        return result['result_repofile']
+
+    def wait(self, compose):
+        """
+        Poll ODCS until this compose finishes, or until our deadline.
+
+        We log the elapsed time and the time this compose spent in ODCS's
+        queue (the "wait" state).
+
+        :param dict compose: ODCS compose information
+        :returns: the final compose information (dict)
+        :raises: RuntimeError if the compose does not finish in time
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        interval = self.interval
+        queued = None
+        while True:
+            state = compose['state_name']
+            elapsed = time.monotonic() - start
+            if state != 'wait' and queued is None:
+                queued = elapsed
+            if state not in ('wait', 'generating'):
+                log.info('compose %s is %s after %ds (queued %ds)'
+                         % (compose['id'], state, elapsed, queued))
+                return compose
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError('compose %s is still %s after %d seconds'
+                                   % (compose['id'], state, self.timeout))
+            log.info('compose %s is %s (elapsed %ds, queued %ds)'
+                     % (compose['id'], state, elapsed,
+                        elapsed if queued is None else queued))
+            self.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.max_interval)
+            compose = retry(self.client.get_compose, compose['id'])
+
+
+def generate(tag, arches, event=None, saved=None):
+    """
+    Generate one ODCS compose for this tag and return the .repo file URL.
+
+    See OdcsManager.generate() for the parameters.
+    """
+    return OdcsManager().generate(tag, arches, event, saved)
@@ -0,0 +1,202 @@
+import bz2
+import os
+import re
+import tempfile
+import zlib
+from subprocess import Popen, PIPE
+
+"""
+Read the signed payloads from OpenPGP messages, without running gpg.
+
+Container signatures are binary OpenPGP "signed messages": a one-pass
+signature packet, a literal data packet with the JSON payload, and a
+signature packet, usually all wrapped in a compressed data packet. See
+RFC 4880.
+"""
+
+# Packet tags (RFC 4880 section 4.3)
+COMPRESSED_DATA = 8
+LITERAL_DATA = 11
+
+# Compression algorithms (RFC 4880 section 9.3)
+UNCOMPRESSED = 0
+ZIP = 1
+ZLIB = 2
+BZIP2 = 3
+
+
+def packets(data):
+    """
+    Parse a sequence of OpenPGP packets.
+
+    :param bytes data: binary (not ASCII-armored) OpenPGP data
+    :yields: (tag, body) tuples
+    :raises: ValueError if the data is not valid OpenPGP
+    """
+    offset = 0
+    while offset < len(data):
+        header = data[offset]
+        offset += 1
+        if not header & 0x80:
+            raise ValueError('invalid OpenPGP packet header at byte %d'
+                             % (offset - 1))
+        if header & 0x40:
+            # New format packet
+            tag = header & 0x3f
+            body, offset = new_format_body(data, offset)
+        else:
+            # Old format packet
+            tag = (header >> 2) & 0x0f
+            body, offset = old_format_body(data, offset, header & 0x03)
+        yield (tag, body)
+
+
+def old_format_body(data, offset, length_type):
+    """
+    Read an old format packet body.
+
+    :returns: (body, offset of the next packet)
+    """
+    if length_type == 3:
+        # Indeterminate length: the packet extends to the end of the data.
+        return (data[offset:], len(data))
+    size = 1 << length_type
+    if offset + size > len(data):
+        raise ValueError('truncated OpenPGP packet header')
+    length = int.from_bytes(data[offset:offset + size], 'big')
+    offset += size
+    return read_body(data, offset, length)
+
+
+def new_format_body(data, offset):
+    """
+    Read a new format packet body, joining any partial body lengths.
+
+    :returns: (body, offset of the next packet)
+    """
+    parts = []
+    while True:
+        if offset >= len(data):
+            raise ValueError('truncated OpenPGP packet header')
+        first = data[offset]
+        if first < 192:
+            length = first
+            offset += 1
+        elif first < 224:
+            if offset + 2 > len(data):
+                raise ValueError('truncated OpenPGP packet header')
+            length = ((first - 192) << 8) + data[offset + 1] + 192
+            offset += 2
+        elif first == 255:
+            if offset + 5 > len(data):
+                raise ValueError('truncated OpenPGP packet header')
+            length = int.from_bytes(data[offset + 1:offset + 5], 'big')
+            offset += 5
+        else:
+            # Partial body length: more parts follow this one.
+            part, offset = read_body(data, offset + 1, 1 << (first & 0x1f))
+            parts.append(part)
+            continue
+        body, offset = read_body(data, offset, length)
+        parts.append(body)
+        return (b''.join(parts), offset)
+
+
+def read_body(data, offset, length):
+    if offset + length > len(data):
+        raise ValueError('truncated OpenPGP packet body')
+    return (data[offset:offset + length], offset + length)
+
+
+def decompress(body):
+    """
+    Decompress the body of a compressed data packet.
+
+    :returns: bytes, the inner packets
+    """
+    algorithm = body[0]
+    compressed = body[1:]
+    try:
+        if algorithm == UNCOMPRESSED:
+            return compressed
+        if algorithm == ZIP:
+            return zlib.decompress(compressed, -15)
+        if algorithm == ZLIB:
+            return zlib.decompress(compressed)
+        if algorithm == BZIP2:
+            return bz2.decompress(compressed)
+    except (zlib.error, OSError) as e:
+        raise ValueError('could not decompress OpenPGP data: %s' % e)
+    raise ValueError('unknown OpenPGP compression algorithm %d' % algorithm)
+
+
+def literal_data(data):
+    """
+    Return the contents of the first literal data packet in this message.
+
+    This is the data that the message signs. We do not check the signature.
+
+    :param bytes data: binary OpenPGP message
+    :returns: bytes
+    :raises: ValueError if there is no literal data packet
+    """
+    for tag, body in packets(data):
+        if tag == COMPRESSED_DATA:
+            return literal_data(decompress(body))
+        if tag == LITERAL_DATA:
+            # format (1 byte), file name length (1 byte), file name,
+            # date (4 bytes), and then the data.
+            if len(body) < 2:
+                raise ValueError('truncated OpenPGP literal data packet')
+            start = 2 + body[1] + 4
+            return body[start:]
+    raise ValueError('no literal data in OpenPGP message')
+
+
+def verify(signatures, gpg='gpg'):
+    """
+    Verify many signed messages with one gpg process.
+
+    :param list signatures: binary OpenPGP messages (bytes)
+    :returns: list of bools, True for each good signature from a key in our
+              keyring, False for bad or unreadable signatures.
+    :raises: RuntimeError if we cannot match gpg's output to the messages.
+    """
+    if not signatures:
+        return []
+    with tempfile.TemporaryDirectory(prefix='bucko-') as tmpdir:
+        filenames = []
+        for index, signature in enumerate(signatures):
+            filename = os.path.join(tmpdir, 'signature-%d' % index)
+            with open(filename, 'wb') as f:
+                f.write(signature)
+            filenames.append(filename)
+        cmd = [gpg, '--batch', '--status-fd', '1', '--verify-files']
+        p = Popen(cmd + filenames, stdout=PIPE, stderr=PIPE)
+        stdout_data = p.communicate()[0]
+    return parse_status(stdout_data.decode(), len(signatures))
+
+
+def parse_status(output, count):
+    """
+    Parse "gpg --status-fd" output for "count" signed messages.
+
+    gpg prints a FILE_START line for each message, and then a GOODSIG line
+    if the signature is good and the key has not expired or been revoked.
+
+    :returns: list of bools, one per message
+    """
+    results = []
+    for line in output.splitlines():
+        match = re.match(r'^\[GNUPG:\] (\w+)', line)
+        if not match:
+            continue
+        keyword = match.group(1)
+        if keyword == 'FILE_START':
+            results.append(False)
+        elif keyword == 'GOODSIG' and results:
+            results[-1] = True
+    if len(results) != count:
+        raise RuntimeError('gpg checked %d signatures, expected %d'
+                           % (len(results), count))
+    return results
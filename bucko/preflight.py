@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+import posixpath
+import requests
+from bucko import transport
+from bucko.log import log
+try:
+    from configparser import RawConfigParser, Error as ConfigParserError
+except ImportError:
+    from ConfigParser import RawConfigParser, Error as ConfigParserError
+
+"""
+Pre-flight checks for the Yum repositories of a container build.
+
+OSBS only discovers a dead .repo URL or a stale baseurl many minutes into a
+build. Before we submit a build, we fetch every .repo file, and we check
+that every repository in those files has repodata/repomd.xml.
+"""
+
+# Number of concurrent HTTP requests.
+MAX_WORKERS = 8
+
+# Options that list a repository's mirrors instead of a baseurl.
+MIRROR_OPTIONS = ('mirrorlist', 'metalink')
+
+
+def repo_baseurls(text, arches):
+    """
+    Return the baseurls of all the enabled repositories in a .repo file.
+
+    We expand "$basearch" for each arch. We skip repositories with a
+    mirrorlist or metalink and no baseurl.
+
+    :param str text: contents of a Yum .repo file
+    :param list arches: eg. ["x86_64", "ppc64le"]
+    :returns: list of (repository name, baseurl) tuples
+    :raises: ValueError if we cannot parse this .repo file, or if it has no
+             enabled repositories
+    """
+    parser = RawConfigParser()
+    try:
+        parser.read_string(text)
+    except ConfigParserError as e:
+        raise ValueError('could not parse .repo file: %s' % e)
+    baseurls = []
+    repositories = 0
+    for section in parser.sections():
+        options = [option for option in ('baseurl',) + MIRROR_OPTIONS
+                   if parser.has_option(section, option)]
+        if not options:
+            continue
+        if parser.has_option(section, 'enabled') and \
+                parser.get(section, 'enabled').strip() == '0':
+            continue
+        repositories += 1
+        if 'baseurl' not in options:
+            log.info('pre-flight: skipping [%s] with a %s'
+                     % (section, options[0]))
+            continue
+        for baseurl in parser.get(section, 'baseurl').split():
+            if '$basearch' in baseurl:
+                for arch in arches:
+                    expanded = baseurl.replace('$basearch', arch)
+                    baseurls.append((section, expanded))
+            else:
+                baseurls.append((section, baseurl))
+    if not repositories:
+        raise ValueError('no enabled repositories')
+    return baseurls
+
+
+def repomd_url(baseurl):
+    """ Return the URL to the repomd.xml file for this baseurl. """
+    return posixpath.join(baseurl, 'repodata', 'repomd.xml')
+
+
+class Preflight(object):
+    """
+    Check many .repo URLs and their repositories concurrently.
+
+    :param session: requests.Session to use. By default we create one
+                    with bucko.transport.session().
+    :param int max_workers: number of requests at a time
+    """
+
+    def __init__(self, session=None, max_workers=MAX_WORKERS):
+        if session is None:
+            session = transport.session(pool_size=max_workers)
+        self.session = session
+        self.max_workers = max_workers
+
+    def fetch_repo(self, url, arches):
+        """
+        Download one .repo file and parse its baseurls.
+
+        :returns: (baseurls, problem) tuple. "problem" is a message, or None
+                  if we found the baseurls.
+        """
+        try:
+            r = self.session.get(url)
+            r.raise_for_status()
+            return (repo_baseurls(r.text, arches), None)
+        except (requests.RequestException, ValueError) as e:
+            return ([], '%s: %s' % (url, e))
+
+    def head_repomd(self, repo_url, section, baseurl):
+        """
+        Check that one repository has metadata.
+
+        :returns: a problem message, or None if the repository is fine
+        """
+        url = repomd_url(baseurl)
+        try:
+            r = self.session.head(url, allow_redirects=True)
+            r.raise_for_status()
+            return None
+        except requests.RequestException as e:
+            return '%s [%s]: %s' % (repo_url, section, e)
+
+    def check(self, repo_urls, arches=('x86_64',)):
+        """
+        Fetch these .repo files and HEAD all their repomd.xml files.
+
+        :param repo_urls: HTTP(S) URLs to Yum .repo files
+        :param arches: architectures for "$basearch" in baseurls
+        :returns: list of the repomd.xml URLs we checked
+        :raises: RuntimeError describing every problem we found
+        """
+        repo_urls = sorted(repo_urls)
+        for url in repo_urls:
+            if not transport.http_url(url):
+                log.info('pre-flight: skipping non-HTTP .repo URL %s' % url)
+        repo_urls = [url for url in repo_urls if transport.http_url(url)]
+        problems = []
+        checks = []
+        seen = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(lambda url: self.fetch_repo(url, arches),
+                                   repo_urls)
+            for url, (baseurls, problem) in zip(repo_urls, results):
+                if problem:
+                    problems.append(problem)
+                    continue
+                for section, baseurl in baseurls:
+                    if '$' in baseurl:
+                        log.info('pre-flight: skipping %s [%s] with an '
+                                 'unknown variable: %s'
+                                 % (url, section, baseurl))
+                        continue
+                    if baseurl in seen:
+                        continue
+                    seen.add(baseurl)
+                    checks.append((url, section, baseurl))
+            results = executor.map(lambda check: self.head_repomd(*check),
+                                   checks)
+            problems.extend(problem for problem in results if problem)
+        if problems:
+            raise RuntimeError('pre-flight checks failed:\n  %s'
+                               % '\n  '.join(problems))
+        checked = [repomd_url(baseurl) for (_, _, baseurl) in checks]
+        log.info('pre-flight: %d .repo files and %d repositories are OK'
+                 % (len(repo_urls), len(checked)))
+        return checked
+
+
+def check(repo_urls, arches=('x86_64',)):
+    """
+    Check these .repo files and their repositories.
+
+    See Preflight.check().
+    """
+    return Preflight().check(repo_urls, arches)
@@ -7,6 +7,8 @@ import os
 import paramiko
 import shutil
 import boto3
+from botocore.config import Config
+from bucko import transport
 
 """
 Publish files to a "push URL", and retrieve them via an "HTTP URL".
@@ -59,7 +61,15 @@ class Publisher(object):
         # Must set these env variables:
         assert os.environ['AWS_ACCESS_KEY_ID']
         assert os.environ['AWS_SECRET_ACCESS_KEY']
-        s3 = boto3.client('s3', endpoint_url=os.environ['AWS_ENDPOINT_URL'])
+        # Retry and time out like bucko.transport's HTTP sessions.
+        (connect_timeout, read_timeout) = transport.TIMEOUT
+        s3_config = Config(retries={'max_attempts': transport.RETRIES + 1,
+                                    'mode': 'standard'},
+                           connect_timeout=connect_timeout,
+                           read_timeout=read_timeout,
+                           max_pool_connections=transport.POOL_SIZE)
+        s3 = boto3.client('s3', endpoint_url=os.environ['AWS_ENDPOINT_URL'],
+                          config=s3_config)
         url = urlparse(self.push_url)
         bucket = url.netloc
         object_name = os.path.basename(file_)
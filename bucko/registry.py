@@ -1,10 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
 from urllib.parse import urlparse
 import base64
+import hashlib
 import os
 import json
 import posixpath
+import re
 import requests
+from bucko import openpgp
+from bucko import transport
 from bucko.build import Build
+from bucko.cache import read_file
+from bucko.log import log
+from bucko.tokens import get_token_cache, token_expiry
 
 """
 Methods to interact with our container registry API
@@ -14,52 +23,164 @@ Methods to interact with our container registry API
 
 # Possibly affected by https://access.redhat.com/articles/6138332 ?
 
+# Largest number of repository scopes we request in one token.
+MAX_SCOPES = 50
 
-class Registry(object):
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+
+# Number of concurrent requests (and pooled connections) for bulk queries.
+POOL_SIZE = 8
+
+# Number of tags to request per page.
+TAGS_PAGE_SIZE = 100
+
+# Number of the highest matching tags whose creation times newest_tag()
+# compares. None means every matching tag.
+NEWEST_TAG_CANDIDATES = None
+
+# Sanity circuit breaker for lookaside signatures: we stop before this index.
+MAX_SIGNATURES = 25
+
+# Fetch this many lookaside signatures at a time.
+SIGNATURE_WINDOW = 4
+
+# Read streamed blobs this many bytes at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# Resume an interrupted blob download this many times.
+MAX_RESUMES = 3
+
+
+def verify_digest(digest, checksum):
     """
-    Simple container registry client that query build NVRs.
+    Raise RuntimeError if this hashlib checksum does not match this digest.
 
-    This class will obtain a read-only JWT in order to access our desired
-    registry server API endpoints.
+    :param str digest: eg. "sha256:123abcd..."
+    :param checksum: a hashlib.sha256 object
+    """
+    algorithm, _, expected = digest.partition(':')
+    if algorithm != 'sha256':
+        raise RuntimeError('unsupported digest algorithm %s' % algorithm)
+    actual = checksum.hexdigest()
+    if actual != expected:
+        raise RuntimeError('digest mismatch: expected %s, got sha256:%s'
+                           % (digest, actual))
 
-    Note, in Red Hat's registry-proxy implementation, a 401 error for a
-    repository could indicate that the repository does not exist (ie, a 404).
+
+def platform_matches(platform, spec):
     """
+    Return True if a manifest list's platform matches this spec.
 
-    def __init__(self, baseurl):
-        if baseurl.endswith('/v2'):
-            self.baseurl = baseurl
-        else:
-            self.baseurl = posixpath.join(baseurl, 'v2')
-        self.session = requests.Session()
-        headers = {
-            'Accept': 'application/vnd.docker.distribution.manifest.v2+json'
-        }
-        self.session.headers.update(headers)
-        self.tokens = {}
+    :param dict platform: eg. {"architecture": "arm64", "os": "linux",
+                          "variant": "v8"}
+    :param str spec: eg. "arm64", "linux/arm64" or "linux/arm64/v8"
+    """
+    parts = spec.split('/')
+    if len(parts) == 1:
+        return platform['architecture'] == parts[0]
+    if platform.get('os') != parts[0]:
+        return False
+    if platform['architecture'] != parts[1]:
+        return False
+    if len(parts) > 2:
+        return platform.get('variant') == parts[2]
+    return True
+
+
+def decode_signatures(name, signatures, verify=False):
+    """
+    Return the JSON document payloads from these GPG signatures.
 
-    def blob(self, repository, digest):
-        """
-        Get a blob by digest.
+    :param str name: image name for error messages
+    :param list signatures: binary OpenPGP messages (bytes)
+    :param bool verify: check every signature with one gpg process, and raise
+                        RuntimeError if any signature is not good.
+    :returns: list of dicts, one per signature/ref
+    """
+    if verify:
+        results = openpgp.verify(signatures)
+        if not all(results):
+            raise RuntimeError('%s has %d bad signature(s)'
+                               % (name, results.count(False)))
+    payloads = []
+    for signature in signatures:
+        payload = json.loads(openpgp.literal_data(signature))
+        payloads.append(payload)
+    return payloads
+
+
+def token_params(service, repositories):
+    """
+    Return the query parameters for a token realm request.
 
-        :param str repository: eg "rhel7"
-        :param str blob: digest to query, eg "sha256:123abcd..."
-        """
-        endpoint = 'blobs/%s' % digest
-        r = self._get(repository, endpoint)
-        return r.json()
+    The distribution token spec allows several "scope" parameters in one
+    request, so one token can cover many repositories.
 
-    def config(self, repository, reference):
-        """
-        Return the config information for this image.
+    :returns: list of (name, value) tuples
+    """
+    params = [('scope', f'repository:{repository}:pull')
+              for repository in repositories]
+    if service:
+        params.append(('service', service))
+    return params
 
-        :param str repository: repository we want to query eg. "rhel7"
-        :param str reference: tag name in the repository, "7.5-ondeck"
-        """
-        manifest = self.manifest(repository, reference)
-        manifest_digest = manifest['config']['digest']  # "sha256:123abcd..."
-        config = self.blob(repository, manifest_digest)
-        return config
+
+def config_build(config):
+    """
+    Return the Koji name-version-release information from an image's
+    config blob labels.
+
+    :param dict config: decoded config blob
+    :returns: bucko.build.Build class
+    """
+    labels = config['config']['Labels']
+    return Build(labels['com.redhat.component'],
+                 labels['version'],
+                 labels['release'])
+
+
+def tag_sort_key(tag):
+    """
+    Return a key that sorts tags with numbers in numeric order.
+
+    For example, "7-10" sorts after "7-2".
+    """
+    return [(1, int(part), '') if part.isdigit() else (0, 0, part)
+            for part in re.split(r'(\d+)', tag)]
+
+
+def created(config):
+    """
+    Return a sortable key for the "created" time in an image's config blob.
+
+    Registries record these times in UTC, eg.
+    "2024-05-01T12:34:56.123456789Z", but the number of fractional digits
+    varies.
+
+    :param dict config: decoded config blob
+    :returns: (seconds str, fraction float) tuple
+    """
+    value = config.get('created') or ''
+    match = re.match(r'^([\d\-T:]+)(\.\d+)?', value)
+    if not match:
+        return ('', 0.0)
+    return (match.group(1), float('0' + (match.group(2) or '')))
+
+
+class BaseRegistry(object):
+    """
+    Settings and helpers that Registry and AsyncRegistry share: the base
+    URL, the token cache, podman's auth file, and the lookaside URL.
+    """
+
+    def __init__(self, baseurl, token_cache=None):
+        if baseurl.endswith('/v2'):
+            self.baseurl = baseurl
+        else:
+            self.baseurl = posixpath.join(baseurl, 'v2')
+        self.host = urlparse(self.baseurl).netloc
+        self.tokens = token_cache or get_token_cache()
 
     def find_realm_service(self, response):
         """
@@ -82,39 +203,6 @@ class Registry(object):
                 service = part[8:].strip('"')
         return (realm, service)
 
-    def store_token(self, realm, service, repository):
-        """
-        Get and store a JWT Bearer token for this repository.
-
-        If we have a saved username+password from podman-login, we'll
-        authenticate to the "realm" URL with that. If not, we will not perform
-        any authentication to "realm", and we'll simply obtain an anonymous
-        pull token.
-
-        :param str realm: eg. "https://registry.example.com/oauth/token"
-        :param str service: eg. "registry", or None
-        :param str repository: eg. "cp/ibm-ceph/prometheus-node-exporter"
-        """
-        params = {'scope': f'repository:{repository}:pull'}
-        if service:
-            params['service'] = service
-        r = self.session.get(realm, params=params, auth=self.auth)
-        r.raise_for_status()
-        data = r.json()
-        token = data['token']
-        self.tokens[repository] = token
-        return token
-
-    @property
-    def auth(self):
-        """ Returns HTTPBasicAuth if we have a saved credential, or None. """
-        o = urlparse(self.baseurl)
-        credential = self.load_credentials(o.hostname)
-        if not credential:
-            return None
-        username, password = credential
-        return requests.auth.HTTPBasicAuth(username, password)
-
     @property
     def authfile(self):
         if os.getenv('REGISTRY_AUTH_FILE'):
@@ -138,10 +226,8 @@ class Registry(object):
         """
         if not self.authfile:
             return None
-        try:
-            with open(self.authfile) as f:
-                data = json.load(f)
-        except FileNotFoundError:
+        data = read_file(self.authfile, json.load)
+        if data is None:
             return None
         auths = data.get('auths', {})
         settings = auths.get(hostname, {})
@@ -172,10 +258,8 @@ class Registry(object):
         o = urlparse(self.baseurl)
         hostname = o.hostname
         conf = f'/etc/containers/registries.d/{hostname}.yaml'
-        try:
-            with open(conf) as f:
-                data = yaml.safe_load(f)
-        except FileNotFoundError:
+        data = read_file(conf, yaml.safe_load)
+        if not data:
             return None
         docker = data.get('docker')
         if not docker:
@@ -188,7 +272,304 @@ class Registry(object):
             return lookaside
         return host.get('sigstore')
 
-    def _get(self, repository, endpoint, additional_headers={}):
+    def missing_tokens(self, repositories):
+        """
+        Find the repositories that have no valid token yet.
+
+        :returns: list of lists of up to MAX_SCOPES repositories each
+        """
+        missing = [repository for repository in dict.fromkeys(repositories)
+                   if not self.tokens.get(self.host, repository)]
+        return [missing[index:index + MAX_SCOPES]
+                for index in range(0, len(missing), MAX_SCOPES)]
+
+    def save_token(self, repositories, data):
+        """
+        Store a token from a realm's JSON response for these repositories.
+
+        :returns: the token
+        """
+        token = data['token']
+        self.tokens.set_many(self.host, repositories, token,
+                             token_expiry(data))
+        return token
+
+    def signature_template(self, lookaside, repository, digest):
+        """
+        Return a format string for this digest's lookaside signature URLs.
+
+        :returns: str with an "{index}" field
+        """
+        return posixpath.join(
+            lookaside,
+            repository + '@' + digest.replace(':', '='),
+            'signature-{index}'
+        )
+
+    def extensions_url(self, repository, digest):
+        """ Return the "extensions" API URL for this digest's signatures. """
+        baseurl = self.baseurl.replace('/v2', '/extensions/v2')
+        return posixpath.join(baseurl, repository, 'signatures', digest)
+
+
+class Registry(BaseRegistry):
+    """
+    Simple container registry client that query build NVRs.
+
+    This class will obtain a read-only JWT in order to access our desired
+    registry server API endpoints.
+
+    Note, in Red Hat's registry-proxy implementation, a 401 error for a
+    repository could indicate that the repository does not exist (ie, a 404).
+
+    By default, all Registry instances in this process share one
+    bucko.tokens.TokenCache.
+    """
+
+    def __init__(self, baseurl, token_cache=None, blob_cache=None,
+                 pool_size=POOL_SIZE):
+        super(Registry, self).__init__(baseurl, token_cache)
+        # Keep enough connections open for our concurrent requests.
+        self.pool_size = pool_size
+        self.session = transport.session(pool_size)
+        headers = {
+            'Accept': MANIFEST_V2
+        }
+        self.session.headers.update(headers)
+        self.blobs = blob_cache
+
+    def blob(self, repository, digest):
+        """
+        Get a blob by digest.
+
+        :param str repository: eg "rhel7"
+        :param str blob: digest to query, eg "sha256:123abcd..."
+        """
+        if self.blobs:
+            data = self.blobs.get(digest)
+            if data is not None:
+                return json.loads(data)
+        endpoint = 'blobs/%s' % digest
+        r = self._get(repository, endpoint)
+        if self.blobs:
+            self.blobs.set(digest, r.content)
+        return r.json()
+
+    def iter_blob(self, repository, digest, offset=0, chunk_size=CHUNK_SIZE):
+        """
+        Stream a blob by digest, without holding the whole blob in memory.
+
+        We verify the sha256 digest as we read. If the data does not match
+        the digest, we raise RuntimeError after yielding the last chunk.
+
+        :param str repository: eg "rhel7"
+        :param str digest: digest to query, eg "sha256:123abcd..."
+        :param int offset: start at this byte. We can only verify the digest
+                           when we read the blob from the start.
+        :yields: bytes
+        """
+        checksum = None
+        if offset == 0:
+            checksum = hashlib.sha256()
+        with self._blob_response(repository, digest, offset) as r:
+            if offset and r.status_code != 206:
+                raise RuntimeError('%s ignored our Range request for %s'
+                                   % (self.host, digest))
+            for chunk in r.iter_content(chunk_size):
+                if checksum:
+                    checksum.update(chunk)
+                yield chunk
+        if checksum:
+            verify_digest(digest, checksum)
+
+    def download_blob(self, repository, digest, path, chunk_size=CHUNK_SIZE):
+        """
+        Download a blob by digest to a file.
+
+        We write to "<path>.part" first. If that file already exists (for
+        example, from an earlier interrupted download), or if the connection
+        drops, we resume with an HTTP Range request. We hash the data as we
+        write it, and we only rename the file to "path" after verifying its
+        sha256 digest.
+
+        :param str repository: eg "rhel7"
+        :param str digest: digest to query, eg "sha256:123abcd..."
+        :param str path: destination file name
+        :raises: RuntimeError if the data does not match the digest.
+        """
+        part = path + '.part'
+        checksum = hashlib.sha256()
+        if os.path.exists(part):
+            # Hash the data from the earlier download once.
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    checksum.update(chunk)
+        resumes = 0
+        while True:
+            try:
+                self._download_part(repository, digest, part, checksum,
+                                    chunk_size)
+                break
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError):
+                resumes += 1
+                if resumes > MAX_RESUMES:
+                    raise
+        try:
+            verify_digest(digest, checksum)
+        except RuntimeError:
+            os.unlink(part)
+            raise
+        os.replace(part, path)
+
+    def _download_part(self, repository, digest, part, checksum,
+                       chunk_size):
+        """
+        Append the rest of a blob to a partial download file, and add the
+        new data to "checksum".
+
+        If the registry does not honor our Range request, we discard the
+        bytes that we already have from its response.
+        """
+        with open(part, 'ab') as f:
+            offset = f.tell()
+            try:
+                r = self._blob_response(repository, digest, offset)
+            except requests.exceptions.HTTPError as e:
+                if offset and e.response.status_code == 416:
+                    # We already have the whole blob.
+                    return
+                raise
+            with r:
+                skip = 0
+                if offset and r.status_code != 206:
+                    skip = offset
+                for chunk in r.iter_content(chunk_size):
+                    if skip:
+                        skipped = len(chunk[:skip])
+                        chunk = chunk[skip:]
+                        skip -= skipped
+                    if chunk:
+                        f.write(chunk)
+                        checksum.update(chunk)
+
+    def _blob_response(self, repository, digest, offset=0):
+        """
+        Start streaming a blob from "offset" to the end.
+
+        :returns: a streaming Response object. The status is 206 if the
+                  registry honored our Range request.
+        """
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        endpoint = 'blobs/%s' % digest
+        return self._get(repository, endpoint, headers, stream=True)
+
+    def config(self, repository, reference):
+        """
+        Return the config information for this image.
+
+        :param str repository: repository we want to query eg. "rhel7"
+        :param str reference: tag name in the repository, "7.5-ondeck"
+        """
+        manifest = self.manifest(repository, reference)
+        manifest_digest = manifest['config']['digest']  # "sha256:123abcd..."
+        config = self.blob(repository, manifest_digest)
+        return config
+
+    def store_token(self, realm, service, repository):
+        """
+        Get and store a JWT Bearer token for this repository.
+
+        If we have a saved username+password from podman-login, we'll
+        authenticate to the "realm" URL with that. If not, we will not perform
+        any authentication to "realm", and we'll simply obtain an anonymous
+        pull token.
+
+        :param str realm: eg. "https://registry.example.com/oauth/token"
+        :param str service: eg. "registry", or None
+        :param str repository: eg. "cp/ibm-ceph/prometheus-node-exporter"
+        """
+        return self.store_tokens(realm, service, [repository])
+
+    def store_tokens(self, realm, service, repositories):
+        """
+        Get and store one JWT Bearer token for several repositories.
+
+        :param list repositories: eg. ["rhel7", "rhel8"]
+        :returns: the token
+        """
+        params = token_params(service, repositories)
+        r = self.session.get(realm, params=params, auth=self.auth)
+        r.raise_for_status()
+        return self.save_token(repositories, r.json())
+
+    def find_realm(self):
+        """
+        Find this registry's token realm from the /v2/ base endpoint.
+
+        :returns: a (realm, service) tuple, or None if this registry does not
+                  require tokens.
+        """
+        realm = self.tokens.get_realm(self.host)
+        if realm:
+            return realm
+        r = self.session.get(self.baseurl + '/')
+        if r.status_code != 401:
+            r.raise_for_status()
+            return None
+        (realm, service) = self.find_realm_service(r)
+        self.tokens.set_realm(self.host, realm, service)
+        return (realm, service)
+
+    def prefetch_tokens(self, repositories):
+        """
+        Get tokens for many repositories with as few realm requests as
+        possible.
+
+        We request one token for all the repositories that do not already
+        have a valid token, MAX_SCOPES repositories at a time.
+
+        :param list repositories: eg. ["rhel7", "rhel8", "ubi9/ubi"]
+        """
+        batches = self.missing_tokens(repositories)
+        if not batches:
+            return
+        realm = self.find_realm()
+        if not realm:
+            return
+        for batch in batches:
+            self.store_tokens(realm[0], realm[1], batch)
+
+    def token(self, repository):
+        """
+        Return a valid JWT Bearer token for this repository.
+
+        If our cached token is missing or about to expire, and we already
+        know this registry's token realm, we get a new token up front.
+
+        :returns: a token, or None if we do not know the realm yet.
+        """
+        token = self.tokens.get(self.host, repository)
+        if token:
+            return token
+        realm = self.tokens.get_realm(self.host)
+        if realm:
+            return self.store_token(realm[0], realm[1], repository)
+        return None
+
+    @property
+    def auth(self):
+        """ Returns HTTPBasicAuth if we have a saved credential, or None. """
+        o = urlparse(self.baseurl)
+        credential = self.load_credentials(o.hostname)
+        if not credential:
+            return None
+        username, password = credential
+        return requests.auth.HTTPBasicAuth(username, password)
+
+    def _get(self, repository, endpoint, additional_headers={}, **kwargs):
         """
         Get a docker distribution API endpoint URL.
 
@@ -198,17 +579,48 @@ class Registry(object):
         :param dict additional_headers: Add these headers to the request
         :returns: Response object
         """
+        return self._request('GET', repository, endpoint, additional_headers,
+                             **kwargs)
+
+    def _head(self, repository, endpoint, additional_headers={}):
+        """
+        Send a HEAD request to a docker distribution API endpoint URL.
+
+        :returns: Response object
+        """
+        return self._request('HEAD', repository, endpoint, additional_headers)
+
+    def _request(self, method, repository, endpoint, additional_headers={},
+                 retry=True, **kwargs):
+        """
+        Send a request to a docker distribution API endpoint URL, with a
+        Bearer token if the registry requires one.
+
+        :param str method: "GET" or "HEAD"
+        :param bool retry: get a new token if the registry rejects ours.
+        :param kwargs: additional arguments for requests, eg. stream=True
+        :returns: Response object
+        """
         url = posixpath.join(self.baseurl, repository, endpoint)
-        token = self.tokens.get(repository)
+        token = self.token(repository)
         if not token:
-            r = self.session.get(url)
-            if r.status_code == 401:
-                (realm, service) = self.find_realm_service(r)
-                self.store_token(realm, service, repository)
-                return self._get(repository, endpoint, additional_headers)
+            r = self.session.request(method, url, headers=additional_headers,
+                                     **kwargs)
+            if r.status_code != 401:
+                r.raise_for_status()
+                return r
+            (realm, service) = self.find_realm_service(r)
+            self.tokens.set_realm(self.host, realm, service)
+            token = self.store_token(realm, service, repository)
         headers = {'Authorization': 'Bearer %s' % token}
         headers.update(additional_headers)
-        r = self.session.get(url, headers=headers)
+        r = self.session.request(method, url, headers=headers, **kwargs)
+        if r.status_code == 401 and retry:
+            # The registry rejected our cached (possibly multi-scope) token.
+            # Get a token for just this repository and try once more.
+            self.tokens.invalidate(self.host, repository)
+            return self._request(method, repository, endpoint,
+                                 additional_headers, retry=False, **kwargs)
         r.raise_for_status()
         return r
 
@@ -223,10 +635,118 @@ class Registry(object):
         # repository: image repository name, eg. "rhel7"
         # reference: tag name in the repository, eg. "7.5-ondeck"
         data = self.config(repository, reference)
-        labels = data['config']['Labels']
-        return Build(labels['com.redhat.component'],
-                     labels['version'],
-                     labels['release'])
+        return config_build(data)
+
+    def builds(self, images):
+        """
+        Return the Koji name-version-release information for many images.
+
+        See configs() for how we look up the images concurrently.
+
+        :param list images: image names, eg. ["rhel7:7.5-ondeck"]
+        :returns: list of bucko.build.Build classes, in the same order as
+                  "images"
+        """
+        images = list(images)
+        configs = self.configs(images)
+        return [config_build(configs[image]) for image in images]
+
+    def configs(self, images):
+        """
+        Return the config information for many images.
+
+        We look up the images concurrently (up to "pool_size" at a time),
+        with one token request for all the repositories, and we download
+        each distinct config blob only once.
+
+        :param list images: image names, eg. ["rhel7:7.5-ondeck"]
+        :returns: dict of image name to config dict
+        """
+        unique = list(dict.fromkeys(images))
+        repositories = [image.split(':', 1)[0] for image in unique]
+        self.prefetch_tokens(repositories)
+
+        def manifest(image):
+            (repository, reference) = image.split(':', 1)
+            return self.manifest(repository, reference)
+
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            manifests = dict(zip(unique, executor.map(manifest, unique)))
+            # config digest -> a repository that has this blob
+            blobs = {}
+            for image in unique:
+                digest = manifests[image]['config']['digest']
+                blobs.setdefault(digest, image.split(':', 1)[0])
+            configs = dict(zip(blobs, executor.map(self.blob, blobs.values(),
+                                                   blobs.keys())))
+        return {image: configs[manifests[image]['config']['digest']]
+                for image in unique}
+
+    def tags(self, repository, page_size=TAGS_PAGE_SIZE):
+        """
+        Yield every tag in this repository.
+
+        We request "page_size" tags at a time and follow the registry's
+        "Link" headers to the next page, so we never hold the whole list.
+
+        :param str repository: repository to query, eg "rhel7"
+        :param int page_size: number of tags per request
+        :yields: tag names (str)
+        """
+        endpoint = 'tags/list?n=%d' % page_size
+        while endpoint:
+            r = self._get(repository, endpoint)
+            for tag in r.json().get('tags') or []:
+                yield tag
+            endpoint = None
+            link = r.links.get('next')
+            if link:
+                endpoint = 'tags/list?' + urlparse(link['url']).query
+
+    def newest_tag(self, repository, pattern, page_size=TAGS_PAGE_SIZE,
+                   candidates=NEWEST_TAG_CANDIDATES):
+        """
+        Return the most recently created tag that matches a glob pattern.
+
+        Comparing the "created" times in the images' config blobs costs a
+        manifest and a config blob request per tag. With a blob cache we
+        only download each config once. To save requests, you can compare
+        only the highest "candidates" matching tags in numeric order. We log
+        the tags that we skip.
+
+        :param str repository: repository to query, eg "rhel7"
+        :param str pattern: fnmatch-style pattern, eg. "7.5-*"
+        :param int candidates: number of tags to compare, or None (the
+                               default) to compare every matching tag.
+        :returns: a tag name (str)
+        :raises: RuntimeError if no tags match the pattern.
+        """
+        tags = [tag for tag in self.tags(repository, page_size)
+                if fnmatchcase(tag, pattern)]
+        if not tags:
+            raise RuntimeError('no tags in %s match %s' % (repository,
+                                                           pattern))
+        if candidates and len(tags) > candidates:
+            tags = sorted(tags, key=tag_sort_key, reverse=True)
+            log.info('%s: not comparing the creation times of %s'
+                     % (repository, ', '.join(tags[candidates:])))
+            tags = tags[:candidates]
+        images = ['%s:%s' % (repository, tag) for tag in tags]
+        configs = self.configs(images)
+        newest = max(images, key=lambda image: created(configs[image]))
+        return newest.split(':', 1)[1]
+
+    def resolve_image(self, image):
+        """
+        Resolve a glob pattern in an image's tag to the newest matching tag.
+
+        :param str image: image name, eg. "rhel7:7.5-*" or "rhel7:7.5-ondeck"
+        :returns: image name with a concrete tag, eg. "rhel7:7.5-20240101"
+        """
+        (repository, reference) = image.split(':', 1)
+        if not any(char in reference for char in '*?['):
+            return image
+        return '%s:%s' % (repository, self.newest_tag(repository, reference))
 
     def signatures(self, image):
         """
@@ -241,42 +761,29 @@ class Registry(object):
         :returns: list of signatures for this image's manifest sha256 digest.
                   Note that one manifest digest can have multiple tags.
         """
-        # Lots of duplicated code here...
         (repository, reference) = image.split(':', 1)
-        manifests = self.manifest(repository, reference, manifest_list=True)
-        for manifest in manifests['manifests']:
-            platform = manifest['platform']
-            # hard-coding so we only return signatures for one arch...
-            if platform['architecture'] != 'amd64':
-                continue
-            digest = manifest['digest']
+        # hard-coding so we only return signatures for one arch...
+        digest = self.digest(repository, reference, platform='amd64')
+        return self.digest_signatures(repository, digest)
+
+    def digest_signatures(self, repository, digest):
+        """
+        Return the GPG signature data for this manifest digest.
 
+        :param str repository: eg. "cp/ibm-ceph/ceph-5-rhel8"
+        :param str digest: eg. "sha256:123abcd..."
+        :returns: list of signatures (bytes)
+        """
         signatures = []
-        if self.lookaside:
-            # Use that URL + /signature-1, 2, 3, etc. until you hit a 404.
-            # The resulting data is the gpg-signed JSON blob.
-            template = posixpath.join(
-                self.lookaside,
-                repository + '@' + digest.replace(':', '='),
-                'signature-{index}'
-            )
-            index = 1
-            MAX_SIGNATURES = 25  # sanity circuit breaker
-            while index < MAX_SIGNATURES:
-                url = template.format(index=index)
-                response = self.session.get(url)
-                if response.ok:
-                    signatures.append(response.content)
-                    index += 1
-                else:
-                    break
+        lookaside = self.lookaside
+        if lookaside:
+            return self.lookaside_signatures(lookaside, repository, digest)
         else:
             # No /etc/containers/registries.d for this host.
             # Query the default "extensions" URL on this registry.
-            token = self.tokens[repository]
+            token = self.token(repository)
             headers = {'Authorization': 'Bearer %s' % token}
-            baseurl = self.baseurl.replace('/v2', '/extensions/v2')
-            url = posixpath.join(baseurl, repository, 'signatures', digest)
+            url = self.extensions_url(repository, digest)
             r = self.session.get(url, headers=headers)
             if r.status_code == 404:
                 return []
@@ -288,27 +795,46 @@ class Registry(object):
                 signatures.append(signature)
         return signatures
 
-    def signature_payloads(self, image):
+    def lookaside_signatures(self, lookaside, repository, digest):
+        """
+        Return the GPG signature blobs for this digest from a lookaside URL.
+
+        Signatures live at that URL + /signature-1, 2, 3, etc. until you hit
+        a 404. Rather than probing one URL at a time, we request
+        SIGNATURE_WINDOW URLs at once, and stop at the first missing one.
+
+        :param str lookaside: lookaside URL, eg.
+                              "https://registry.redhat.io/containers/sigstore/"
+        :returns: list of gpg-signed JSON blobs (bytes)
+        """
+        template = self.signature_template(lookaside, repository, digest)
+
+        def fetch(index):
+            return self.session.get(template.format(index=index))
+
+        signatures = []
+        with ThreadPoolExecutor(max_workers=SIGNATURE_WINDOW) as executor:
+            for start in range(1, MAX_SIGNATURES, SIGNATURE_WINDOW):
+                stop = min(start + SIGNATURE_WINDOW, MAX_SIGNATURES)
+                for response in executor.map(fetch, range(start, stop)):
+                    if not response.ok:
+                        return signatures
+                    signatures.append(response.content)
+        return signatures
+
+    def signature_payloads(self, image, verify=False):
         """
         Return the JSON document payloads that GPG has signed.
 
-        Ignores GPG signature validity and simply returns the data.
+        By default, ignores GPG signature validity and simply returns the
+        data.
 
+        :param bool verify: check every signature with one gpg process, and
+                            raise RuntimeError if any signature is not good.
         :returns: list of dicts, one per signature/ref
         """
-        # Pipe each binary file thru /usr/bin/gpg to read the contents
-        # on STDOUT and view the signature info on STDERR
-        # Or, run gpg --verify /tmp/myfile to only verify the signature.
-        payloads = []
-        from subprocess import Popen, PIPE
         signatures = self.signatures(image)
-        for signature in signatures:
-            p = Popen(['gpg'], stdout=PIPE, stdin=PIPE, stderr=PIPE)
-            stdout_data = p.communicate(input=signature)[0]
-            string = stdout_data.decode()
-            payload = json.loads(string)
-            payloads.append(payload)
-        return payloads
+        return decode_signatures(image, signatures, verify)
 
     def signature_references(self, image):
         """
@@ -323,6 +849,63 @@ class Registry(object):
         return [s['critical']['identity']['docker-reference']
                 for s in signatures]
 
+    def platform_digests(self, repository, reference):
+        """
+        Return the manifest digest for each platform of this image.
+
+        :param str repository: repository to query, eg "rhel7"
+        :param str reference: tag name in the repository, "7.5-ondeck"
+        :returns: dict of platform name (eg. "amd64" or "arm64/v8") to
+                  manifest digest, in manifest list order.
+        """
+        endpoint = 'manifests/%s' % reference
+        headers = {'Accept': '%s, %s' % (MANIFEST_LIST, MANIFEST_V2)}
+        r = self._get(repository, endpoint, headers)
+        data = r.json()
+        if data.get('mediaType') != MANIFEST_LIST:
+            # Single-arch image: the config blob knows the architecture.
+            config = self.blob(repository, data['config']['digest'])
+            digest = r.headers.get('Docker-Content-Digest')
+            if not digest:
+                digest = 'sha256:' + hashlib.sha256(r.content).hexdigest()
+            return {config['architecture']: digest}
+        digests = {}
+        for manifest in data['manifests']:
+            platform = manifest['platform']
+            name = platform['architecture']
+            if platform.get('variant'):
+                name += '/' + platform['variant']
+            digests[name] = manifest['digest']
+        return digests
+
+    def signature_audit(self, image, verify=False):
+        """
+        Return the signed docker refs (tags) for every platform of this image.
+
+        We read the manifest list once, and then fetch and decode each
+        platform's signatures concurrently.
+
+        :param str image: image name, eg. "cp/ibm-ceph/ceph-5-rhel8:latest"
+        :param bool verify: check every signature with gpg, and raise
+                            RuntimeError if any signature is not good.
+        :returns: dict of platform name (eg. "ppc64le") to a list of signed
+                  docker refs (str)
+        """
+        (repository, reference) = image.split(':', 1)
+        digests = self.platform_digests(repository, reference)
+
+        def references(platform):
+            digest = digests[platform]
+            signatures = self.digest_signatures(repository, digest)
+            name = '%s@%s (%s)' % (repository, digest, platform)
+            payloads = decode_signatures(name, signatures, verify)
+            return [s['critical']['identity']['docker-reference']
+                    for s in payloads]
+
+        with ThreadPoolExecutor(max_workers=len(digests) or 1) as executor:
+            results = executor.map(references, digests)
+            return dict(zip(digests, results))
+
     def manifest(self, repository, reference, manifest_list=False):
         """
         Get the manifest information about this image.
@@ -332,9 +915,81 @@ class Registry(object):
         :param bool manifest_list: return the "fat manifests", see
                                    https://docs.docker.com/registry/spec/manifest-v2-2/
         """
-        endpoint = 'manifests/%s' % reference
         additional_headers = {}
         if manifest_list:
-            additional_headers['Accept'] = 'application/vnd.docker.distribution.manifest.list.v2+json'
+            additional_headers['Accept'] = MANIFEST_LIST
+        if self.blobs:
+            return self.cached_manifest(repository, reference,
+                                        additional_headers)
+        endpoint = 'manifests/%s' % reference
         r = self._get(repository, endpoint, additional_headers)
         return r.json()
+
+    def cached_manifest(self, repository, reference, additional_headers):
+        """
+        Get a manifest from our blob cache if possible.
+
+        A digest reference never changes, so we can always use our cached
+        copy. For a tag, we ask the registry which digest the tag points to
+        with a HEAD request, and then we use our copy of that digest.
+        """
+        digest = reference
+        if not reference.startswith('sha256:'):
+            digest = self._head_digest(repository, reference,
+                                       additional_headers)
+            if not digest:
+                endpoint = 'manifests/%s' % reference
+                r = self._get(repository, endpoint, additional_headers)
+                return r.json()
+        data = self.blobs.get(digest)
+        if data is not None:
+            return json.loads(data)
+        endpoint = 'manifests/%s' % digest
+        r = self._get(repository, endpoint, additional_headers)
+        self.blobs.set(digest, r.content)
+        return r.json()
+
+    def digest(self, repository, reference, platform=None):
+        """
+        Return the manifest digest that this reference points to.
+
+        Without a platform, this costs one HEAD request. With a platform, we
+        must GET the manifest list to find that platform's manifest.
+
+        :param str repository: repository to query, eg "rhel7"
+        :param str reference: tag name in the repository, "7.5-ondeck"
+        :param str platform: architecture, eg. "amd64", or
+                             "os/architecture[/variant]", eg.
+                             "linux/arm64/v8". If the reference is a
+                             single-arch manifest, we return its digest.
+        :returns: a digest str, eg. "sha256:123abcd..."
+        :raises: RuntimeError if the manifest list lacks this platform.
+        """
+        headers = {'Accept': '%s, %s' % (MANIFEST_LIST, MANIFEST_V2)}
+        if not platform:
+            digest = self._head_digest(repository, reference, headers)
+            if digest:
+                return digest
+        endpoint = 'manifests/%s' % reference
+        r = self._get(repository, endpoint, headers)
+        data = r.json()
+        if platform and data.get('mediaType') == MANIFEST_LIST:
+            for manifest in data['manifests']:
+                if platform_matches(manifest['platform'], platform):
+                    return manifest['digest']
+            raise RuntimeError('%s:%s has no %s manifest'
+                               % (repository, reference, platform))
+        digest = r.headers.get('Docker-Content-Digest')
+        if digest:
+            return digest
+        return 'sha256:' + hashlib.sha256(r.content).hexdigest()
+
+    def _head_digest(self, repository, reference, additional_headers):
+        """
+        Ask the registry for a manifest's digest with a HEAD request.
+
+        :returns: a digest str, or None if the registry did not tell us.
+        """
+        endpoint = 'manifests/%s' % reference
+        r = self._head(repository, endpoint, additional_headers)
+        return r.headers.get('Docker-Content-Digest')
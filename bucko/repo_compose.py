@@ -1,7 +1,13 @@
+import io
 import os
 import posixpath
 import tempfile
 import productmd.compose
+import productmd.composeinfo
+import productmd.images
+import productmd.modules
+import productmd.rpms
+from bucko import transport
 try:
     from configparser import RawConfigParser
 except ImportError:
@@ -17,11 +23,33 @@ GPG_KEYS = {
 }
 
 
+# Compose metadata files, in productmd's order of preference.
+COMPOSEINFO_PATHS = ['metadata/composeinfo.json']
+IMAGES_PATHS = ['metadata/images.json', 'metadata/image-manifest.json']
+RPMS_PATHS = ['metadata/rpms.json', 'metadata/rpm-manifest.json']
+MODULES_PATHS = ['metadata/modules.json']
+
+
 class RepoCompose(productmd.compose.Compose):
-    """ An online compose for which we will write a yum .repo file. """
+    """
+    An online compose for which we will write a yum .repo file.
+
+    We download HTTP(S) compose metadata with bucko.transport, so these
+    requests get its retries and timing hooks. productmd only reads local
+    composes for us.
+
+    :param session: requests.Session for HTTP(S) composes. By default we
+                    create one with bucko.transport.session().
+    """
 
-    def __init__(self, path, keys={}):
-        super(RepoCompose, self).__init__(path)
+    def __init__(self, path, keys={}, session=None):
+        self.session = None
+        if transport.http_url(path):
+            self.session = session or transport.session()
+            self.compose_path = self.find_compose_path(path)
+            self.metadata = {}
+        else:
+            super(RepoCompose, self).__init__(path)
         # Sanity-check that this is a layered product compose.
         if not self.info.release.is_layered:
             raise RuntimeError('%s must be layered' % self.info.release.short)
@@ -29,6 +57,72 @@ class RepoCompose(productmd.compose.Compose):
         self.keys = GPG_KEYS.copy()
         self.keys.update(keys)
 
+    def find_compose_path(self, url):
+        """
+        Return the URL of this compose's metadata directory's parent.
+
+        Like productmd, we prefer the "compose" subdirectory.
+        """
+        path = posixpath.join(url, 'compose')
+        metadata = posixpath.join(path, COMPOSEINFO_PATHS[0])
+        r = self.session.head(metadata, allow_redirects=True)
+        if r.status_code == 200:
+            return path
+        return url
+
+    def download_metadata(self, paths, cls):
+        """
+        Download and parse the first of these metadata files that exists.
+
+        :param list paths: paths relative to self.compose_path
+        :param cls: productmd metadata class, eg. productmd.rpms.Rpms
+        :returns: an instance of "cls"
+        """
+        if cls in self.metadata:
+            return self.metadata[cls]
+        for path in paths:
+            url = posixpath.join(self.compose_path, path)
+            r = self.session.get(url)
+            if r.status_code == 404:
+                continue
+            r.raise_for_status()
+            obj = cls()
+            try:
+                obj.load(io.StringIO(r.text))
+            except ValueError as exc:
+                raise RuntimeError('%s can not be deserialized: %s.'
+                                   % (url, exc))
+            self.metadata[cls] = obj
+            return obj
+        raise RuntimeError('Failed to load metadata from %s'
+                           % self.compose_path)
+
+    @property
+    def info(self):
+        if not self.session:
+            return super(RepoCompose, self).info
+        return self.download_metadata(COMPOSEINFO_PATHS,
+                                      productmd.composeinfo.ComposeInfo)
+
+    @property
+    def images(self):
+        if not self.session:
+            return super(RepoCompose, self).images
+        return self.download_metadata(IMAGES_PATHS, productmd.images.Images)
+
+    @property
+    def rpms(self):
+        if not self.session:
+            return super(RepoCompose, self).rpms
+        return self.download_metadata(RPMS_PATHS, productmd.rpms.Rpms)
+
+    @property
+    def modules(self):
+        if not self.session:
+            return super(RepoCompose, self).modules
+        return self.download_metadata(MODULES_PATHS,
+                                      productmd.modules.Modules)
+
     def get_variant_url(self, v, arch):
         return posixpath.join(self.compose_path, v.paths.repository[arch])
 
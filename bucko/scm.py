@@ -0,0 +1,67 @@
+import re
+import subprocess
+from bucko import trace
+from bucko.log import log
+
+"""
+Resolve dist-git SCM URLs to exact commits.
+"""
+
+# Seconds to wait for "git ls-remote".
+LS_REMOTE_TIMEOUT = 60
+
+
+def remote_ref(ref):
+    """
+    Return the full remote ref name for a Koji SCM ref.
+
+    :param str ref: eg. "origin/ceph-8.0-rhel-9" or "ceph-8.0-rhel-9"
+    :returns: eg. "refs/heads/ceph-8.0-rhel-9"
+    """
+    if ref.startswith('refs/'):
+        return ref
+    if ref.startswith('origin/'):
+        ref = ref[len('origin/'):]
+    return 'refs/heads/%s' % ref
+
+
+def ls_remote(url, ref):
+    """
+    Return the commit that a remote ref points to, or None.
+
+    :param str url: git URL, eg. "git://example.com/containers/rhceph"
+    :param str ref: full ref name, eg. "refs/heads/ceph-8.0-rhel-9"
+    """
+    cmd = ('git', 'ls-remote', url, ref)
+    log.info('+ ' + ' '.join(cmd))
+    with trace.span('git ls-remote', 'cmd'):
+        output = subprocess.check_output(cmd, timeout=LS_REMOTE_TIMEOUT)
+    for line in output.decode('utf-8').splitlines():
+        commit, _, name = line.partition('\t')
+        if name == ref:
+            return commit
+    return None
+
+
+def resolve(scm):
+    """
+    Return this Koji SCM URL with its ref replaced by a commit.
+
+    :param str scm: eg. "git://example.com/containers/rhceph#origin/ceph-8"
+    :returns: eg. "git://example.com/containers/rhceph#1a2b3c...", or None
+              if we cannot find the commit.
+    """
+    url, _, ref = scm.partition('#')
+    if not ref:
+        return None
+    if re.match(r'^[0-9a-f]{40}$', ref):
+        return scm
+    try:
+        commit = ls_remote(url, remote_ref(ref))
+    except (OSError, subprocess.SubprocessError) as e:
+        log.warning('could not resolve %s: %s' % (scm, e))
+        return None
+    if not commit:
+        log.warning('%s has no %s ref' % (url, ref))
+        return None
+    return '%s#%s' % (url, commit)
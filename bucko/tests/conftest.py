@@ -0,0 +1,57 @@
+import pytest
+from bucko import blob_cache
+from bucko import cache
+from bucko import koji_builder
+from bucko import tokens
+from bucko import trace
+from bucko import transport
+
+
+@pytest.fixture(autouse=True)
+def cache_home(monkeypatch, tmpdir):
+    """ Keep bucko's on-disk caches out of the real home directory. """
+    path = tmpdir.join('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def parsed_files(monkeypatch):
+    """ Forget any configuration files that earlier tests parsed. """
+    monkeypatch.setattr(cache, '_files', {})
+
+
+@pytest.fixture(autouse=True)
+def blob_caches(monkeypatch):
+    """ Give each test fresh process-wide registry blob caches. """
+    monkeypatch.setattr(blob_cache, '_blob_caches', {})
+
+
+@pytest.fixture(autouse=True)
+def koji_sessions(monkeypatch):
+    """ Give each test a fresh process-wide Koji session registry. """
+    monkeypatch.setattr(koji_builder, '_sessions', {})
+    monkeypatch.setattr(koji_builder, '_metadata_caches', {})
+    monkeypatch.setattr(koji_builder, '_session_locks', {})
+    monkeypatch.setattr(koji_builder, '_persistent_sessions', set())
+    yield
+    for f in koji_builder._session_locks.values():
+        f.close()
+
+
+@pytest.fixture(autouse=True)
+def token_caches(monkeypatch):
+    """ Give each test fresh process-wide registry token caches. """
+    monkeypatch.setattr(tokens, '_token_caches', {})
+
+
+@pytest.fixture(autouse=True)
+def transport_hooks(monkeypatch):
+    """ Forget any HTTP timing hooks that earlier tests added. """
+    monkeypatch.setattr(transport, '_hooks', [])
+
+
+@pytest.fixture(autouse=True)
+def trace_spans(monkeypatch):
+    """ Forget any trace spans that earlier tests recorded. """
+    monkeypatch.setattr(trace, '_spans', [])
@@ -0,0 +1,301 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from xmlrpc.client import Fault
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+import koji
+
+"""
+A tiny stand-in for a Koji hub's XML-RPC API.
+
+FakeHub serves just enough of the hub API for bucko's build pipeline, and it
+records every HTTP round trip per "stage" so that we can measure how many hub
+calls each part of bucko makes.
+
+Run it on localhost with "python -m bucko.tests.fakehub".
+"""
+
+# Koji's GenericError fault code
+GENERIC_ERROR = 1000
+
+# Hub calls that record the session's call number
+WRITE_METHODS = {'buildContainer', 'untagBuild'}
+
+
+class Handler(SimpleXMLRPCRequestHandler):
+    # Koji's ClientSession may add session parameters to the URL.
+    rpc_paths = ()
+
+    def _dispatch(self, method, params):
+        # Koji sends the session's call number in a header.
+        return self.server.instance._dispatch(method, params, self.headers)
+
+
+class FakeHub(object):
+    """
+    Fake Koji hub with scripted buildContainer task lifecycles.
+
+    :param float latency: simulated seconds for each HTTP round trip.
+    :param int polls: number of getTaskInfo calls that see a new task as
+                      "OPEN" before it is "CLOSED".
+    :param bool sleep: really sleep for "latency" seconds per round trip.
+    :param list arches: build tag arches for every build target.
+    """
+
+    def __init__(self, latency=0.3, polls=3, sleep=False,
+                 arches=('x86_64', 'ppc64le', 's390x', 'aarch64')):
+        self.latency = latency
+        self.polls = polls
+        self.sleep = sleep
+        self.arches = ' '.join(arches)
+        self.stats = OrderedDict()
+        self.current_stage = 'setup'
+        self.tasks = {}
+        self.tags = {}  # build ID -> list of tag names
+        self.history = []  # (event ID, tag name) for each tag/untag
+        self.event = 1000
+        self.callnums = {}  # session ID -> last call number of a write
+        self.server = None
+        self.lock = threading.Lock()
+
+    # Server lifecycle
+
+    def start(self):
+        """ Serve XML-RPC on a random localhost port in a thread. """
+        self.server = SimpleXMLRPCServer(('127.0.0.1', 0),
+                                         requestHandler=Handler,
+                                         allow_none=True,
+                                         logRequests=False)
+        self.server.register_instance(self)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://%s:%d/kojihub' % (host, port)
+
+    def session(self, profile='fakehub'):
+        """ Return a real koji.ClientSession for this hub. """
+        opts = {'server': self.url,
+                'weburl': 'http://localhost/koji',
+                'authtype': 'password',
+                'user': 'bucko',
+                'password': 'bucko',
+                'cert': '',
+                'serverca': None,
+                'no_ssl_verify': True,
+                'timeout': 10,
+                'retry_interval': 0,
+                'max_retries': 0}
+        return koji.ClientSession(self.url, opts)
+
+    # Statistics
+
+    @contextmanager
+    def stage(self, name):
+        """ Attribute all the round trips within this block to "name". """
+        previous = self.current_stage
+        self.current_stage = name
+        try:
+            yield
+        finally:
+            self.current_stage = previous
+
+    def record(self, methods):
+        stage = self.stats.setdefault(self.current_stage,
+                                      {'round_trips': 0, 'calls': Counter()})
+        stage['round_trips'] += 1
+        stage['calls'].update(methods)
+        if self.sleep:
+            time.sleep(self.latency)
+
+    def round_trips(self, stage=None):
+        """ Return the number of round trips for one stage, or all stages. """
+        if stage:
+            return self.stats.get(stage, {'round_trips': 0})['round_trips']
+        return sum(s['round_trips'] for s in self.stats.values())
+
+    def report(self):
+        """ Return a text table of round trips and simulated time. """
+        lines = ['%-24s %11s %6s %9s' % ('stage', 'round trips', 'calls',
+                                         'sim time')]
+        for name, stage in self.stats.items():
+            round_trips = stage['round_trips']
+            calls = sum(stage['calls'].values())
+            simulated = round_trips * self.latency
+            lines.append('%-24s %11d %6d %8.1fs' % (name, round_trips, calls,
+                                                    simulated))
+        total = self.round_trips()
+        lines.append('%-24s %11d %6s %8.1fs' % ('total', total, '',
+                                                total * self.latency))
+        return '\n'.join(lines)
+
+    # XML-RPC dispatching
+
+    def _dispatch(self, method, params, headers=None):
+        with self.lock:
+            if method == 'multiCall':
+                methods = [call['methodName'] for call in params[0]]
+            else:
+                methods = [method]
+            self.record(methods)
+            self.check_callnum(headers or {}, methods)
+            if method == 'multiCall':
+                return [self._multicall_entry(call) for call in params[0]]
+            return self._call(method, params)
+
+    def check_callnum(self, headers, methods):
+        """
+        Like Koji's hub, reject old call numbers for a session.
+
+        The hub remembers the call number of each session's last write call,
+        and it raises SequenceError for any call that is not newer.
+        """
+        session_id = headers.get('Koji-Session-Id')
+        callnum = headers.get('Koji-Session-Callnum')
+        if session_id is None or callnum is None:
+            return
+        callnum = int(callnum)
+        last = self.callnums.get(session_id)
+        if last is not None and callnum <= last:
+            raise Fault(koji.SequenceError.faultCode,
+                        'session %s: callnum %d is not after %d'
+                        % (session_id, callnum, last))
+        if WRITE_METHODS.intersection(methods):
+            self.callnums[session_id] = callnum
+
+    def _multicall_entry(self, call):
+        try:
+            return [self._call(call['methodName'], call['params'])]
+        except Fault as e:
+            return {'faultCode': e.faultCode, 'faultString': e.faultString}
+
+    def _call(self, method, params):
+        args = list(params)
+        kwargs = {}
+        if args and isinstance(args[-1], dict) and args[-1].get('__starstar'):
+            kwargs = args.pop()
+            del kwargs['__starstar']
+        func = getattr(self, 'rpc_%s' % method, None)
+        if func is None:
+            raise Fault(GENERIC_ERROR, 'Invalid method: %s' % method)
+        return func(*args, **kwargs)
+
+    def new_event(self, tag):
+        """ Record a tag or untag operation. """
+        self.event += 1
+        self.history.append((self.event, tag))
+
+    # Hub API methods
+
+    def rpc_getAPIVersion(self):
+        return koji.API_VERSION
+
+    def rpc_getKojiVersion(self):
+        return '1.36.0'
+
+    def rpc_login(self, user, password, **kwargs):
+        return {'session-id': 1, 'session-key': '1-abc', 'header-auth': True}
+
+    def rpc_getLoggedInUser(self):
+        return {'id': 1, 'name': 'bucko'}
+
+    def rpc_getLastEvent(self, before=None):
+        return {'id': self.event, 'ts': 1700000000.0}
+
+    def rpc_getFullInheritance(self, tag, event=None, reverse=False):
+        return []
+
+    def rpc_queryHistory(self, tables=None, tag=None, afterEvent=None,
+                         **kwargs):
+        changes = [{'create_event': event, 'tag.name': name}
+                   for event, name in self.history
+                   if name == tag and event > (afterEvent or 0)]
+        return {'tag_listing': changes, 'tag_inheritance': []}
+
+    def rpc_getBuildTarget(self, target, event=None, strict=False):
+        return {'id': 1,
+                'name': target,
+                'build_tag': 100,
+                'build_tag_name': target.replace('-candidate', '-build'),
+                'dest_tag': 101,
+                'dest_tag_name': target}
+
+    def rpc_getTag(self, tag, strict=False, event=None, blocked=False):
+        return {'id': 100, 'name': tag, 'arches': self.arches}
+
+    def rpc_buildContainer(self, src, target, opts, priority=None,
+                           channel='container'):
+        task_id = 2000 + len(self.tasks)
+        build_id = 3000 + len(self.tasks)
+        self.tasks[task_id] = {
+            'polls': 0,
+            'request': [src, target, opts],
+            'result': {
+                'koji_builds': [str(build_id)],
+                'repositories': [
+                    'registry.example.com/ceph:latest',
+                    'registry.example.com/ceph:%s-%d' % (target, task_id),
+                ],
+            },
+        }
+        if not opts.get('scratch'):
+            self.tags[build_id] = [target]
+            self.new_event(target)
+        return task_id
+
+    def rpc_getTaskInfo(self, task_id, request=False, strict=False):
+        task = self.tasks.get(task_id)
+        if task is None:
+            return None
+        task['polls'] += 1
+        if task['polls'] <= self.polls:
+            state = koji.TASK_STATES['OPEN']
+        else:
+            state = koji.TASK_STATES['CLOSED']
+        info = {'id': task_id,
+                'state': state,
+                'method': 'buildContainer',
+                'arch': 'noarch',
+                'host_id': None}
+        if request:
+            info['request'] = task['request']
+        return info
+
+    def rpc_getTaskChildren(self, task_id, request=False, strict=False):
+        return []
+
+    def rpc_getTaskResult(self, task_id, raise_fault=True):
+        return self.tasks[task_id]['result']
+
+    def rpc_listTags(self, build=None, package=None, perms=True,
+                     queryOpts=None, pattern=None):
+        return [{'name': name} for name in self.tags.get(build, [])]
+
+    def rpc_untagBuild(self, tag, build, strict=True, force=False):
+        tags = self.tags.get(build, [])
+        if tag in tags:
+            tags.remove(tag)
+            self.new_event(tag)
+        elif strict:
+            raise Fault(GENERIC_ERROR, 'build %s not in tag %s' % (build, tag))
+
+
+if __name__ == '__main__':
+    hub = FakeHub(sleep=True)
+    hub.start()
+    print('Fake Koji hub at %s (ctrl-c to exit)' % hub.url)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print('')
+        print(hub.report())
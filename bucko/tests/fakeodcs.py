@@ -0,0 +1,113 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from bucko.tests.httpserver import ThreadingHTTPServer
+
+"""
+A tiny stand-in for the ODCS REST API (api/1/composes/).
+
+Each new compose spends "queue_polls" GET requests in the "wait" state and
+"generate_polls" GET requests in the "generating" state, and then moves to
+"final_state".
+"""
+
+
+class FakeOdcs(object):
+    def __init__(self, queue_polls=1, generate_polls=1, final_state='done'):
+        self.queue_polls = queue_polls
+        self.generate_polls = generate_polls
+        self.final_state = final_state
+        self.composes = {}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        """ Serve HTTP on a random localhost port in a thread. """
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                match = re.match(r'^/api/1/composes/(\d+)$', self.path)
+                if not match:
+                    return self.send_json(404, {'error': 'Not Found'})
+                compose = hub.get(int(match.group(1)))
+                if compose is None:
+                    return self.send_json(404, {'error': 'No such compose'})
+                self.send_json(200, compose)
+
+            def do_POST(self):
+                if self.path != '/api/1/composes/':
+                    return self.send_json(404, {'error': 'Not Found'})
+                length = int(self.headers['Content-Length'])
+                data = json.loads(self.rfile.read(length).decode('utf-8'))
+                self.send_json(200, hub.create(data))
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://%s:%d/' % (host, port)
+
+    def create(self, data):
+        with self.lock:
+            self.requests['POST'] += 1
+            compose_id = len(self.composes) + 1
+            toplevel_url = '%scomposes/odcs-%d' % (self.url, compose_id)
+            self.composes[compose_id] = {
+                'id': compose_id,
+                'source': data['source']['source'],
+                'arches': ' '.join(data.get('arches', [])),
+                'state_name': 'wait',
+                'time_to_expire': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                time.gmtime(time.time() +
+                                                            24 * 60 * 60)),
+                'polls': 0,
+                'toplevel_url': toplevel_url,
+                'result_repofile': '%s/odcs-%d.repo' % (toplevel_url,
+                                                        compose_id),
+            }
+            return self.public(compose_id)
+
+    def get(self, compose_id):
+        with self.lock:
+            self.requests['GET'] += 1
+            compose = self.composes.get(compose_id)
+            if compose is None:
+                return None
+            compose['polls'] += 1
+            if compose['polls'] <= self.queue_polls:
+                compose['state_name'] = 'wait'
+            elif compose['polls'] <= self.queue_polls + self.generate_polls:
+                compose['state_name'] = 'generating'
+            else:
+                compose['state_name'] = self.final_state
+            return self.public(compose_id)
+
+    def public(self, compose_id):
+        compose = dict(self.composes[compose_id])
+        del compose['polls']
+        return compose
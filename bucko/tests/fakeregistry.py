@@ -0,0 +1,363 @@
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+from bucko.tests.httpserver import ThreadingHTTPServer
+
+"""
+A tiny stand-in for a Docker Distribution (v2) registry.
+
+FakeRegistry serves a token realm, manifests, manifest lists, blobs, tag
+lists, lookaside signatures and "extensions/v2" signatures. Like FakeHub, it
+records every request per "stage" so that we can measure how many requests
+each Registry operation makes.
+
+Run it on localhost with "python -m bucko.tests.fakeregistry".
+"""
+
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+
+# Host name in the signed docker references
+SIGNED_HOST = 'registry.example.com'
+
+
+def digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def signed_message(payload):
+    """
+    Return an OpenPGP message with this payload in a literal data packet.
+
+    The signature packets are bogus, so gpg will not verify this message.
+    """
+    def packet(tag, body):
+        # Old format packet, two-octet length
+        return bytes([0x80 | (tag << 2) | 1]) + len(body).to_bytes(2, 'big') \
+            + body
+    literal = b'b\0\0\0\0\0' + payload
+    inner = (packet(4, b'one-pass signature') + packet(11, literal) +
+             packet(2, b'signature'))
+    return packet(8, bytes([2]) + zlib.compress(inner))
+
+
+class FakeRegistry(object):
+    """
+    Fake token-protected container registry.
+
+    :param float latency: seconds to sleep for each request.
+    :param int page_size: maximum tags per tags/list page.
+    """
+
+    def __init__(self, latency=0.0, page_size=100):
+        self.latency = latency
+        self.page_size = page_size
+        self.manifests = {}  # (repository, reference) -> (type, bytes)
+        self.blobs = {}  # (repository, digest) -> bytes
+        self.tags = {}  # repository -> list of tags
+        self.signatures = {}  # manifest digest -> list of messages
+        self.stats = OrderedDict()
+        self.current_stage = 'setup'
+        self.issued = 0
+        self.server = None
+        self.lock = threading.Lock()
+
+    # Server lifecycle
+
+    def start(self):
+        """ Serve HTTP on a random localhost port in a thread. """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                registry.handle(self)
+
+            def do_HEAD(self):
+                registry.handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://%s:%d' % (host, port)
+
+    @property
+    def lookaside(self):
+        return self.url + '/sigstore'
+
+    # Content
+
+    def add_image(self, repository, tag, version='1', release='1',
+                  arches=('amd64', 'ppc64le', 's390x', 'arm64'),
+                  signatures=1):
+        """
+        Add a multi-arch image, with signatures for each arch.
+
+        :returns: the manifest list digest
+        """
+        entries = []
+        for arch in arches:
+            config = json.dumps({
+                'architecture': arch,
+                'created': '2024-01-01T00:00:00Z',
+                'config': {'Labels': {
+                    'com.redhat.component': repository.split('/')[-1],
+                    'version': version,
+                    'release': release}},
+            }, sort_keys=True).encode()
+            self.blobs[(repository, digest(config))] = config
+            manifest = json.dumps({
+                'schemaVersion': 2,
+                'mediaType': MANIFEST_V2,
+                'config': {'mediaType': 'application/json',
+                           'size': len(config),
+                           'digest': digest(config)},
+                'layers': [],
+            }, sort_keys=True).encode()
+            self.manifests[(repository, digest(manifest))] = (MANIFEST_V2,
+                                                              manifest)
+            reference = '%s/%s:%s' % (SIGNED_HOST, repository, tag)
+            self.signatures[digest(manifest)] = [
+                signed_message(json.dumps({'critical': {
+                    'identity': {'docker-reference': reference},
+                    'image': {'docker-manifest-digest': digest(manifest)},
+                    'type': 'atomic container signature'}}).encode())
+                for _ in range(signatures)]
+            entries.append({'mediaType': MANIFEST_V2,
+                            'size': len(manifest),
+                            'digest': digest(manifest),
+                            'platform': {'architecture': arch,
+                                         'os': 'linux'}})
+        manifest_list = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_LIST,
+            'manifests': entries,
+        }, sort_keys=True).encode()
+        self.manifests[(repository, tag)] = (MANIFEST_LIST, manifest_list)
+        self.manifests[(repository, digest(manifest_list))] = (
+            MANIFEST_LIST, manifest_list)
+        tags = self.tags.setdefault(repository, [])
+        if tag not in tags:
+            tags.append(tag)
+        return digest(manifest_list)
+
+    # Statistics
+
+    @contextmanager
+    def stage(self, name):
+        """ Attribute all the requests within this block to "name". """
+        previous = self.current_stage
+        self.current_stage = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.current_stage = previous
+            stage = self.stage_stats(name)
+            stage['wall time'] += time.time() - start
+
+    def stage_stats(self, name):
+        return self.stats.setdefault(name, {'requests': 0,
+                                            'wall time': 0.0,
+                                            'kinds': Counter()})
+
+    def record(self, kind):
+        with self.lock:
+            stage = self.stage_stats(self.current_stage)
+            stage['requests'] += 1
+            stage['kinds'][kind] += 1
+
+    def requests(self, stage=None, kind=None):
+        """ Return the number of requests for one stage, or all stages. """
+        stages = self.stats.values()
+        if stage:
+            stages = [self.stats.get(stage, self.stage_stats(stage))]
+        if kind:
+            return sum(s['kinds'][kind] for s in stages)
+        return sum(s['requests'] for s in stages)
+
+    def report(self):
+        """ Return a text table of requests and wall time per stage. """
+        lines = ['%-28s %8s %9s' % ('stage', 'requests', 'wall time')]
+        for name, stage in self.stats.items():
+            if name == 'setup':
+                continue
+            lines.append('%-28s %8d %8.3fs' % (name, stage['requests'],
+                                               stage['wall time']))
+        return '\n'.join(lines)
+
+    # HTTP handling
+
+    def handle(self, handler):
+        if self.latency:
+            time.sleep(self.latency)
+        parsed = urlparse(handler.path)
+        path = parsed.path
+        query = parse_qs(parsed.query)
+        if path == '/v2/auth':
+            self.record('token')
+            return self.token(handler, query)
+        if path.startswith('/sigstore/'):
+            self.record('lookaside')
+            return self.lookaside_signature(handler, path)
+        authorized = handler.headers.get('Authorization', '').startswith(
+            'Bearer token-')
+        match = re.match(r'^/extensions/v2/(.+)/signatures/(.+)$', path)
+        if match:
+            self.record('extensions')
+            if not authorized:
+                return self.challenge(handler)
+            return self.extension_signatures(handler, match.group(2))
+        if path == '/v2/':
+            self.record('base')
+            if not authorized:
+                return self.challenge(handler)
+            return self.send(handler, 200, b'{}')
+        match = re.match(r'^/v2/(.+)/(manifests|blobs|tags)/(.+)$', path)
+        if not match:
+            self.record('other')
+            return self.send(handler, 404, b'{}')
+        repository, kind, reference = match.groups()
+        self.record('%s %s' % (handler.command, kind))
+        if not authorized:
+            return self.challenge(handler)
+        if kind == 'manifests':
+            return self.manifest(handler, repository, reference)
+        if kind == 'blobs':
+            return self.blob(handler, repository, reference)
+        return self.tags_list(handler, repository, query)
+
+    def send(self, handler, status, body, headers=None,
+             content_type='application/json'):
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+    def challenge(self, handler):
+        realm = '%s/v2/auth' % self.url
+        headers = {'WWW-Authenticate': 'Bearer realm="%s",service="fake"'
+                   % realm}
+        return self.send(handler, 401, b'{}', headers)
+
+    def token(self, handler, query):
+        with self.lock:
+            self.issued += 1
+            token = 'token-%d' % self.issued
+        body = json.dumps({'token': token, 'expires_in': 300,
+                           'scope': query.get('scope', [])}).encode()
+        return self.send(handler, 200, body)
+
+    def manifest(self, handler, repository, reference):
+        entry = self.manifests.get((repository, reference))
+        if not entry:
+            return self.send(handler, 404, b'{}')
+        media_type, body = entry
+        accept = handler.headers.get('Accept', '')
+        if media_type == MANIFEST_LIST and MANIFEST_LIST not in accept:
+            # Like a real registry, return the amd64 manifest to clients
+            # that do not accept manifest lists.
+            data = json.loads(body.decode())
+            amd64 = data['manifests'][0]['digest']
+            media_type, body = self.manifests[(repository, amd64)]
+        headers = {'Docker-Content-Digest': digest(body)}
+        return self.send(handler, 200, body, headers, media_type)
+
+    def blob(self, handler, repository, reference):
+        body = self.blobs.get((repository, reference))
+        if body is None:
+            return self.send(handler, 404, b'{}')
+        status = 200
+        headers = {'Docker-Content-Digest': reference}
+        byte_range = handler.headers.get('Range')
+        if byte_range:
+            start = int(byte_range[len('bytes='):].split('-')[0])
+            if start >= len(body):
+                return self.send(handler, 416, b'')
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, len(body) - 1, len(body))
+            body = body[start:]
+            status = 206
+        return self.send(handler, status, body, headers,
+                         'application/octet-stream')
+
+    def tags_list(self, handler, repository, query):
+        tags = self.tags.get(repository)
+        if tags is None:
+            return self.send(handler, 404, b'{}')
+        size = int(query.get('n', [self.page_size])[0])
+        size = min(size, self.page_size)
+        start = 0
+        if 'last' in query:
+            start = tags.index(query['last'][0]) + 1
+        page = tags[start:start + size]
+        headers = {}
+        if start + size < len(tags):
+            link = '/v2/%s/tags/list?n=%d&last=%s' % (repository, size,
+                                                      page[-1])
+            headers['Link'] = '<%s>; rel="next"' % link
+        body = json.dumps({'name': repository, 'tags': page}).encode()
+        return self.send(handler, 200, body, headers)
+
+    def lookaside_signature(self, handler, path):
+        match = re.match(r'^/sigstore/(.+)@sha256=(\w+)/signature-(\d+)$',
+                         path)
+        if not match:
+            return self.send(handler, 404, b'')
+        messages = self.signatures.get('sha256:' + match.group(2), [])
+        index = int(match.group(3))
+        if index > len(messages):
+            return self.send(handler, 404, b'')
+        return self.send(handler, 200, messages[index - 1], None,
+                         'application/octet-stream')
+
+    def extension_signatures(self, handler, manifest_digest):
+        messages = self.signatures.get(manifest_digest)
+        if messages is None:
+            return self.send(handler, 404, b'{}')
+        entries = [{'schemaVersion': 2,
+                    'type': 'atomic',
+                    'content': base64.b64encode(message).decode()}
+                   for message in messages]
+        body = json.dumps({'signatures': entries}).encode()
+        return self.send(handler, 200, body)
+
+
+if __name__ == '__main__':
+    registry = FakeRegistry(latency=0.05)
+    registry.start()
+    registry.add_image('ceph/rhceph-7', 'latest', version='7')
+    print('Fake registry at %s (ctrl-c to exit)' % registry.url)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print('')
+        print(registry.report())
@@ -0,0 +1,35 @@
+import json
+import zlib
+from bucko import openpgp
+
+"""
+Fake OpenPGP-signed container image signatures.
+"""
+
+PAYLOAD = json.dumps({'critical': {'identity': {
+    'docker-reference': 'registry.example.com/ceph:latest'}}}).encode()
+
+
+def new_packet(tag, body):
+    """ Return a new format packet with a five-octet length. """
+    header = bytes([0xc0 | tag, 255]) + len(body).to_bytes(4, 'big')
+    return header + body
+
+
+def old_packet(tag, body):
+    """ Return an old format packet with a two-octet length. """
+    header = bytes([0x80 | (tag << 2) | 1]) + len(body).to_bytes(2, 'big')
+    return header + body
+
+
+def literal(data, filename=b''):
+    return (b'b' + bytes([len(filename)]) + filename + b'\0\0\0\0' + data)
+
+
+def message(compress=zlib.compress, algorithm=openpgp.ZLIB):
+    """ Return a fake signed message (with bogus signature packets). """
+    inner = (old_packet(4, b'one-pass signature') +
+             old_packet(openpgp.LITERAL_DATA, literal(PAYLOAD, b'payload')) +
+             old_packet(2, b'signature'))
+    body = bytes([algorithm]) + compress(inner)
+    return new_packet(openpgp.COMPRESSED_DATA, body)
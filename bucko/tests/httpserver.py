@@ -0,0 +1,10 @@
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+"""
+A local HTTP server for tests that talk to fake services over real sockets.
+"""
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
@@ -0,0 +1,176 @@
+import asyncio
+import base64
+import hashlib
+import json
+import threading
+import pytest
+from bucko.async_registry import AsyncRegistry
+from bucko.registry import MANIFEST_LIST
+from bucko.tokens import TokenCache
+from bucko.tests.fakesignature import PAYLOAD, message
+
+web = pytest.importorskip('aiohttp.web')
+
+
+def digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+CONFIG = json.dumps({'config': {'Labels': {
+    'com.redhat.component': 'rhceph-container',
+    'version': '7',
+    'release': '1'}}}).encode()
+MANIFEST = json.dumps({'config': {'digest': digest(CONFIG)}}).encode()
+MANIFEST_LIST_DATA = json.dumps({
+    'mediaType': MANIFEST_LIST,
+    'manifests': [{'digest': digest(MANIFEST),
+                   'platform': {'architecture': 'amd64', 'os': 'linux'}}],
+}).encode()
+
+
+class Server(object):
+    """ Small token-protected registry for AsyncRegistry. """
+
+    def __init__(self):
+        self.requests = []
+        self.issued = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/v2/', self.base)
+        app.router.add_get('/v2/auth', self.auth)
+        app.router.add_route('*', '/v2/{repository:.+}/manifests/{ref}',
+                             self.manifest)
+        app.router.add_get('/v2/{repository:.+}/blobs/{digest}', self.blob)
+        app.router.add_get('/extensions/v2/{repository:.+}/signatures/'
+                           '{digest}', self.signatures)
+        return app
+
+    def authorized(self, request):
+        self.requests.append((request.method, request.path))
+        token = request.headers.get('Authorization', '')
+        return token.startswith('Bearer token-')
+
+    def challenge(self, request):
+        realm = 'http://%s/v2/auth' % request.host
+        return web.Response(status=401, headers={
+            'WWW-Authenticate': 'Bearer realm="%s"' % realm})
+
+    async def base(self, request):
+        if not self.authorized(request):
+            return self.challenge(request)
+        return web.json_response({})
+
+    async def auth(self, request):
+        self.requests.append(('GET', request.path))
+        self.issued += 1
+        scopes = request.query.getall('scope')
+        return web.json_response({'token': 'token-%d' % self.issued,
+                                  'expires_in': 300,
+                                  'scopes': scopes})
+
+    async def manifest(self, request):
+        if not self.authorized(request):
+            return self.challenge(request)
+        ref = request.match_info['ref']
+        data = MANIFEST
+        accept = request.headers.get('Accept', '')
+        if ref != digest(MANIFEST) and MANIFEST_LIST in accept:
+            data = MANIFEST_LIST_DATA
+        headers = {'Docker-Content-Digest': digest(data)}
+        if request.method == 'HEAD':
+            return web.Response(headers=headers)
+        return web.Response(body=data, headers=headers)
+
+    async def blob(self, request):
+        if not self.authorized(request):
+            return self.challenge(request)
+        return web.Response(body=CONFIG)
+
+    async def signatures(self, request):
+        if not self.authorized(request):
+            return self.challenge(request)
+        content = base64.b64encode(message()).decode()
+        return web.json_response({'signatures': [{'content': content}]})
+
+
+def run(server, coroutine):
+    """ Serve our fake registry while we await coroutine(registry). """
+    async def main():
+        runner = web.AppRunner(server.app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            url = 'http://127.0.0.1:%d' % port
+            async with AsyncRegistry(url, max_concurrency=4) as registry:
+                return await coroutine(registry)
+        finally:
+            await runner.cleanup()
+    # asyncio.run() is new in Python 3.7.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+class TestAsyncRegistry(object):
+    @pytest.fixture
+    def server(self):
+        return Server()
+
+    def test_build(self, server):
+        async def build(registry):
+            return await registry.build('ceph:latest')
+        assert run(server, build).nvr == 'rhceph-container-7-1'
+
+    def test_builds(self, server):
+        async def builds(registry):
+            return await registry.builds(['ceph:7', 'rhceph:7', 'ceph:7'])
+        builds = run(server, builds)
+        assert [b.nvr for b in builds] == ['rhceph-container-7-1'] * 3
+        # One realm request for both repositories:
+        assert server.issued == 1
+
+    def test_digest(self, server):
+        async def head(registry):
+            return await registry.digest('ceph', 'latest')
+        assert run(server, head) == digest(MANIFEST_LIST_DATA)
+        assert ('GET', '/v2/ceph/manifests/latest') not in server.requests
+
+    def test_digest_platform(self, server):
+        async def platform(registry):
+            return await registry.digest('ceph', 'latest', 'amd64')
+        assert run(server, platform) == digest(MANIFEST)
+
+    def test_blocking_io_in_threads(self, server, monkeypatch):
+        """ Token cache writes and registries.d reads leave the loop. """
+        loop_threads = []
+        blocking_threads = []
+        save = TokenCache.save
+
+        def record_save(self):
+            blocking_threads.append(threading.get_ident())
+            return save(self)
+
+        def lookaside(self):
+            blocking_threads.append(threading.get_ident())
+            return None
+        monkeypatch.setattr(TokenCache, 'save', record_save)
+        monkeypatch.setattr(AsyncRegistry, 'lookaside', property(lookaside))
+
+        async def signatures(registry):
+            loop_threads.append(threading.get_ident())
+            return await registry.signatures('ceph:latest')
+        assert len(run(server, signatures)) == 1
+        assert blocking_threads
+        assert loop_threads[0] not in blocking_threads
+
+    def test_signature_payloads(self, server, monkeypatch):
+        monkeypatch.setattr(AsyncRegistry, 'lookaside', None)
+
+        async def payloads(registry):
+            return await registry.signature_payloads('ceph:latest')
+        assert run(server, payloads) == [json.loads(PAYLOAD)]
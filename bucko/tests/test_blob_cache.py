@@ -0,0 +1,47 @@
+import hashlib
+import os
+from bucko import blob_cache
+from bucko.blob_cache import BlobCache
+
+
+def digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+class TestBlobCache(object):
+    def test_get_missing(self, tmpdir):
+        cache = BlobCache(str(tmpdir))
+        assert cache.get(digest(b'foo')) is None
+
+    def test_set_get(self, tmpdir):
+        cache = BlobCache(str(tmpdir))
+        assert cache.set(digest(b'foo'), b'foo') is True
+        assert cache.get(digest(b'foo')) == b'foo'
+
+    def test_wrong_digest(self, tmpdir):
+        cache = BlobCache(str(tmpdir))
+        assert cache.set(digest(b'foo'), b'bar') is False
+        assert cache.get(digest(b'foo')) is None
+
+    def test_unsupported_digest(self, tmpdir):
+        cache = BlobCache(str(tmpdir))
+        assert cache.set('sha512:abc', b'foo') is False
+        assert cache.get('sha256:../../etc/passwd') is None
+
+    def test_evict(self, tmpdir):
+        cache = BlobCache(str(tmpdir), max_size=10)
+        cache.set(digest(b'aaaa'), b'aaaa')
+        cache.set(digest(b'bbbb'), b'bbbb')
+        # Make "aaaa" the least recently used entry:
+        os.utime(cache.filename(digest(b'aaaa')), (1, 1))
+        cache.set(digest(b'cccc'), b'cccc')
+        assert cache.get(digest(b'aaaa')) is None
+        assert cache.get(digest(b'bbbb')) == b'bbbb'
+        assert cache.get(digest(b'cccc')) == b'cccc'
+        assert cache.size() == 8
+
+
+def test_get_blob_cache(cache_home):
+    cache = blob_cache.get_blob_cache()
+    assert cache is blob_cache.get_blob_cache()
+    assert cache.path == str(cache_home.join('bucko', 'blobs'))
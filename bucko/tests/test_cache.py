@@ -0,0 +1,112 @@
+import os
+import stat
+import time
+from bucko import cache
+
+
+def test_cache_dir(cache_home):
+    path = cache.cache_dir()
+    assert path == str(cache_home.join('bucko'))
+    assert os.path.isdir(path)
+
+
+def test_read_json_missing(tmpdir):
+    assert cache.read_json(str(tmpdir.join('missing.json'))) is None
+
+
+def test_read_json_corrupt(tmpdir):
+    path = tmpdir.join('corrupt.json')
+    path.write('{')
+    assert cache.read_json(str(path)) is None
+
+
+class TestReadFile(object):
+    def loader(self, f):
+        self.loads += 1
+        return f.read()
+
+    def test_missing(self, tmpdir):
+        self.loads = 0
+        path = str(tmpdir.join('missing'))
+        assert cache.read_file(path, self.loader) is None
+
+    def test_memoized(self, tmpdir):
+        self.loads = 0
+        path = tmpdir.join('auth.json')
+        path.write('one')
+        assert cache.read_file(str(path), self.loader) == 'one'
+        assert cache.read_file(str(path), self.loader) == 'one'
+        assert self.loads == 1
+
+    def test_changed(self, tmpdir):
+        self.loads = 0
+        path = tmpdir.join('auth.json')
+        path.write('one')
+        assert cache.read_file(str(path), self.loader) == 'one'
+        path.write('three')
+        assert cache.read_file(str(path), self.loader) == 'three'
+        assert self.loads == 2
+
+    def test_deleted(self, tmpdir):
+        self.loads = 0
+        path = tmpdir.join('auth.json')
+        path.write('one')
+        cache.read_file(str(path), self.loader)
+        path.remove()
+        assert cache.read_file(str(path), self.loader) is None
+
+
+def test_write_private_json(tmpdir):
+    path = str(tmpdir.join('data.json'))
+    cache.write_private_json(path, {'foo': 'bar'})
+    assert cache.read_json(path) == {'foo': 'bar'}
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    assert mode == 0o600
+
+
+class TestFingerprint(object):
+    def test_stable(self):
+        first = cache.fingerprint(branch='foo', repos=['a', 'b'])
+        second = cache.fingerprint(repos={'b', 'a'}, branch='foo')
+        assert first == second
+
+    def test_different(self):
+        first = cache.fingerprint(branch='foo', parent=None)
+        second = cache.fingerprint(branch='foo', parent='bar-1-1')
+        assert first != second
+
+
+class TestTTLCache(object):
+    def test_get_missing(self):
+        c = cache.TTLCache(60)
+        assert c.get('foo') is None
+
+    def test_set_get(self):
+        c = cache.TTLCache(60)
+        c.set('foo', {'bar': 1})
+        assert c.get('foo') == {'bar': 1}
+
+    def test_expired(self, monkeypatch):
+        c = cache.TTLCache(60)
+        c.set('foo', 'bar')
+        later = time.time() + 61
+        monkeypatch.setattr('bucko.cache.time.time', lambda: later)
+        assert c.get('foo') is None
+        assert 'foo' not in c.entries
+
+    def test_invalidate(self):
+        c = cache.TTLCache(60)
+        c.set('foo', 'bar')
+        c.set('baz', 'qux')
+        c.invalidate('foo')
+        assert c.get('foo') is None
+        assert c.get('baz') == 'qux'
+        c.invalidate()
+        assert c.entries == {}
+
+    def test_persist(self, tmpdir):
+        path = str(tmpdir.join('ttl.json'))
+        c = cache.TTLCache(60, path)
+        c.set('foo', 'bar')
+        c = cache.TTLCache(60, path)
+        assert c.get('foo') == 'bar'
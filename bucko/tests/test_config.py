@@ -47,6 +47,21 @@ def test_lookup_nonfatal(simple_configp):
     assert result is None
 
 
+def test_lookup_boolean(simple_configp):
+    simple_configp.set('testsection', 'enabled', 'Yes')
+    simple_configp.set('testsection', 'disabled', 'no')
+    assert config.lookup_boolean(simple_configp, 'testsection', 'enabled')
+    assert not config.lookup_boolean(simple_configp, 'testsection', 'disabled')
+    assert not config.lookup_boolean(simple_configp, 'testsection', 'baz')
+
+
+def test_parse_boolean():
+    for value in ('yes', 'True', 'on', '1'):
+        assert config.parse_boolean(value)
+    for value in ('no', 'false', 'off', '0', '', None):
+        assert not config.parse_boolean(value)
+
+
 def test_get_repo_urls(configp):
     section = 'ceph-4.0-rhel-8-base'
     result = config.get_repo_urls(configp, section)
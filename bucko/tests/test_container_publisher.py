@@ -1,3 +1,4 @@
+from bucko import trace
 from bucko.container_publisher import ContainerPublisher
 
 HOST = 'registry.example.com'
@@ -41,3 +42,12 @@ def test_publish(monkeypatch):
     ]
     assert recorder.calls
     assert recorder.calls == expected
+
+
+def test_publish_trace(monkeypatch):
+    monkeypatch.setattr('subprocess.check_output', CheckOutputRecorder())
+    p = ContainerPublisher(HOST, TOKEN)
+    p.publish('registry.example.com/ceph/ceph:foo', 'ceph', 'ceph-4.0-rhel-8',
+              'latest')
+    names = [span.name for span in trace.spans('cmd')]
+    assert names == ['podman login', 'skopeo copy', 'podman logout']
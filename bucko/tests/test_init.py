@@ -1,4 +1,7 @@
+import json
 import os
+import time
+from concurrent.futures import Future
 import productmd
 import pytest
 import bucko
@@ -63,6 +66,57 @@ class TestGetPublisher(object):
         assert p.http_url == 'http://example.com/mypath'
 
 
+class TestGetRegistry(object):
+    @pytest.fixture
+    def config(self):
+        config = ConfigParser()
+        config.add_section('registry')
+        config.set('registry', 'url', 'https://registry.example.com')
+        return config
+
+    def test_get_registry(self, config):
+        registry = bucko.get_registry(config)
+        assert isinstance(registry, bucko.Registry)
+        assert registry.baseurl == 'https://registry.example.com/v2'
+        assert registry.tokens.path is None
+
+    def test_token_cache(self, config):
+        config.set('registry', 'token_cache', 'yes')
+        registry = bucko.get_registry(config)
+        assert registry.tokens.path.endswith('registry-tokens.json')
+
+    def test_no_blob_cache(self, config):
+        registry = bucko.get_registry(config)
+        assert registry.blobs is None
+
+    def test_blob_cache(self, config):
+        config.set('registry', 'blob_cache', 'yes')
+        config.set('registry', 'blob_cache_size', '10')
+        registry = bucko.get_registry(config)
+        assert registry.blobs.path.endswith('blobs')
+        assert registry.blobs.max_size == 10 * 1024 * 1024
+
+
+class TestGetParentBuild(object):
+    @pytest.fixture
+    def config(self):
+        config = ConfigParser()
+        config.add_section('registry')
+        config.set('registry', 'url', 'https://registry.example.com')
+        return config
+
+    def test_no_parent_image(self, config):
+        assert bucko.get_parent_build(config, None) is None
+
+    def test_glob(self, config, monkeypatch):
+        monkeypatch.setattr(bucko.Registry, 'newest_tag',
+                            lambda self, repository, pattern: '7-2')
+        monkeypatch.setattr(bucko.Registry, 'build',
+                            lambda self, image: image)
+        assert bucko.get_parent_build(config, 'ceph:7-*') == 'ceph:7-2'
+        assert bucko.get_parent_build(config, 'ceph:7-1') == 'ceph:7-1'
+
+
 class TestGetCompose(object):
     @pytest.fixture
     def config(self):
@@ -94,27 +148,67 @@ class TestGetBranch(object):
 class FakeKojiBuilder(object):
     """ Dummy KojiBuilder module """
     session = SimpleNamespace(baseurl='dummyhub')
+    profile = 'koji'
+
+    canceled = []
 
     def __init__(self, *args, **kw):
-        pass
+        self.watched = []
+
+    def build_container(self, *args, **kw):
+        return 1000 + len(kw['branch'])
 
-    def build_container(*args, **kw):
-        return 1234
+    def cancel_task(self, id_):
+        self.canceled.append(id_)
 
-    def watch_task(*args, **kw):
-        pass
+    def get_target_arches(self, target):
+        return 'x86_64 ppc64le'
+
+    def get_last_event(self):
+        return 5000
+
+    def tag_changed_since(self, tag, event):
+        return True
+
+    def watch_task(self, id_):
+        self.watched.append(id_)
+
+    def task_succeeded(self, id_):
+        return True
+
+    def watch_tasks(self, ids, interval=5):
+        # The last task finishes first:
+        for id_ in reversed(ids):
+            yield id_, True
 
     def get_repositories(*args, **kw):
         return ['http://registry.example.com/foo']
 
 
 class TestBuildContainer(object):
+    @pytest.fixture(autouse=True)
+    def preflight(self, monkeypatch):
+        checked = []
+        monkeypatch.setattr('bucko.preflight.check',
+                            lambda repo_urls, arches: checked.append(
+                                (set(repo_urls), arches)))
+        return checked
+
+    @pytest.fixture(autouse=True)
+    def commits(self, monkeypatch):
+        """ The dist-git commit for each ref. """
+        commits = {'refs/heads/foo-3.0-rhel-7': 'a' * 40,
+                   'refs/heads/foo-3.0-rhel-8-extra': 'b' * 40}
+        monkeypatch.setattr('bucko.scm.ls_remote',
+                            lambda url, ref: commits.get(ref))
+        return commits
+
     @pytest.fixture
     def config(self):
         config = ConfigParser()
         config.add_section('koji')
         config.set('koji', 'profile', 'koji')
-        config.set('koji', 'scm', 'git://example.com')
+        config.set('koji', 'scm', 'git://example.com/foo#origin/%(branch)s')
         config.set('koji', 'target', 'foo-rhel-7-candidate')
         return config
 
@@ -126,9 +220,324 @@ class TestBuildContainer(object):
         scratch = True
         results = bucko.build_container(repo_url, branch, parent_image,
                                         scratch, config)
-        assert results['koji_task'] == 1234
+        assert results['koji_task'] == 1014
         assert results['repository'] == 'http://registry.example.com/foo'
 
+    def test_build_container_reuse(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        watched = []
+        monkeypatch.setattr(FakeKojiBuilder, 'watch_task',
+                            lambda self, id_: watched.append(id_))
+        repo_urls = {'http://example.com/example.repo'}
+        args = (repo_urls, 'foo-3.0-rhel-7', None, True, config)
+        first = bucko.build_container(*args)
+        first['repositories'].append('mutated')
+        second = bucko.build_container(*args)
+        assert second['koji_task'] == first['koji_task']
+        assert 'mutated' not in second['repositories']
+        assert watched == [1014]
+        # --force skips the stored result:
+        bucko.build_container(*args, force=True)
+        assert watched == [1014, 1014]
+
+    def test_build_container_changed_inputs(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        watched = []
+        monkeypatch.setattr(FakeKojiBuilder, 'watch_task',
+                            lambda self, id_: watched.append(id_))
+        repo_urls = {'http://example.com/example.repo'}
+        bucko.build_container(repo_urls, 'foo-3.0-rhel-7', None, True, config)
+        repo_urls.add('http://example.com/other.repo')
+        bucko.build_container(repo_urls, 'foo-3.0-rhel-7', None, True, config)
+        assert watched == [1014, 1014]
+
+    def test_build_container_new_commit(self, config, monkeypatch, commits):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        submitted = []
+        monkeypatch.setattr(FakeKojiBuilder, 'build_container',
+                            lambda self, **kw: submitted.append(kw['scm'])
+                            or 1000 + len(submitted))
+        repo_urls = {'http://example.com/example.repo'}
+        args = (repo_urls, 'foo-3.0-rhel-7', None, True, config)
+        bucko.build_container(*args)
+        bucko.build_container(*args)
+        # Only the dist-git commit changes:
+        commits['refs/heads/foo-3.0-rhel-7'] = 'c' * 40
+        bucko.build_container(*args)
+        assert submitted == ['git://example.com/foo#' + 'a' * 40,
+                             'git://example.com/foo#' + 'c' * 40]
+
+    def test_build_container_unresolved(self, config, monkeypatch, commits):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        watched = []
+        monkeypatch.setattr(FakeKojiBuilder, 'watch_task',
+                            lambda self, id_: watched.append(id_))
+        commits.clear()
+        repo_urls = {'http://example.com/example.repo'}
+        args = (repo_urls, 'foo-3.0-rhel-7', None, True, config)
+        bucko.build_container(*args)
+        bucko.build_container(*args)
+        # We could not tell whether dist-git changed, so we built twice:
+        assert watched == [1014, 1014]
+
+    def test_build_container_odcs_compose(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        submitted = []
+        monkeypatch.setattr(FakeKojiBuilder, 'build_container',
+                            lambda self, **kw: submitted.append(kw['repos']))
+        odcs_compose = Future()
+        odcs_compose.set_result('http://odcs.example.com/odcs-1.repo')
+        repo_urls = {'http://example.com/example.repo'}
+        bucko.build_container(repo_urls, 'foo-3.0-rhel-7', None, True, config,
+                              odcs_compose=odcs_compose)
+        assert submitted[0] == {
+            'http://example.com/example.repo',
+            'http://odcs.example.com/odcs-1.repo',
+        }
+        # We did not modify the caller's set:
+        assert repo_urls == {'http://example.com/example.repo'}
+
+    def test_build_container_preflight(self, config, monkeypatch, preflight):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        repo_urls = {'http://example.com/example.repo'}
+        bucko.build_container(repo_urls, 'foo-3.0-rhel-7', None, True, config)
+        assert preflight == [(repo_urls, ['x86_64', 'ppc64le'])]
+
+    def test_build_container_stages(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        repo_urls = {'http://example.com/example.repo'}
+        bucko.build_container(repo_urls, 'foo-3.0-rhel-7', None, True, config)
+        assert list(bucko.trace.stage_durations()) == [
+            'pre-flight checks',
+            'submit Koji build',
+            'Koji build',
+        ]
+
+    def test_build_container_preflight_failure(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        submitted = []
+        monkeypatch.setattr(FakeKojiBuilder, 'build_container',
+                            lambda self, **kw: submitted.append(kw))
+
+        def check(repo_urls, arches):
+            raise RuntimeError('pre-flight checks failed')
+        monkeypatch.setattr('bucko.preflight.check', check)
+        repo_urls = {'http://example.com/example.repo'}
+        with pytest.raises(RuntimeError):
+            bucko.build_container(repo_urls, 'foo-3.0-rhel-7', None, True,
+                                  config)
+        assert submitted == []
+
+    def test_build_containers(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        repo_urls = {'http://example.com/example.repo'}
+        builds = [('foo-3.0-rhel-7', None, repo_urls, None),
+                  ('foo-3.0-rhel-8-extra', None, repo_urls, None)]
+        scratch = True
+        results = bucko.build_containers(builds, scratch, config)
+        results = list(results)
+        assert [branch for branch, _ in results] == [
+            'foo-3.0-rhel-8-extra',
+            'foo-3.0-rhel-7',
+        ]
+        assert results[0][1]['koji_task'] == 1020
+        assert results[1][1]['koji_task'] == 1014
+
+    def test_build_containers_profiles(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        submitted = []
+        monkeypatch.setattr(FakeKojiBuilder, 'build_container',
+                            lambda self, **kw: submitted.append(kw))
+        config.set('koji', 'profile', 'koji-%(branch)s')
+        builds = [('foo-3.0-rhel-7', None, set(), None),
+                  ('foo-3.0-rhel-8-extra', None, set(), None)]
+        with pytest.raises(RuntimeError, match='different Koji profiles'):
+            list(bucko.build_containers(builds, True, config))
+        assert submitted == []
+
+    def test_build_containers_preflight_failure(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        submitted = []
+        monkeypatch.setattr(FakeKojiBuilder, 'build_container',
+                            lambda self, **kw: submitted.append(kw))
+
+        def check(repo_urls, arches):
+            if 'http://example.com/gone.repo' in repo_urls:
+                raise RuntimeError('pre-flight checks failed')
+        monkeypatch.setattr('bucko.preflight.check', check)
+        builds = [('foo-3.0-rhel-7', None,
+                   {'http://example.com/example.repo'}, None),
+                  ('foo-3.0-rhel-8-extra', None,
+                   {'http://example.com/gone.repo'}, None)]
+        with pytest.raises(RuntimeError, match='pre-flight checks failed'):
+            list(bucko.build_containers(builds, True, config))
+        assert submitted == []
+
+    def test_build_containers_preflight_first(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        events = []
+        monkeypatch.setattr('bucko.preflight.check',
+                            lambda repo_urls, arches: events.append('check'))
+        monkeypatch.setattr(FakeKojiBuilder, 'build_container',
+                            lambda self, **kw: events.append('submit'))
+        repo_urls = {'http://example.com/example.repo'}
+        builds = [('foo-3.0-rhel-7', None, repo_urls, None),
+                  ('foo-3.0-rhel-8-extra', None, repo_urls, None)]
+        monkeypatch.setattr(FakeKojiBuilder, 'watch_tasks',
+                            lambda self, ids: [])
+        list(bucko.build_containers(builds, True, config))
+        assert events == ['check', 'check', 'submit', 'submit']
+
+    def test_build_containers_submit_failure(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        monkeypatch.setattr(FakeKojiBuilder, 'canceled', [])
+
+        def build_container(self, **kw):
+            if kw['branch'] == 'foo-3.0-rhel-8-extra':
+                raise RuntimeError('Build Target is not present')
+            return 1014
+        monkeypatch.setattr(FakeKojiBuilder, 'build_container',
+                            build_container)
+        repo_urls = {'http://example.com/example.repo'}
+        builds = [('foo-3.0-rhel-7', None, repo_urls, None),
+                  ('foo-3.0-rhel-8-extra', None, repo_urls, None)]
+        with pytest.raises(RuntimeError, match='Build Target'):
+            list(bucko.build_containers(builds, True, config))
+        assert FakeKojiBuilder.canceled == [1014]
+
+    def test_build_containers_reuse_after_submit(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        repo_urls = {'http://example.com/example.repo'}
+        bucko.build_container(repo_urls, 'foo-3.0-rhel-7', None, True,
+                              config)
+        submitted = []
+        monkeypatch.setattr(FakeKojiBuilder, 'build_container',
+                            lambda self, **kw: submitted.append(kw['branch'])
+                            or 1020)
+        builds = [('foo-3.0-rhel-7', None, repo_urls, None),
+                  ('foo-3.0-rhel-8-extra', None, repo_urls, None)]
+        results = bucko.build_containers(builds, True, config)
+        branch, result = next(results)
+        assert branch == 'foo-3.0-rhel-7'
+        assert result['koji_task'] == 1014
+        # We submitted the other branch before we yielded the re-used one:
+        assert submitted == ['foo-3.0-rhel-8-extra']
+        assert [branch for branch, _ in results] == ['foo-3.0-rhel-8-extra']
+
+    def test_build_container_reuse_expired(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        repo_urls = {'http://example.com/example.repo'}
+        args = (repo_urls, 'foo-3.0-rhel-7', None, True, config)
+        first = bucko.build_container(*args)
+        get = bucko.TTLCache.get
+        reads = []
+
+        def get_once(self, key):
+            # The stored result expires right after our first read.
+            reads.append(key)
+            return get(self, key) if len(reads) == 1 else None
+        monkeypatch.setattr(bucko.TTLCache, 'get', get_once)
+        assert bucko.build_container(*args) == first
+        assert len(reads) == 1
+
+    def test_build_containers_stage(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        repo_urls = {'http://example.com/example.repo'}
+        builds = [('foo-3.0-rhel-7', None, repo_urls, None),
+                  ('foo-3.0-rhel-8-extra', None, repo_urls, None)]
+        list(bucko.build_containers(builds, True, config))
+        spans = [s for s in bucko.trace.spans('stage')
+                 if s.name == 'Koji build']
+        # One span for all the overlapping builds:
+        assert len(spans) == 1
+        assert spans[0].args == {'branches': ['foo-3.0-rhel-7',
+                                              'foo-3.0-rhel-8-extra']}
+
+    def test_build_containers_failure(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        monkeypatch.setattr(FakeKojiBuilder, 'watch_tasks',
+                            lambda self, ids: [(id_, False) for id_ in ids])
+        builds = [('foo-3.0-rhel-7', None, set(), None)]
+        with pytest.raises(RuntimeError):
+            list(bucko.build_containers(builds, True, config))
+
+
+class FakeOdcsManager(object):
+    """ Dummy OdcsManager """
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, tag, arches, event=None, saved=None):
+        self.calls.append((tag, arches, event, saved))
+        future = Future()
+        future.set_result('http://odcs.example.com/odcs-1.repo')
+        return future
+
+
+class TestStartOdcsCompose(object):
+    @pytest.fixture
+    def config(self):
+        config = ConfigParser()
+        config.add_section('koji')
+        config.set('koji', 'profile', 'koji')
+        config.set('koji', 'target', '%(branch)s-candidate')
+        config.add_section('foo-3.0-rhel-7-base')
+        config.set('foo-3.0-rhel-7-base', 'odcs_tag', 'foo-3.0-candidate')
+        return config
+
+    def test_no_odcs_tag(self, config):
+        manager = FakeOdcsManager()
+        result = bucko.start_odcs_compose(config, 'bar-1-rhel-7', manager)
+        assert result is None
+
+    def test_odcs_tag(self, config, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', FakeKojiBuilder)
+        manager = FakeOdcsManager()
+        future = bucko.start_odcs_compose(config, 'foo-3.0-rhel-7', manager)
+        assert future.result() == 'http://odcs.example.com/odcs-1.repo'
+        expected = [('foo-3.0-candidate', 'x86_64 ppc64le', 5000, None)]
+        assert manager.calls == expected
+
+
+class TestGetOdcsManager(object):
+    def test_defaults(self, monkeypatch):
+        monkeypatch.setattr('bucko.odcs_manager.OdcsManager',
+                            lambda **kw: kw)
+        result = bucko.get_odcs_manager(ConfigParser())
+        assert result == {'url': bucko.odcs_manager.ODCS_URL,
+                          'timeout': bucko.odcs_manager.COMPOSE_TIMEOUT}
+
+    def test_settings(self, monkeypatch):
+        monkeypatch.setattr('bucko.odcs_manager.OdcsManager',
+                            lambda **kw: kw)
+        config = ConfigParser()
+        config.add_section('odcs')
+        config.set('odcs', 'url', 'https://odcs.example.com')
+        config.set('odcs', 'timeout', '600')
+        result = bucko.get_odcs_manager(config)
+        assert result == {'url': 'https://odcs.example.com', 'timeout': 600}
+
+
+class TestGetBranchSettings(object):
+    def test_base_section(self):
+        config = ConfigParser()
+        config.read(os.path.join(FIXTURES_DIR, '.bucko.conf'))
+        repo_url = 'http://example.com/compose.repo'
+        parent_image, repo_urls = bucko.get_branch_settings(
+            config, 'ceph-4.0-rhel-8', repo_url)
+        assert parent_image is None
+        assert repo_urls == {'http://example.com/repo1.repo',
+                             'http://example.com/repo2.repo',
+                             repo_url}
+
+    def test_no_section(self):
+        config = ConfigParser()
+        repo_url = 'http://example.com/compose.repo'
+        parent_image, repo_urls = bucko.get_branch_settings(
+            config, 'ceph-9.0-rhel-9', repo_url)
+        assert parent_image is None
+        assert repo_urls == {repo_url}
+
 
 class TestWritePropsFile(object):
     def test_no_workspace(self, monkeypatch):
@@ -146,3 +555,77 @@ class TestWritePropsFile(object):
         contents = props_path.read_text('utf-8')
         expected = 'FOO=bar\n'
         assert contents == expected
+
+
+class TestTraceFiles(object):
+    def test_stage_props(self):
+        start = time.monotonic()
+        bucko.trace.record('write .repo file', 'stage', start, 0.25)
+        bucko.trace.record('Koji build', 'stage', start, 1234.5)
+        assert bucko.stage_props() == {
+            'stage_write_repo_file_seconds': '0.250',
+            'stage_koji_build_seconds': '1234.500',
+        }
+
+    def test_write_trace_files(self):
+        bucko.trace.record('Koji build', 'stage', time.monotonic(), 1.0)
+        json_file, summary_file = bucko.write_trace_files('RHCEPH-8.0-1')
+        assert os.path.basename(json_file) == 'RHCEPH-8.0-1-trace.json'
+        assert os.path.basename(summary_file) == 'RHCEPH-8.0-1-trace.txt'
+        with open(json_file) as f:
+            assert len(json.load(f)['traceEvents']) == 1
+        with open(summary_file) as f:
+            assert 'Koji build' in f.read()
+
+    def test_publish_trace_files(self):
+        published = []
+
+        class FakePublisher(object):
+            def publish(self, file_):
+                published.append(os.path.basename(file_))
+                return 'http://example.com/' + os.path.basename(file_)
+
+        bucko.publish_trace_files(FakePublisher(), 'RHCEPH-8.0-1')
+        assert published == ['RHCEPH-8.0-1-trace.json',
+                             'RHCEPH-8.0-1-trace.txt']
+
+    def test_publish_trace_files_failure(self):
+        class FakePublisher(object):
+            def publish(self, file_):
+                raise OSError('push_url is down')
+
+        # Does not raise:
+        bucko.publish_trace_files(FakePublisher(), 'RHCEPH-8.0-1')
+
+
+class TestGetKojiBuilder(object):
+    def test_defaults(self, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', lambda **kw: kw)
+        result = bucko.get_koji_builder({'profile': 'koji'})
+        assert result == {'profile': 'koji',
+                          'metadata_ttl': bucko.METADATA_TTL,
+                          'persist_metadata': False,
+                          'persist_session': False}
+
+    def test_metadata_cache(self, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', lambda **kw: kw)
+        kconf = {'profile': 'koji',
+                 'metadata_ttl': '60',
+                 'metadata_cache': 'yes'}
+        result = bucko.get_koji_builder(kconf)
+        assert result == {'profile': 'koji',
+                          'metadata_ttl': 60,
+                          'persist_metadata': True,
+                          'persist_session': False}
+
+    def test_session_cache(self, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', lambda **kw: kw)
+        kconf = {'profile': 'koji', 'session_cache': 'yes'}
+        result = bucko.get_koji_builder(kconf)
+        assert result['persist_session'] is True
+
+    def test_metadata_cache_on(self, monkeypatch):
+        monkeypatch.setattr('bucko.KojiBuilder', lambda **kw: kw)
+        kconf = {'profile': 'koji', 'metadata_cache': 'on'}
+        result = bucko.get_koji_builder(kconf)
+        assert result['persist_metadata'] is True
@@ -0,0 +1,102 @@
+import pytest
+from bucko import koji_builder
+from bucko.koji_builder import KojiBuilder
+from bucko.tests.fakehub import FakeHub
+
+"""
+Count Koji hub round trips for each stage of bucko's build pipeline.
+
+These budgets guard against regressions in the number of hub calls. Run
+"py.test -s bucko/tests/test_koji_benchmark.py" to see the report.
+"""
+
+SCM = 'git://example.com/containers/rhceph#origin/ceph-8.0-rhel-9'
+TARGET = 'ceph-8.0-rhel-9-containers-candidate'
+BRANCH = 'ceph-8.0-rhel-9'
+REPOS = ['http://example.com/compose.repo']
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    hub = FakeHub(latency=0.3, polls=3)
+    hub.start()
+    monkeypatch.setitem(koji_builder._sessions, 'fakehub', hub.session())
+    yield hub
+    hub.stop()
+
+
+def run_pipeline(hub, scratch=False):
+    """ Run the Koji stages of bucko's main() against this hub. """
+    # main() looks up the target arches for ODCS
+    with hub.stage('get_target_arches'):
+        KojiBuilder('fakehub', persist_session=True).get_target_arches(TARGET)
+    # ... and then build_container() uses a second KojiBuilder.
+    k = KojiBuilder('fakehub', persist_session=True)
+    with hub.stage('build_container'):
+        task_id = k.build_container(SCM, TARGET, BRANCH, REPOS,
+                                    scratch=scratch)
+    with hub.stage('watch_task'):
+        k.watch_task(task_id, interval=0)
+    if not scratch:
+        with hub.stage('untag_task_result'):
+            k.untag_task_result(task_id)
+    with hub.stage('get_repositories'):
+        k.get_repositories(task_id, TARGET)
+    return task_id
+
+
+class TestKojiBenchmark(object):
+    def test_pipeline(self, hub):
+        run_pipeline(hub)
+        print('')
+        print(hub.report())
+        assert hub.round_trips('get_target_arches') <= 2
+        # login + getAPIVersion + buildContainer
+        assert hub.round_trips('build_container') <= 3
+        # getTaskInfo + getTaskChildren for each poll, plus the final poll
+        assert hub.round_trips('watch_task') <= 2 * (hub.polls + 1) + 2
+        # getTaskResult, one listTags multicall, one untagBuild multicall
+        assert hub.round_trips('untag_task_result') <= 3
+        assert hub.round_trips('get_repositories') == 0
+
+    def test_scratch_pipeline(self, hub):
+        run_pipeline(hub, scratch=True)
+        assert hub.round_trips('untag_task_result') == 0
+        assert hub.round_trips('get_repositories') == 1
+
+    def test_untagged(self, hub):
+        task_id = run_pipeline(hub)
+        build_id = int(hub.tasks[task_id]['result']['koji_builds'][0])
+        assert hub.tags[build_id] == []
+
+    def test_resumed_session(self, hub, monkeypatch):
+        run_pipeline(hub)
+        # Simulate a new bucko process:
+        monkeypatch.setattr(koji_builder, '_sessions',
+                            {'fakehub': hub.session()})
+        monkeypatch.setattr(koji_builder, '_metadata_caches', {})
+        hub.stats.clear()
+        run_pipeline(hub)
+        calls = hub.stats['build_container']['calls']
+        assert calls['login'] == 0
+        assert calls['getLoggedInUser'] == 1
+
+    def test_watch_tasks(self, hub):
+        k = KojiBuilder('fakehub')
+        task_ids = [k.build_container(SCM, TARGET, BRANCH, REPOS)
+                    for _ in range(3)]
+        with hub.stage('watch_tasks'):
+            results = list(k.watch_tasks(task_ids, interval=0))
+        assert sorted(results) == [(task_id, True) for task_id in task_ids]
+        # One multicall per poll, no matter how many tasks we watch:
+        assert hub.round_trips('watch_tasks') == hub.polls + 1
+
+    def test_tag_changed_since(self, hub):
+        k = KojiBuilder('fakehub')
+        event = k.get_last_event()
+        with hub.stage('tag_changed_since'):
+            assert k.tag_changed_since(TARGET, event) is False
+        # getFullInheritance, plus one queryHistory multicall
+        assert hub.round_trips('tag_changed_since') == 2
+        run_pipeline(hub)
+        assert k.tag_changed_since(TARGET, event) is True
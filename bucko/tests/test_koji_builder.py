@@ -1,16 +1,29 @@
+import fcntl
+import json
+import os
+import stat
+import time
 import koji
 from types import SimpleNamespace
+from bucko import koji_builder
 from bucko.koji_builder import KojiBuilder
+from bucko.koji_builder import save_sessions
+from bucko.koji_builder import session_file
+from bucko.koji_builder import trace_calls
+from bucko import trace
+from bucko.tests.fakehub import FakeHub
 from collections import defaultdict
 
 
 class FakeKoji(object):
     """ Dummy koji module """
     TASK_STATES = koji.TASK_STATES
+    GenericError = koji.GenericError
     config = SimpleNamespace(
         server='dummyhub',
         weburl='dummyweb',
         authtype='kerberos',
+        principal='kdreyer@EXAMPLE.COM',
         cert='',
     )
 
@@ -23,30 +36,69 @@ class FakeKoji(object):
         return cls
 
 
+class FakeMultiCallSession(object):
+    """ Dummy koji.MultiCallSession that runs each call immediately """
+
+    def __init__(self, session):
+        self.session = session
+
+    def __getattr__(self, name):
+        method = getattr(self.session, name)
+        return lambda *args, **kw: SimpleNamespace(result=method(*args, **kw))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
 class FakeClientSession(object):
     """ Dummy koji.ClientSession """
     logged_in = False
+    sinfo = None
+    callnum = None
     tasks_waited = defaultdict(int)
+    valid_sessions = [{'session-id': 1, 'session-key': 'abc'}]
 
     def __init__(self, baseurl, opts):
+        self.baseurl = baseurl
         self.opts = opts
+        self.calls = defaultdict(int)
+
+    def multicall(self, strict=False, batch=None):
+        self.calls['multicall'] += 1
+        return FakeMultiCallSession(self)
 
     def __getattr__(self, name):
         return lambda *args, **kw: None
 
     def gssapi_login(self, *args, **kw):
-        self.logged_in = True
+        self.calls['gssapi_login'] += 1
+        self.setSession({'session-id': 1, 'session-key': 'abc'})
+
+    def setSession(self, sinfo):
+        self.logged_in = sinfo is not None
+        self.callnum = None if sinfo is None else 0
+        self.sinfo = sinfo
+
+    def getLoggedInUser(self):
+        if self.sinfo not in self.valid_sessions:
+            raise koji.AuthError('invalid session')
+        return {'name': 'kdreyer'}
 
     def getAPIVersion(self):
         return 1
 
     def getBuildTarget(self, target, strict=False):
+        self.calls['getBuildTarget'] += 1
         return {'build_tag': 123}
 
     def buildContainer(self, *args, **kw):
         return 1234
 
     def getTag(self, tag, strict=False):
+        self.calls['getTag'] += 1
         return {'arches': 'x86_64 ppc64le s390x'}
 
     def getTaskInfo(self, id_, request=False):
@@ -64,6 +116,7 @@ class FakeClientSession(object):
 
     def getTaskResult(self, id_):
         """ Return a non-scratch buildContainer task result """
+        self.calls['getTaskResult'] += 1
         return {
             'koji_builds': ['1234'],  # list of koji build IDs
             'repositories': [
@@ -73,6 +126,20 @@ class FakeClientSession(object):
             ],
         }
 
+    def getLastEvent(self):
+        return {'id': 5000, 'ts': 1700000000.0}
+
+    def getFullInheritance(self, tag):
+        return [{'name': 'parent-tag'}]
+
+    def queryHistory(self, tables, tag, afterEvent):
+        """ "parent-tag" changed at event 5000 """
+        self.calls['queryHistory'] += 1
+        changes = []
+        if tag == 'parent-tag' and afterEvent < 5000:
+            changes = [{'create_event': 5000, 'revoke_event': None}]
+        return {'tag_listing': changes, 'tag_inheritance': []}
+
     def listTags(self, build):
         """ Return a list of tags for a build """
         return [
@@ -93,6 +160,102 @@ class TestKojiBuilder(object):
         k.ensure_logged_in()
         assert k.session.logged_in is True
 
+    def test_shared_session(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        first = KojiBuilder('koji')
+        second = KojiBuilder('koji')
+        assert first.session is second.session
+
+    def test_save_session(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji', persist_session=True)
+        k.ensure_logged_in()
+        path = session_file('koji')
+        with open(path) as f:
+            data = json.load(f)
+        assert data['server'] == 'dummyhub'
+        assert data['sinfo'] == {'session-id': 1, 'session-key': 'abc'}
+        assert data['expires'] > time.time()
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    def test_resume_session(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        KojiBuilder('koji', persist_session=True).ensure_logged_in()
+        # Simulate a new bucko process:
+        monkeypatch.setattr('bucko.koji_builder._sessions', {})
+        k = KojiBuilder('koji', persist_session=True)
+        k.ensure_logged_in()
+        assert k.session.logged_in is True
+        assert k.session.calls['gssapi_login'] == 0
+
+    def test_resume_callnum(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji', persist_session=True)
+        k.ensure_logged_in()
+        k.session.callnum = 12
+        save_sessions()
+        # Simulate a new bucko process:
+        monkeypatch.setattr('bucko.koji_builder._sessions', {})
+        k = KojiBuilder('koji', persist_session=True)
+        k.ensure_logged_in()
+        assert k.session.callnum == 12
+
+    def test_resume_locked_session(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        KojiBuilder('koji', persist_session=True).ensure_logged_in()
+        path = session_file('koji')
+        with open(path) as f:
+            saved = f.read()
+        # Simulate a new bucko process while another one owns the session:
+        monkeypatch.setattr('bucko.koji_builder._sessions', {})
+        for f in koji_builder._session_locks.values():
+            f.close()
+        koji_builder._session_locks.clear()
+        with open(path + '.lock', 'a') as other:
+            fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            k = KojiBuilder('koji', persist_session=True)
+            k.ensure_logged_in()
+        assert k.session.calls['gssapi_login'] == 1
+        # We did not overwrite the other process's session:
+        with open(path) as f:
+            assert f.read() == saved
+
+    def test_login_principal(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.gssapi', None)
+        login_principal = koji_builder.login_principal
+        assert login_principal({'authtype': 'password',
+                                'user': 'bucko'}) == 'bucko'
+        assert login_principal({'authtype': 'kerberos',
+                                'principal': 'bucko@EXAMPLE.COM'}) == \
+            'bucko@EXAMPLE.COM'
+        # We cannot read the default credential cache without gssapi:
+        assert login_principal({'authtype': 'kerberos'}) is None
+
+    def test_resume_expired_session(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        KojiBuilder('koji', persist_session=True).ensure_logged_in()
+        monkeypatch.setattr(FakeClientSession, 'valid_sessions', [])
+        monkeypatch.setattr('bucko.koji_builder._sessions', {})
+        k = KojiBuilder('koji', persist_session=True)
+        k.ensure_logged_in()
+        assert k.session.logged_in is True
+        assert k.session.calls['gssapi_login'] == 1
+
+    def test_session_not_persistent(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        KojiBuilder('koji').ensure_logged_in()
+        assert not os.path.exists(session_file('koji'))
+
+    def test_resume_other_principal(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        KojiBuilder('koji', persist_session=True).ensure_logged_in()
+        # Simulate a new bucko process with a different Kerberos ticket:
+        monkeypatch.setattr('bucko.koji_builder._sessions', {})
+        monkeypatch.setattr(FakeKoji.config, 'principal', 'other@EXAMPLE.COM')
+        k = KojiBuilder('koji', persist_session=True)
+        k.ensure_logged_in()
+        assert k.session.calls['gssapi_login'] == 1
+
     def test_build_container(self, monkeypatch):
         monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
         k = KojiBuilder('koji')
@@ -101,6 +264,15 @@ class TestKojiBuilder(object):
         result = k.build_container(scm, target, 'ceph-4.0-rhel-8', [])
         assert result == 1234
 
+    def test_cancel_task(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji')
+        canceled = []
+        monkeypatch.setattr(k.session, 'cancelTask', canceled.append,
+                            raising=False)
+        k.cancel_task(1234)
+        assert canceled == [1234]
+
     def test_watch_task(self, monkeypatch, capsys):
         monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
         k = KojiBuilder('koji')
@@ -108,6 +280,26 @@ class TestKojiBuilder(object):
         out, _ = capsys.readouterr()
         assert 'Watching Koji task dummyweb/taskinfo?taskID=1234' in out
 
+    def test_watch_tasks(self, monkeypatch, capsys):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji')
+        k.session.tasks_waited[2001] = 2
+        results = list(k.watch_tasks([2000, 2001], interval=0))
+        # Task 2001 started earlier, so it finishes first:
+        assert results == [(2001, True), (2000, True)]
+        out, _ = capsys.readouterr()
+        assert 'Watching Koji task dummyweb/taskinfo?taskID=2000' in out
+        assert 'Watching Koji task dummyweb/taskinfo?taskID=2001' in out
+        assert 'Koji task 2000 is OPEN' in out
+        assert 'Koji task 2001 is CLOSED' in out
+
+    def test_task_succeeded(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji')
+        k.session.tasks_waited[3000] = 10
+        assert k.task_succeeded(3000) is True
+        assert k.task_succeeded(3001) is False
+
     def test_get_repositories(self, monkeypatch, capsys):
         monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
         k = KojiBuilder('koji')
@@ -128,6 +320,16 @@ Checking dummyweb/buildinfo?buildID=1234 for tags to untag
 Untagging dummyweb/buildinfo?buildID=1234 from ceph-candidate
 """
         assert out == expected
+        # One multicall for listTags, one multicall for untagBuild:
+        assert k.session.calls['multicall'] == 2
+
+    def test_get_task_result_memoized(self, monkeypatch, capsys):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji')
+        k.untag_task_result(12345)
+        k.get_repositories(12345, 'ceph-candidate')
+        k.get_repositories(12345, 'ceph-candidate')
+        assert k.session.calls['getTaskResult'] == 1
 
     def test_get_target_arches(self, monkeypatch, capsys):
         monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
@@ -135,3 +337,64 @@ Untagging dummyweb/buildinfo?buildID=1234 from ceph-candidate
         target = 'ceph-7.0-rhel-9-containers-candidate'
         result = k.get_target_arches(target)
         assert result == 'x86_64 ppc64le s390x'
+
+    def test_target_metadata_cached(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji')
+        target = 'ceph-7.0-rhel-9-containers-candidate'
+        k.get_target_arches(target)
+        k.build_container('git://example.com', target, 'ceph-7.0-rhel-9', [])
+        # A second KojiBuilder in this process shares the cache:
+        KojiBuilder('koji').get_target_arches(target)
+        assert k.session.calls['getBuildTarget'] == 1
+        assert k.session.calls['getTag'] == 1
+
+    def test_invalidate_metadata(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji')
+        target = 'ceph-7.0-rhel-9-containers-candidate'
+        k.get_target_arches(target)
+        k.invalidate_metadata()
+        k.get_target_arches(target)
+        assert k.session.calls['getBuildTarget'] == 2
+        assert k.session.calls['getTag'] == 2
+
+    def test_persist_metadata(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        target = 'ceph-7.0-rhel-9-containers-candidate'
+        KojiBuilder('koji', persist_metadata=True).get_target_arches(target)
+        # Simulate a new bucko process:
+        monkeypatch.setattr('bucko.koji_builder._sessions', {})
+        monkeypatch.setattr('bucko.koji_builder._metadata_caches', {})
+        k = KojiBuilder('koji', persist_metadata=True)
+        assert k.get_target_arches(target) == 'x86_64 ppc64le s390x'
+        assert k.session.calls['getBuildTarget'] == 0
+
+    def test_get_last_event(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji')
+        assert k.get_last_event() == 5000
+
+    def test_tag_changed_since(self, monkeypatch):
+        monkeypatch.setattr('bucko.koji_builder.koji', FakeKoji)
+        k = KojiBuilder('koji')
+        assert k.tag_changed_since('ceph-candidate', 4999) is True
+        assert k.tag_changed_since('ceph-candidate', 5000) is False
+        # We query the tag and its parent each time:
+        assert k.session.calls['queryHistory'] == 4
+
+
+def test_trace_calls():
+    hub = FakeHub()
+    hub.start()
+    try:
+        session = hub.session()
+        trace_calls(session)
+        session.getLastEvent()
+        with session.multicall(strict=True) as m:
+            m.getTag('ceph-8.0-rhel-9-build')
+            m.getTag('ceph-8.0-rhel-9-candidate')
+    finally:
+        hub.stop()
+    names = [span.name for span in trace.spans('koji')]
+    assert names == ['koji getLastEvent', 'koji multiCall']
@@ -1,13 +1,32 @@
 import sys
-from odcs.client.odcs import ComposeSourceTag
+from datetime import datetime, timedelta, timezone
+import time
+import pytest
+from odcs.client.odcs import AuthMech, ComposeSourceTag
 from bucko import odcs_manager
+from bucko.tests.fakeodcs import FakeOdcs
 from unittest.mock import patch
 
+SLEEP = odcs_manager.OdcsManager.sleep
+
+
+def expires_in(seconds):
+    """ Return an ODCS "time_to_expire" value this many seconds from now. """
+    expires = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    return expires.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr('bucko.odcs_manager.OdcsManager.sleep',
+                        lambda self, seconds: self.check_stopped())
+
 
 @patch('bucko.odcs_manager.odcs.ODCS.request_compose',
-       return_value={'id': 1, 'toplevel_url': 'http://example.com/'})
-@patch('bucko.odcs_manager.odcs.ODCS.wait_for_compose',
-       return_value={'state_name': 'done',
+       return_value={'id': 1, 'state_name': 'wait',
+                     'toplevel_url': 'http://example.com/'})
+@patch('bucko.odcs_manager.odcs.ODCS.get_compose',
+       return_value={'id': 1, 'state_name': 'done',
                      'result_repofile': 'https://example.com/example.repo'})
 def test_generate(mock_wait, mock_request):
     result = odcs_manager.generate('ceph-6.0-rhel-9-candidate',
@@ -23,3 +42,189 @@ def test_generate(mock_wait, mock_request):
     assert isinstance(source, ComposeSourceTag)
     kwargs = mock_request.call_args.kwargs
     assert kwargs == {'arches': ['x86_64', 'ppc64le', 's390x']}
+
+
+class FakeKojiBuilder(object):
+    def __init__(self, changed):
+        self.changed = changed
+
+    def tag_changed_since(self, tag, event):
+        return self.changed
+
+
+@patch('bucko.odcs_manager.odcs.ODCS.request_compose',
+       return_value={'id': 1, 'state_name': 'wait',
+                     'toplevel_url': 'http://example.com/'})
+@patch('bucko.odcs_manager.odcs.ODCS.get_compose',
+       return_value={'id': 1,
+                     'state_name': 'done',
+                     'result_repofile': 'https://example.com/example.repo'})
+def test_generate_records_compose(mock_wait, mock_request):
+    tag = 'ceph-6.0-rhel-9-candidate'
+    arches = 'x86_64 ppc64le s390x'
+    odcs_manager.generate(tag, arches, event=5000)
+    # The tag has not changed:
+    saved = odcs_manager.find_compose(tag, arches, FakeKojiBuilder(False))
+    assert saved == {'event': 5000,
+                     'compose_id': 1,
+                     'result_repofile': 'https://example.com/example.repo'}
+    # The tag has changed:
+    saved = odcs_manager.find_compose(tag, arches, FakeKojiBuilder(True))
+    assert saved is None
+    # Different arches:
+    saved = odcs_manager.find_compose(tag, 'x86_64', FakeKojiBuilder(False))
+    assert saved is None
+
+
+@patch('bucko.odcs_manager.odcs.ODCS.request_compose')
+@patch('bucko.odcs_manager.odcs.ODCS.get_compose',
+       return_value={'id': 1,
+                     'state_name': 'done',
+                     'time_to_expire': expires_in(20 * 60 * 60),
+                     'toplevel_url': 'http://example.com/',
+                     'result_repofile': 'https://example.com/example.repo'})
+def test_generate_reuse(mock_get, mock_request):
+    saved = {'event': 5000, 'compose_id': 1}
+    result = odcs_manager.generate('ceph-6.0-rhel-9-candidate',
+                                   'x86_64 ppc64le s390x',
+                                   event=5001, saved=saved)
+    assert result == 'https://example.com/example.repo'
+    mock_get.assert_called_once_with(1)
+    mock_request.assert_not_called()
+
+
+@patch('bucko.odcs_manager.odcs.ODCS.request_compose',
+       return_value={'id': 2, 'state_name': 'wait',
+                     'toplevel_url': 'http://example.com/'})
+@patch('bucko.odcs_manager.odcs.ODCS.get_compose',
+       side_effect=[{'id': 1, 'state_name': 'done',
+                     'time_to_expire': expires_in(10 * 60),
+                     'toplevel_url': 'http://example.com/',
+                     'result_repofile': 'https://example.com/old.repo'},
+                    {'id': 2, 'state_name': 'done',
+                     'result_repofile': 'https://example.com/new.repo'}])
+def test_generate_reuse_expiring(mock_get, mock_request):
+    saved = {'event': 5000, 'compose_id': 1}
+    result = odcs_manager.generate('ceph-6.0-rhel-9-candidate',
+                                   'x86_64 ppc64le s390x',
+                                   event=5001, saved=saved)
+    assert result == 'https://example.com/new.repo'
+    mock_request.assert_called_once()
+
+
+def test_seconds_to_expire():
+    remaining = odcs_manager.seconds_to_expire(
+        {'time_to_expire': expires_in(3600)})
+    assert 3590 < remaining <= 3600
+    assert odcs_manager.seconds_to_expire({}) is None
+    assert odcs_manager.seconds_to_expire({'time_to_expire': 'x'}) is None
+
+
+@patch('bucko.odcs_manager.odcs.ODCS.request_compose',
+       return_value={'id': 2, 'state_name': 'wait',
+                     'toplevel_url': 'http://example.com/'})
+@patch('bucko.odcs_manager.odcs.ODCS.get_compose',
+       side_effect=[{'id': 1, 'state_name': 'removed'},
+                    {'id': 2, 'state_name': 'done',
+                     'result_repofile': 'https://example.com/new.repo'}])
+def test_generate_reuse_removed(mock_get, mock_request):
+    saved = {'event': 5000, 'compose_id': 1}
+    result = odcs_manager.generate('ceph-6.0-rhel-9-candidate',
+                                   'x86_64 ppc64le s390x',
+                                   event=5001, saved=saved)
+    assert result == 'https://example.com/new.repo'
+    mock_request.assert_called_once()
+
+
+class TestOdcsManager(object):
+    @pytest.fixture
+    def server(self):
+        server = FakeOdcs(queue_polls=2, generate_polls=2)
+        server.start()
+        yield server
+        server.stop()
+
+    def manager(self, server, **kw):
+        return odcs_manager.OdcsManager(url=server.url,
+                                        auth_mech=AuthMech.Anonymous, **kw)
+
+    def test_generate(self, server):
+        manager = self.manager(server)
+        result = manager.generate('ceph-6.0-rhel-9-candidate', 'x86_64')
+        assert result == server.url + 'composes/odcs-1/odcs-1.repo'
+        assert server.composes[1]['source'] == 'ceph-6.0-rhel-9-candidate'
+        assert server.requests == {'POST': 1, 'GET': 5}
+
+    def test_concurrent(self, server):
+        manager = self.manager(server)
+        futures = [manager.submit('ceph-%d.0-rhel-9-candidate' % version,
+                                  'x86_64 s390x')
+                   for version in (6, 7, 8)]
+        results = sorted(future.result() for future in futures)
+        assert results == [server.url + 'composes/odcs-%d/odcs-%d.repo'
+                           % (id_, id_) for id_ in (1, 2, 3)]
+        assert server.requests['POST'] == 3
+
+    def test_request_up_front(self, server):
+        # One thread waits for all the composes:
+        manager = self.manager(server, max_workers=1)
+        futures = [manager.submit('ceph-%d.0-rhel-9-candidate' % version,
+                                  'x86_64')
+                   for version in (6, 7, 8)]
+        # We requested every compose before the first one finished:
+        assert server.requests['POST'] == 3
+        for future in futures:
+            future.result()
+
+    def test_concurrent_records(self, server):
+        manager = self.manager(server)
+        tags = ['ceph-%d.0-rhel-9-candidate' % version
+                for version in (6, 7, 8)]
+        futures = [manager.submit(tag, 'x86_64', event=5000) for tag in tags]
+        for future in futures:
+            future.result()
+        # Every thread's record is in the file:
+        store = odcs_manager.get_compose_store()
+        for tag in tags:
+            assert store.get(odcs_manager.compose_key(tag, 'x86_64'))
+
+    def test_backoff(self, server, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr('bucko.odcs_manager.OdcsManager.sleep',
+                            lambda self, seconds: sleeps.append(seconds))
+        manager = self.manager(server, interval=5, max_interval=12)
+        manager.generate('ceph-6.0-rhel-9-candidate', 'x86_64')
+        assert sleeps == [5, 10, 12, 12, 12]
+
+    def test_timeout(self, server):
+        manager = self.manager(server, timeout=0)
+        with pytest.raises(RuntimeError) as e:
+            manager.generate('ceph-6.0-rhel-9-candidate', 'x86_64')
+        assert 'compose 1 is still wait after 0 seconds' in str(e.value)
+
+    def test_shutdown(self, server, monkeypatch):
+        # Really sleep between polls:
+        monkeypatch.setattr('bucko.odcs_manager.OdcsManager.sleep', SLEEP)
+        manager = self.manager(server, interval=60)
+        future = manager.submit('ceph-6.0-rhel-9-candidate', 'x86_64')
+        while not server.requests.get('POST'):
+            time.sleep(0.01)
+        start = time.monotonic()
+        manager.shutdown()
+        with pytest.raises(RuntimeError) as e:
+            future.result(timeout=5)
+        assert 'stopped waiting' in str(e.value)
+        assert time.monotonic() - start < 5
+
+    def test_shutdown_pending(self, server):
+        manager = self.manager(server)
+        manager.shutdown()
+        with pytest.raises(RuntimeError):
+            manager.generate('ceph-6.0-rhel-9-candidate', 'x86_64')
+        assert server.requests.get('POST', 0) == 0
+
+    def test_failed(self, server):
+        server.final_state = 'failed'
+        manager = self.manager(server)
+        with pytest.raises(RuntimeError):
+            manager.generate('ceph-6.0-rhel-9-candidate', 'x86_64')
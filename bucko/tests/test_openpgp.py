@@ -0,0 +1,95 @@
+import bz2
+import shutil
+import subprocess
+import zlib
+import pytest
+from bucko import openpgp
+from bucko.tests.fakesignature import PAYLOAD, literal, message, old_packet
+
+
+def raw_deflate(data):
+    compressor = zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestLiteralData(object):
+    def test_zlib(self):
+        assert openpgp.literal_data(message()) == PAYLOAD
+
+    def test_zip(self):
+        data = message(raw_deflate, openpgp.ZIP)
+        assert openpgp.literal_data(data) == PAYLOAD
+
+    def test_bzip2(self):
+        data = message(bz2.compress, openpgp.BZIP2)
+        assert openpgp.literal_data(data) == PAYLOAD
+
+    def test_uncompressed(self):
+        data = message(lambda inner: inner, openpgp.UNCOMPRESSED)
+        assert openpgp.literal_data(data) == PAYLOAD
+
+    def test_partial_body_lengths(self):
+        body = literal(PAYLOAD)
+        # One 4-byte partial body, and then the rest:
+        rest = body[4:]
+        data = (bytes([0xc0 | openpgp.LITERAL_DATA, 0xe2]) + body[:4] +
+                bytes([255]) + len(rest).to_bytes(4, 'big') + rest)
+        assert openpgp.literal_data(data) == PAYLOAD
+
+    def test_no_literal_data(self):
+        with pytest.raises(ValueError, match='no literal data'):
+            openpgp.literal_data(old_packet(2, b'signature'))
+
+    def test_truncated(self):
+        with pytest.raises(ValueError, match='truncated'):
+            openpgp.literal_data(message()[:-5])
+
+    def test_not_openpgp(self):
+        with pytest.raises(ValueError, match='invalid OpenPGP'):
+            openpgp.literal_data(b'{"json": true}')
+
+
+def test_parse_status():
+    output = '\n'.join([
+        '[GNUPG:] FILE_START 1 signature-0',
+        '[GNUPG:] NEWSIG',
+        '[GNUPG:] GOODSIG 4B8EC33C8013A835 bucko test <bucko@example.com>',
+        '[GNUPG:] VALIDSIG A1EA5EC4C5AA91CF7D04CAFD4B8EC33C8013A835',
+        '[GNUPG:] FILE_DONE',
+        '[GNUPG:] FILE_START 1 signature-1',
+        '[GNUPG:] NODATA 1',
+        '[GNUPG:] FILE_DONE',
+        '[GNUPG:] FILE_START 1 signature-2',
+        '[GNUPG:] NEWSIG',
+        '[GNUPG:] BADSIG 4B8EC33C8013A835 bucko test <bucko@example.com>',
+        '[GNUPG:] FILE_DONE',
+    ])
+    assert openpgp.parse_status(output, 3) == [True, False, False]
+    with pytest.raises(RuntimeError):
+        openpgp.parse_status(output, 4)
+
+
+@pytest.mark.skipif(not shutil.which('gpg'), reason='requires gpg')
+class TestVerify(object):
+    @pytest.fixture
+    def signed(self, tmpdir, monkeypatch):
+        home = tmpdir.mkdir('gnupg')
+        home.chmod(0o700)
+        monkeypatch.setenv('GNUPGHOME', str(home))
+        subprocess.check_call(['gpg', '--batch', '--quiet', '--passphrase',
+                               '', '--quick-gen-key', 'bucko test', 'ed25519',
+                               'sign', '0'], stderr=subprocess.DEVNULL)
+        p = subprocess.Popen(['gpg', '--batch', '--sign'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+        return p.communicate(input=PAYLOAD)[0]
+
+    def test_literal_data(self, signed):
+        assert openpgp.literal_data(signed) == PAYLOAD
+
+    def test_verify(self, signed):
+        assert openpgp.verify([signed, message(), signed]) == [True, False,
+                                                               True]
+
+    def test_verify_nothing(self):
+        assert openpgp.verify([]) == []
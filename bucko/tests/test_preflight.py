@@ -0,0 +1,160 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+import pytest
+from bucko import preflight
+from bucko.tests.httpserver import ThreadingHTTPServer
+
+
+REPO = """
+[rhel-9-baseos]
+name = RHEL 9 BaseOS
+baseurl = {url}/rhel-9/baseos/$basearch/os
+gpgcheck = 0
+
+[rhel-9-appstream]
+name = RHEL 9 AppStream
+baseurl = {url}/rhel-9/appstream/x86_64/os
+gpgcheck = 0
+
+[rhel-9-disabled]
+baseurl = {url}/rhel-9/disabled
+enabled = 0
+"""
+
+
+class RepoServer(object):
+    """ Serve .repo files and repomd.xml files from a dict of paths. """
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append((self.command, self.path))
+                body = server.files.get(self.path)
+                status = 404 if body is None else 200
+                body = body or b''
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            do_HEAD = do_GET
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://%s:%d' % (host, port)
+
+    def add_repository(self, path):
+        self.files[path + '/repodata/repomd.xml'] = b'<repomd/>'
+
+
+@pytest.fixture
+def server():
+    server = RepoServer()
+    server.start()
+    server.files['/rhel-9.repo'] = REPO.format(url=server.url).encode()
+    server.add_repository('/rhel-9/baseos/x86_64/os')
+    server.add_repository('/rhel-9/baseos/ppc64le/os')
+    server.add_repository('/rhel-9/appstream/x86_64/os')
+    yield server
+    server.stop()
+
+
+def test_repo_baseurls():
+    text = REPO.format(url='http://example.com')
+    assert preflight.repo_baseurls(text, ['x86_64', 'ppc64le']) == [
+        ('rhel-9-baseos', 'http://example.com/rhel-9/baseos/x86_64/os'),
+        ('rhel-9-baseos', 'http://example.com/rhel-9/baseos/ppc64le/os'),
+        ('rhel-9-appstream', 'http://example.com/rhel-9/appstream/x86_64/os'),
+    ]
+
+
+def test_repo_baseurls_mirrorlist():
+    text = REPO.format(url='http://example.com') + """
+[epel]
+mirrorlist = https://mirrors.example.com/mirrorlist?repo=epel-9
+
+[fedora]
+metalink = https://mirrors.example.com/metalink?repo=fedora-40
+"""
+    baseurls = preflight.repo_baseurls(text, ['x86_64'])
+    assert [section for (section, _) in baseurls] == [
+        'rhel-9-baseos',
+        'rhel-9-appstream',
+    ]
+
+
+def test_repo_baseurls_invalid():
+    with pytest.raises(ValueError):
+        preflight.repo_baseurls('<html>Not Found</html>', ['x86_64'])
+
+
+class TestPreflight(object):
+    def test_check(self, server):
+        checked = preflight.check([server.url + '/rhel-9.repo'],
+                                  ['x86_64', 'ppc64le'])
+        assert sorted(checked) == sorted([
+            server.url + '/rhel-9/baseos/x86_64/os/repodata/repomd.xml',
+            server.url + '/rhel-9/baseos/ppc64le/os/repodata/repomd.xml',
+            server.url + '/rhel-9/appstream/x86_64/os/repodata/repomd.xml',
+        ])
+        heads = [path for (method, path) in server.requests
+                 if method == 'HEAD']
+        assert len(heads) == 3
+
+    def test_shared_baseurls(self, server):
+        server.files['/other.repo'] = server.files['/rhel-9.repo']
+        repo_urls = [server.url + '/rhel-9.repo', server.url + '/other.repo']
+        checked = preflight.check(repo_urls, ['x86_64'])
+        assert len(checked) == 2
+
+    def test_combined_report(self, server):
+        del server.files['/rhel-9/baseos/ppc64le/os/repodata/repomd.xml']
+        repo_urls = [server.url + '/rhel-9.repo', server.url + '/gone.repo']
+        with pytest.raises(RuntimeError) as e:
+            preflight.check(repo_urls, ['x86_64', 'ppc64le'])
+        message = str(e.value)
+        assert '/gone.repo: 404' in message
+        assert '[rhel-9-baseos]: 404' in message
+        assert '/ppc64le/os/repodata/repomd.xml' in message
+
+    def test_no_repositories(self, server):
+        server.files['/empty.repo'] = b'[main]\ngpgcheck = 0\n'
+        with pytest.raises(RuntimeError) as e:
+            preflight.check([server.url + '/empty.repo'])
+        assert 'no enabled repositories' in str(e.value)
+
+    def test_skip_mirrorlist(self, server):
+        text = '[epel]\nmirrorlist = %s/mirrorlist\n' % server.url
+        server.files['/epel.repo'] = text.encode()
+        assert preflight.check([server.url + '/epel.repo']) == []
+
+    def test_skip_non_http(self):
+        assert preflight.check(['file:///tmp/test.repo']) == []
+
+    def test_skip_unknown_variables(self, server):
+        text = '[epel]\nbaseurl = %s/epel/$releasever\n' % server.url
+        server.files['/epel.repo'] = text.encode()
+        assert preflight.check([server.url + '/epel.repo']) == []
@@ -1,5 +1,122 @@
+import base64
+import hashlib
+import io
+import json
+import pytest
+from urllib.parse import parse_qs, urlparse
 import requests
-from bucko.registry import Registry
+from bucko.blob_cache import BlobCache
+from bucko.registry import MANIFEST_LIST, MANIFEST_V2
+from bucko.registry import Registry, platform_matches, tag_sort_key
+from bucko.tests.fakesignature import PAYLOAD, message
+from bucko.tokens import TokenCache
+
+REALM = 'https://registry.example.com/v2/auth'
+LOOKASIDE = 'https://sigstore.example.com/containers/sigstore'
+
+
+def make_response(status, data=None, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    if data is not None:
+        response._content = json.dumps(data).encode()
+    return response
+
+
+class DroppedConnection(io.BytesIO):
+    """ Response body that drops the connection after a few bytes. """
+    def read(self, size=-1):
+        if self.tell() >= 4:
+            raise requests.exceptions.ConnectionError('connection dropped')
+        return super(DroppedConnection, self).read(min(size, 4))
+
+
+class FakeSession(object):
+    """
+    Dummy requests.Session for a registry that requires Bearer tokens.
+    """
+    def __init__(self):
+        self.headers = {}
+        self.urls = []
+        self.issued = 0
+        self.scopes = []
+        self.rejected = set()
+        self.content = {}  # url -> bytes
+        self.tags = {}  # repository -> list of tags
+        self.ranges = True  # honor Range requests
+        self.drops = 0  # number of streams that drop the connection
+
+    def request(self, method, url, headers=None, stream=False, **kwargs):
+        if method == 'GET':
+            r = self.get(url, headers)
+            if stream and r._content:
+                body = DroppedConnection if self.drops else io.BytesIO
+                self.drops = max(self.drops - 1, 0)
+                r.raw = body(r._content)
+                r._content = False
+            return r
+        self.urls.append('%s %s' % (method, url))
+        r = self.respond(url, headers)
+        r._content = b''
+        return r
+
+    def get(self, url, headers=None, params=None, auth=None):
+        self.urls.append(url)
+        return self.respond(url, headers, params)
+
+    def respond(self, url, headers=None, params=None):
+        if url.startswith(LOOKASIDE):
+            if url not in self.content:
+                return make_response(404)
+            r = make_response(200)
+            r._content = self.content[url]
+            return r
+        if url == REALM:
+            self.issued += 1
+            self.scopes.append([value for (key, value) in params
+                                if key == 'scope'])
+            return make_response(200, {'token': 'token-%d' % self.issued,
+                                       'expires_in': 300})
+        headers = headers or {}
+        authorization = headers.get('Authorization', '')
+        if authorization in self.rejected:
+            return make_response(401)
+        if not authorization.startswith('Bearer token-'):
+            www_auth = 'Bearer realm="%s"' % REALM
+            return make_response(401, headers={'WWW-Authenticate': www_auth})
+        if '/tags/list?' in url:
+            return self.tags_list(url)
+        if url in self.content:
+            content = self.content[url]
+            digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+            r = make_response(200, headers={'Docker-Content-Digest': digest})
+            r._content = content
+            r.url = url
+            if 'Range' in headers and self.ranges:
+                start = int(headers['Range'][len('bytes='):-1])
+                r.status_code = 206 if start < len(content) else 416
+                r._content = content[start:]
+            return r
+        return make_response(200, {'url': url})
+
+    def tags_list(self, url):
+        parsed = urlparse(url)
+        repository = parsed.path[len('/v2/'):-len('/tags/list')]
+        query = parse_qs(parsed.query)
+        size = int(query['n'][0])
+        tags = self.tags[repository]
+        start = 0
+        if 'last' in query:
+            start = tags.index(query['last'][0]) + 1
+        page = tags[start:start + size]
+        headers = {}
+        if start + size < len(tags):
+            link = '/v2/%s/tags/list?n=%d&last=%s' % (repository, size,
+                                                      page[-1])
+            headers['Link'] = '<%s>; rel="next"' % link
+        return make_response(200, {'name': repository, 'tags': page},
+                             headers)
 
 
 def test_init():
@@ -29,3 +146,553 @@ def test_find_realm_service_icr():
     realm, service = registry.find_realm_service(response)
     assert realm == 'https://registry.example.com/oauth/token'
     assert service == 'registry'
+
+
+class TestTokens(object):
+    def registry(self, token_cache=None):
+        registry = Registry('http://registry.example.com', token_cache)
+        registry.session = FakeSession()
+        return registry
+
+    def test_first_request(self):
+        registry = self.registry()
+        registry.manifest('rhel7', 'latest')
+        assert registry.session.urls == [
+            'http://registry.example.com/v2/rhel7/manifests/latest',
+            REALM,
+            'http://registry.example.com/v2/rhel7/manifests/latest',
+        ]
+
+    def test_known_realm(self):
+        registry = self.registry()
+        registry.manifest('rhel7', 'latest')
+        registry.session.urls = []
+        # We request a token for a new repository up front:
+        registry.manifest('rhel8', 'latest')
+        assert registry.session.urls == [
+            REALM,
+            'http://registry.example.com/v2/rhel8/manifests/latest',
+        ]
+
+    def test_cached_token(self):
+        registry = self.registry()
+        registry.manifest('rhel7', 'latest')
+        registry.session.urls = []
+        # A second Registry instance shares our token cache:
+        other = self.registry()
+        other.manifest('rhel7', 'latest')
+        assert other.session.urls == [
+            'http://registry.example.com/v2/rhel7/manifests/latest',
+        ]
+
+    def test_expired_token(self):
+        registry = self.registry()
+        registry.manifest('rhel7', 'latest')
+        # Expire our token:
+        registry.tokens.set(registry.host, 'rhel7', 'token-1', 0)
+        registry.session.urls = []
+        registry.manifest('rhel7', 'latest')
+        assert registry.session.urls == [
+            REALM,
+            'http://registry.example.com/v2/rhel7/manifests/latest',
+        ]
+
+    def test_persistent_tokens(self, tmpdir):
+        path = str(tmpdir.join('tokens.json'))
+        self.registry(TokenCache(path)).manifest('rhel7', 'latest')
+        registry = self.registry(TokenCache(path))
+        registry.manifest('rhel7', 'latest')
+        assert registry.session.urls == [
+            'http://registry.example.com/v2/rhel7/manifests/latest',
+        ]
+
+    def test_prefetch_tokens(self):
+        registry = self.registry()
+        repositories = ['rhel7', 'rhel8', 'rhel7', 'ubi9/ubi']
+        registry.prefetch_tokens(repositories)
+        # One /v2/ request to find the realm, and one token request:
+        assert registry.session.urls == ['http://registry.example.com/v2/',
+                                         REALM]
+        assert registry.session.scopes == [[
+            'repository:rhel7:pull',
+            'repository:rhel8:pull',
+            'repository:ubi9/ubi:pull',
+        ]]
+        registry.session.urls = []
+        for repository in repositories:
+            registry.manifest(repository, 'latest')
+        assert REALM not in registry.session.urls
+
+    def test_prefetch_tokens_batches(self, monkeypatch):
+        monkeypatch.setattr('bucko.registry.MAX_SCOPES', 2)
+        registry = self.registry()
+        registry.prefetch_tokens(['a', 'b', 'c', 'd', 'e'])
+        assert [len(scopes) for scopes in registry.session.scopes] == [2, 2, 1]
+
+    def test_prefetch_cached_tokens(self):
+        registry = self.registry()
+        registry.manifest('rhel7', 'latest')
+        registry.session.urls = []
+        registry.prefetch_tokens(['rhel7'])
+        assert registry.session.urls == []
+
+    def test_rejected_token(self):
+        registry = self.registry()
+        registry.prefetch_tokens(['rhel7', 'rhel8'])
+        registry.session.rejected.add('Bearer token-1')
+        registry.session.urls = []
+        registry.manifest('rhel7', 'latest')
+        assert registry.session.urls == [
+            'http://registry.example.com/v2/rhel7/manifests/latest',
+            REALM,
+            'http://registry.example.com/v2/rhel7/manifests/latest',
+        ]
+        assert registry.session.scopes[-1] == ['repository:rhel7:pull']
+
+
+class TestCredentials(object):
+    def test_load_credentials(self, tmpdir, monkeypatch):
+        authfile = tmpdir.join('auth.json')
+        auth = base64.b64encode(b'bucko:secret').decode()
+        authfile.write(json.dumps({'auths': {
+            'registry.example.com': {'auth': auth}}}))
+        monkeypatch.setenv('REGISTRY_AUTH_FILE', str(authfile))
+        registry = Registry('http://registry.example.com')
+        assert registry.load_credentials('registry.example.com') == [
+            'bucko', 'secret']
+        assert registry.load_credentials('other.example.com') is None
+        assert registry.auth.username == 'bucko'
+
+    def test_missing_authfile(self, tmpdir, monkeypatch):
+        monkeypatch.setenv('REGISTRY_AUTH_FILE', str(tmpdir.join('missing')))
+        registry = Registry('http://registry.example.com')
+        assert registry.auth is None
+
+
+class TestBlobCache(object):
+    MANIFEST = json.dumps({'config': {'digest': 'sha256:' + 'c' * 64}})
+
+    def registry(self, tmpdir):
+        blob_cache = BlobCache(str(tmpdir.join('blobs')))
+        registry = Registry('http://registry.example.com',
+                            blob_cache=blob_cache)
+        registry.session = FakeSession()
+        content = self.MANIFEST.encode()
+        digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+        base = 'http://registry.example.com/v2/rhel7/manifests/'
+        registry.session.content[base + 'latest'] = content
+        registry.session.content[base + digest] = content
+        return registry
+
+    def test_tag(self, tmpdir):
+        registry = self.registry(tmpdir)
+        manifest = registry.manifest('rhel7', 'latest')
+        assert manifest == json.loads(self.MANIFEST)
+        registry.session.urls = []
+        assert registry.manifest('rhel7', 'latest') == manifest
+        # We only revalidate the tag:
+        assert registry.session.urls == [
+            'HEAD http://registry.example.com/v2/rhel7/manifests/latest',
+        ]
+
+    def test_digest(self, tmpdir):
+        registry = self.registry(tmpdir)
+        content = self.MANIFEST.encode()
+        digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+        registry.manifest('rhel7', digest)
+        registry.session.urls = []
+        registry.manifest('rhel7', digest)
+        assert registry.session.urls == []
+
+    def test_blob(self, tmpdir):
+        registry = self.registry(tmpdir)
+        content = json.dumps({'config': {'Labels': {}}}).encode()
+        digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+        url = 'http://registry.example.com/v2/rhel7/blobs/' + digest
+        registry.session.content[url] = content
+        assert registry.blob('rhel7', digest) == {'config': {'Labels': {}}}
+        registry.session.urls = []
+        assert registry.blob('rhel7', digest) == {'config': {'Labels': {}}}
+        assert registry.session.urls == []
+
+
+class TestBlobDownload(object):
+    CONTENT = b'0123456789' * 3
+    DIGEST = 'sha256:' + hashlib.sha256(CONTENT).hexdigest()
+    URL = 'http://registry.example.com/v2/rhel7/blobs/' + DIGEST
+
+    @pytest.fixture
+    def registry(self):
+        registry = Registry('http://registry.example.com')
+        registry.session = FakeSession()
+        registry.session.content[self.URL] = self.CONTENT
+        return registry
+
+    def test_iter_blob(self, registry):
+        chunks = list(registry.iter_blob('rhel7', self.DIGEST, chunk_size=8))
+        assert b''.join(chunks) == self.CONTENT
+        assert max(len(chunk) for chunk in chunks) == 8
+
+    def test_iter_blob_offset(self, registry):
+        chunks = registry.iter_blob('rhel7', self.DIGEST, offset=25)
+        assert b''.join(chunks) == self.CONTENT[25:]
+
+    def test_iter_blob_mismatch(self, registry):
+        registry.session.content[self.URL] = b'corrupt'
+        with pytest.raises(RuntimeError, match='digest mismatch'):
+            list(registry.iter_blob('rhel7', self.DIGEST))
+
+    def test_download_blob(self, registry, tmpdir):
+        path = str(tmpdir.join('layer'))
+        registry.download_blob('rhel7', self.DIGEST, path)
+        assert open(path, 'rb').read() == self.CONTENT
+        assert not tmpdir.join('layer.part').exists()
+
+    def test_resume_partial_file(self, registry, tmpdir):
+        path = str(tmpdir.join('layer'))
+        tmpdir.join('layer.part').write_binary(self.CONTENT[:12])
+        registry.download_blob('rhel7', self.DIGEST, path)
+        assert open(path, 'rb').read() == self.CONTENT
+
+    def test_resume_complete_file(self, registry, tmpdir):
+        path = str(tmpdir.join('layer'))
+        tmpdir.join('layer.part').write_binary(self.CONTENT)
+        registry.download_blob('rhel7', self.DIGEST, path)
+        assert open(path, 'rb').read() == self.CONTENT
+
+    def test_resume_dropped_connection(self, registry, tmpdir):
+        registry.session.drops = 2
+        path = str(tmpdir.join('layer'))
+        registry.download_blob('rhel7', self.DIGEST, path, chunk_size=4)
+        assert open(path, 'rb').read() == self.CONTENT
+
+    def test_too_many_dropped_connections(self, registry, tmpdir):
+        registry.session.drops = 10
+        path = str(tmpdir.join('layer'))
+        with pytest.raises(requests.exceptions.ConnectionError):
+            registry.download_blob('rhel7', self.DIGEST, path, chunk_size=4)
+
+    def test_no_range_support(self, registry, tmpdir):
+        registry.session.ranges = False
+        path = str(tmpdir.join('layer'))
+        tmpdir.join('layer.part').write_binary(self.CONTENT[:12])
+        registry.download_blob('rhel7', self.DIGEST, path)
+        assert open(path, 'rb').read() == self.CONTENT
+
+    def test_no_range_support_dropped_connection(self, registry, tmpdir):
+        registry.session.ranges = False
+        registry.session.drops = 2
+        path = str(tmpdir.join('layer'))
+        tmpdir.join('layer.part').write_binary(self.CONTENT[:12])
+        registry.download_blob('rhel7', self.DIGEST, path, chunk_size=4)
+        assert open(path, 'rb').read() == self.CONTENT
+
+    def test_download_hashes_once(self, registry, tmpdir, monkeypatch):
+        modes = []
+
+        def fake_open(name, mode='r', *args, **kwargs):
+            modes.append(mode)
+            return open(name, mode, *args, **kwargs)
+        monkeypatch.setattr('bucko.registry.open', fake_open, raising=False)
+        registry.session.drops = 1
+        path = str(tmpdir.join('layer'))
+        registry.download_blob('rhel7', self.DIGEST, path, chunk_size=4)
+        assert open(path, 'rb').read() == self.CONTENT
+        # We never read the .part file back:
+        assert modes == ['ab', 'ab']
+
+    def test_download_mismatch(self, registry, tmpdir):
+        registry.session.content[self.URL] = b'corrupt'
+        path = str(tmpdir.join('layer'))
+        with pytest.raises(RuntimeError, match='digest mismatch'):
+            registry.download_blob('rhel7', self.DIGEST, path)
+        assert not tmpdir.join('layer').exists()
+        assert not tmpdir.join('layer.part').exists()
+
+
+class TestDigest(object):
+    LIST = json.dumps({
+        'mediaType': MANIFEST_LIST,
+        'manifests': [
+            {'digest': 'sha256:amd64',
+             'platform': {'architecture': 'amd64', 'os': 'linux'}},
+            {'digest': 'sha256:arm64',
+             'platform': {'architecture': 'arm64', 'os': 'linux',
+                          'variant': 'v8'}},
+        ],
+    }).encode()
+    URL = 'http://registry.example.com/v2/ceph/manifests/latest'
+
+    @pytest.fixture
+    def registry(self):
+        registry = Registry('http://registry.example.com')
+        registry.session = FakeSession()
+        registry.session.content[self.URL] = self.LIST
+        return registry
+
+    def test_head(self, registry):
+        digest = registry.digest('ceph', 'latest')
+        assert digest == 'sha256:' + hashlib.sha256(self.LIST).hexdigest()
+        # We never GET the manifest:
+        assert self.URL not in registry.session.urls
+
+    def test_platform(self, registry):
+        assert registry.digest('ceph', 'latest', 'amd64') == 'sha256:amd64'
+        assert registry.digest('ceph', 'latest',
+                               'linux/arm64/v8') == 'sha256:arm64'
+
+    def test_missing_platform(self, registry):
+        with pytest.raises(RuntimeError, match='no s390x manifest'):
+            registry.digest('ceph', 'latest', 's390x')
+
+    def test_single_arch(self, registry):
+        content = json.dumps({'mediaType': MANIFEST_V2}).encode()
+        registry.session.content[self.URL] = content
+        digest = registry.digest('ceph', 'latest', 'amd64')
+        assert digest == 'sha256:' + hashlib.sha256(content).hexdigest()
+
+
+def test_platform_matches():
+    platform = {'architecture': 'arm64', 'os': 'linux', 'variant': 'v8'}
+    assert platform_matches(platform, 'arm64')
+    assert platform_matches(platform, 'linux/arm64')
+    assert platform_matches(platform, 'linux/arm64/v8')
+    assert not platform_matches(platform, 'amd64')
+    assert not platform_matches(platform, 'windows/arm64')
+    assert not platform_matches(platform, 'linux/arm64/v7')
+
+
+def test_tag_sort_key():
+    tags = ['7-10', 'latest', '7-2', '6-1', '7-1']
+    assert sorted(tags, key=tag_sort_key) == [
+        '6-1', '7-1', '7-2', '7-10', 'latest']
+
+
+class TestLookasideSignatures(object):
+    DIGEST = 'sha256:' + 'a' * 64
+
+    def registry(self, count):
+        registry = Registry('http://registry.example.com')
+        registry.session = FakeSession()
+        for index in range(1, count + 1):
+            url = '%s/ceph@%s/signature-%d' % (LOOKASIDE, 'sha256=' + 'a' * 64,
+                                               index)
+            registry.session.content[url] = b'signature %d' % index
+        return registry
+
+    def signatures(self, registry):
+        return registry.lookaside_signatures(LOOKASIDE, 'ceph', self.DIGEST)
+
+    def test_none(self):
+        registry = self.registry(0)
+        assert self.signatures(registry) == []
+        # At most one window of requests:
+        assert len(registry.session.urls) <= 4
+
+    def test_window(self):
+        registry = self.registry(6)
+        signatures = self.signatures(registry)
+        assert signatures == [b'signature %d' % i for i in range(1, 7)]
+        # At most two windows of four requests:
+        assert len(registry.session.urls) <= 8
+
+    def test_max_signatures(self):
+        registry = self.registry(30)
+        assert len(self.signatures(registry)) == 24
+
+    def test_signatures(self, monkeypatch):
+        registry = self.registry(2)
+        monkeypatch.setattr(Registry, 'lookaside', LOOKASIDE)
+        monkeypatch.setattr(registry, 'digest', lambda *a, **kw: self.DIGEST)
+        assert registry.signatures('ceph:latest') == [b'signature 1',
+                                                      b'signature 2']
+
+    def test_signature_payloads(self, monkeypatch):
+        registry = self.registry(0)
+        monkeypatch.setattr(registry, 'signatures',
+                            lambda image: [message(), message()])
+        payloads = registry.signature_payloads('ceph:latest')
+        assert payloads == [json.loads(PAYLOAD), json.loads(PAYLOAD)]
+        assert registry.signature_references('ceph:latest') == [
+            'registry.example.com/ceph:latest',
+            'registry.example.com/ceph:latest',
+        ]
+
+    def test_verify_signature_payloads(self, monkeypatch):
+        registry = self.registry(0)
+        monkeypatch.setattr(registry, 'signatures',
+                            lambda image: [message(), message()])
+        monkeypatch.setattr('bucko.openpgp.verify',
+                            lambda signatures: [True, False])
+        with pytest.raises(RuntimeError, match='1 bad signature'):
+            registry.signature_payloads('ceph:latest', verify=True)
+
+
+class TestSignatureAudit(object):
+    PLATFORMS = {'amd64': 'a', 'ppc64le': 'b', 's390x': 'c', 'arm64/v8': 'd'}
+    URL = 'http://registry.example.com/v2/ceph/manifests/latest'
+
+    @pytest.fixture
+    def registry(self, monkeypatch):
+        registry = Registry('http://registry.example.com')
+        registry.session = FakeSession()
+        monkeypatch.setattr(Registry, 'lookaside', LOOKASIDE)
+        manifests = []
+        for name, char in self.PLATFORMS.items():
+            platform = {'architecture': name.split('/')[0], 'os': 'linux'}
+            if '/' in name:
+                platform['variant'] = name.split('/')[1]
+            digest = 'sha256:' + char * 64
+            manifests.append({'digest': digest, 'platform': platform})
+            url = '%s/ceph@%s/signature-1' % (LOOKASIDE,
+                                              digest.replace(':', '='))
+            registry.session.content[url] = message()
+        content = json.dumps({'mediaType': MANIFEST_LIST,
+                              'manifests': manifests}).encode()
+        registry.session.content[self.URL] = content
+        return registry
+
+    def test_platform_digests(self, registry):
+        digests = registry.platform_digests('ceph', 'latest')
+        assert list(digests) == ['amd64', 'ppc64le', 's390x', 'arm64/v8']
+        assert digests['s390x'] == 'sha256:' + 'c' * 64
+
+    def test_signature_audit(self, registry):
+        registry.prefetch_tokens(['ceph'])
+        audit = registry.signature_audit('ceph:latest')
+        reference = 'registry.example.com/ceph:latest'
+        assert audit == {name: [reference] for name in self.PLATFORMS}
+        # We fetch the manifest list just once:
+        assert registry.session.urls.count(self.URL) == 1
+
+    def test_unsigned_platform(self, registry):
+        url = '%s/ceph@sha256=%s/signature-1' % (LOOKASIDE, 'b' * 64)
+        del registry.session.content[url]
+        audit = registry.signature_audit('ceph:latest')
+        assert audit['ppc64le'] == []
+        assert audit['amd64'] == ['registry.example.com/ceph:latest']
+
+    def test_single_arch(self, registry):
+        config = json.dumps({'architecture': 'amd64'}).encode()
+        config_digest = 'sha256:' + hashlib.sha256(config).hexdigest()
+        url = 'http://registry.example.com/v2/ceph/blobs/' + config_digest
+        registry.session.content[url] = config
+        content = json.dumps({'mediaType': MANIFEST_V2,
+                              'config': {'digest': config_digest}}).encode()
+        registry.session.content[self.URL] = content
+        digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+        assert registry.platform_digests('ceph', 'latest') == {
+            'amd64': digest}
+
+
+class TestBuilds(object):
+    def config(self, version):
+        return json.dumps({'config': {'Labels': {
+            'com.redhat.component': 'rhceph-container',
+            'version': version,
+            'release': '1'}}}).encode()
+
+    @pytest.fixture
+    def registry(self):
+        registry = Registry('http://registry.example.com', pool_size=4)
+        registry.session = FakeSession()
+        base = 'http://registry.example.com/v2/'
+        tags = {'ceph:5': '5', 'ceph:latest': '7', 'ceph:7': '7',
+                'rhceph/ceph:7': '7'}
+        for image, version in tags.items():
+            config = self.config(version)
+            digest = 'sha256:' + hashlib.sha256(config).hexdigest()
+            repository, tag = image.split(':')
+            url = '%s%s/blobs/%s' % (base, repository, digest)
+            registry.session.content[url] = config
+            manifest = json.dumps({'config': {'digest': digest}}).encode()
+            url = '%s%s/manifests/%s' % (base, repository, tag)
+            registry.session.content[url] = manifest
+        return registry
+
+    def test_builds(self, registry):
+        images = ['ceph:latest', 'ceph:5', 'rhceph/ceph:7', 'ceph:latest']
+        builds = registry.builds(images)
+        assert [build.nvr for build in builds] == [
+            'rhceph-container-7-1',
+            'rhceph-container-5-1',
+            'rhceph-container-7-1',
+            'rhceph-container-7-1',
+        ]
+
+    def test_requests(self, registry):
+        registry.builds(['ceph:latest', 'ceph:7', 'ceph:5', 'rhceph/ceph:7'])
+        urls = registry.session.urls
+        # One token for both repositories:
+        assert urls.count(REALM) == 1
+        # Three images share one config blob:
+        assert len([url for url in urls if '/blobs/' in url]) == 2
+        # One manifest request per image:
+        assert len([url for url in urls if '/manifests/' in url]) == 4
+
+    def test_build(self, registry):
+        assert registry.build('ceph:5').nvr == 'rhceph-container-5-1'
+
+
+class TestTags(object):
+    @pytest.fixture
+    def registry(self):
+        registry = Registry('http://registry.example.com')
+        registry.session = FakeSession()
+        registry.session.tags['ceph'] = ['5', '7-1', '7-2', '7-10', 'latest']
+        base = 'http://registry.example.com/v2/ceph/'
+        times = {'5': '2024-01-01T00:00:00Z',
+                 '7-1': '2024-02-01T00:00:00.5Z',
+                 '7-2': '2024-03-01T00:00:00.25Z',
+                 '7-10': '2024-03-01T00:00:00.125000000Z',
+                 'latest': '2024-03-01T00:00:00.25Z'}
+        for tag, time in times.items():
+            config = json.dumps({'created': time}).encode()
+            digest = 'sha256:' + hashlib.sha256(config).hexdigest()
+            registry.session.content[base + 'blobs/' + digest] = config
+            manifest = json.dumps({'config': {'digest': digest}}).encode()
+            registry.session.content[base + 'manifests/' + tag] = manifest
+        return registry
+
+    def test_tags(self, registry):
+        tags = list(registry.tags('ceph', page_size=2))
+        assert tags == ['5', '7-1', '7-2', '7-10', 'latest']
+        pages = [url for url in registry.session.urls if 'tags/list' in url]
+        # One unauthenticated request, and then three pages:
+        assert len(pages) == 4
+
+    def test_tags_lazy(self, registry):
+        tags = registry.tags('ceph', page_size=2)
+        assert next(tags) == '5'
+        pages = [url for url in registry.session.urls if 'tags/list' in url]
+        assert len(pages) == 2
+
+    def test_newest_tag(self, registry):
+        assert registry.newest_tag('ceph', '7-*', page_size=2) == '7-2'
+
+    def test_newest_tag_candidates(self, registry, caplog):
+        # "7-10" and "7-2" are the highest tags, and "7-2" is newer:
+        assert registry.newest_tag('ceph', '7-*', candidates=2) == '7-2'
+        assert 'not comparing the creation times of 7-1' in caplog.text
+        manifests = [url for url in registry.session.urls
+                     if '/manifests/' in url]
+        assert sorted(manifests) == [
+            'http://registry.example.com/v2/ceph/manifests/7-10',
+            'http://registry.example.com/v2/ceph/manifests/7-2',
+        ]
+
+    def test_newest_tag_all_candidates(self, registry):
+        # By default, we compare every matching tag:
+        assert registry.newest_tag('ceph', '*') == '7-2'
+        manifests = [url for url in registry.session.urls
+                     if '/manifests/' in url]
+        assert len(manifests) == 5
+
+    def test_newest_tag_no_match(self, registry):
+        with pytest.raises(RuntimeError, match='no tags in ceph match 8-*'):
+            registry.newest_tag('ceph', '8-*')
+
+    def test_resolve_image(self, registry):
+        assert registry.resolve_image('ceph:7-*') == 'ceph:7-2'
+        assert registry.resolve_image('ceph:7-1') == 'ceph:7-1'
+        assert registry.session.urls.count(REALM) == 1
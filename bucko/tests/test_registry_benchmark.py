@@ -0,0 +1,113 @@
+import time
+import pytest
+from bucko.blob_cache import BlobCache
+from bucko.registry import Registry
+from bucko.tests.fakeregistry import FakeRegistry
+from bucko.tokens import TokenCache
+
+"""
+Count registry requests and wall time for Registry operations.
+
+These budgets guard against regressions in the number of registry requests.
+Run "py.test -s bucko/tests/test_registry_benchmark.py" to see the report.
+"""
+
+IMAGES = ['ceph/image-%d' % n for n in range(20)]
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = FakeRegistry(latency=0.01, page_size=50)
+    server.start()
+    server.add_image('ceph/rhceph-7', 'latest', version='7', signatures=2)
+    for repository in IMAGES:
+        server.add_image(repository, 'latest')
+    for n in range(120):
+        server.add_image('ceph/many-tags', '7-%d' % n, version='7',
+                         arches=('amd64',))
+    yield server
+    print('')
+    print(server.report())
+    server.stop()
+
+
+@pytest.fixture
+def registry(server, monkeypatch):
+    monkeypatch.setattr(Registry, 'lookaside', None)
+    return Registry(server.url, TokenCache())
+
+
+class TestRegistryBenchmark(object):
+    def test_build(self, server, registry):
+        with server.stage('build (cold)'):
+            build = registry.build('ceph/rhceph-7:latest')
+        assert build.nvr == 'rhceph-7-7-1'
+        # 401, token, manifest, config blob:
+        assert server.requests('build (cold)') == 4
+        with server.stage('build (warm token)'):
+            registry.build('ceph/rhceph-7:latest')
+        assert server.requests('build (warm token)') == 2
+
+    def test_build_blob_cache(self, server, registry, tmpdir):
+        registry.blobs = BlobCache(str(tmpdir))
+        registry.build('ceph/rhceph-7:latest')
+        with server.stage('build (blob cache)'):
+            registry.build('ceph/rhceph-7:latest')
+        # Just one HEAD to revalidate the tag:
+        assert server.requests('build (blob cache)') == 1
+        assert server.requests('build (blob cache)', 'HEAD manifests') == 1
+
+    def test_digest(self, server, registry):
+        registry.prefetch_tokens(['ceph/rhceph-7'])
+        with server.stage('digest'):
+            registry.digest('ceph/rhceph-7', 'latest')
+        assert server.requests('digest') == 1
+
+    def test_extension_signatures(self, server, registry):
+        registry.prefetch_tokens(['ceph/rhceph-7'])
+        with server.stage('signatures (extensions)'):
+            references = registry.signature_references('ceph/rhceph-7:latest')
+        assert len(references) == 2
+        # manifest list, extensions API
+        assert server.requests('signatures (extensions)') == 2
+
+    def test_lookaside_signatures(self, server, registry, monkeypatch):
+        monkeypatch.setattr(Registry, 'lookaside', server.lookaside)
+        registry.prefetch_tokens(['ceph/rhceph-7'])
+        with server.stage('signatures (lookaside)'):
+            signatures = registry.signatures('ceph/rhceph-7:latest')
+        assert len(signatures) == 2
+        # manifest list, plus at most one window of lookaside requests
+        assert server.requests('signatures (lookaside)') <= 5
+
+    def test_signature_audit(self, server, registry):
+        registry.prefetch_tokens(['ceph/rhceph-7'])
+        with server.stage('signature_audit (4 arches)'):
+            audit = registry.signature_audit('ceph/rhceph-7:latest')
+        assert sorted(audit) == ['amd64', 'arm64', 'ppc64le', 's390x']
+        # manifest list, plus one extensions request per arch
+        assert server.requests('signature_audit (4 arches)') == 5
+
+    def test_builds(self, server, registry):
+        images = ['%s:latest' % repository for repository in IMAGES]
+        with server.stage('build x20 (serial)'):
+            start = time.time()
+            serial = [registry.build(image) for image in images]
+            serial_time = time.time() - start
+        registry.tokens = TokenCache()
+        with server.stage('builds x20 (concurrent)'):
+            start = time.time()
+            concurrent = registry.builds(images)
+            concurrent_time = time.time() - start
+        assert [b.nvr for b in concurrent] == [b.nvr for b in serial]
+        # One base request and one token request for all 20 repositories:
+        assert server.requests('builds x20 (concurrent)', 'token') == 1
+        assert server.requests('builds x20 (concurrent)') == 2 + 20 * 2
+        assert concurrent_time < serial_time
+
+    def test_tags(self, server, registry):
+        with server.stage('tags (120 tags)'):
+            tags = list(registry.tags('ceph/many-tags', page_size=50))
+        assert len(tags) == 120
+        # 401, token, and then three pages:
+        assert server.requests('tags (120 tags)', 'GET tags') == 4
@@ -1,5 +1,9 @@
 import os
+import threading
+from http.server import SimpleHTTPRequestHandler
+from bucko import transport
 from bucko.repo_compose import RepoCompose
+from bucko.tests.httpserver import ThreadingHTTPServer
 import productmd.compose
 import pytest
 try:
@@ -13,6 +17,60 @@ FIXTURES_DIR = os.path.join(TESTS_DIR, 'fixtures')
 INTERNAL_KEYS = {'f000000d': '/etc/RPM-GPG-KEY-f00d'}
 
 
+class FixturesServer(object):
+    """
+    Serve FIXTURES_DIR over HTTP under "prefix".
+
+    The first "failures" GET requests for each file return 503.
+    """
+
+    def __init__(self):
+        self.prefix = ''
+        self.failures = 0
+        self.requests = []
+        self.heads = []
+
+    def start(self):
+        server = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def translate_path(self, path):
+                if not path.startswith(server.prefix + '/'):
+                    return os.path.join(FIXTURES_DIR, 'missing')
+                path = path[len(server.prefix):].split('?')[0]
+                return os.path.join(FIXTURES_DIR, *path.split('/'))
+
+            def do_GET(self):
+                path = self.path[len(server.prefix):]
+                server.requests.append(path)
+                if server.requests.count(path) <= server.failures:
+                    self.send_error(503)
+                    return
+                super(Handler, self).do_GET()
+
+            def do_HEAD(self):
+                server.heads.append(self.path)
+                super(Handler, self).do_HEAD()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://%s:%d' % (host, port)
+
+
 @pytest.fixture
 def repocompose():
     compose = RepoCompose(FIXTURES_DIR, INTERNAL_KEYS)
@@ -70,3 +128,58 @@ class TestRepoComposeYumRepo(object):
         result = config.get('MYPRODUCT-2.1-RHEL-7-Tools', 'baseurl')
         expected = 'https://noexist.example.com/composes/Tools'
         assert result == expected
+
+
+class TestRepoComposeHttp(object):
+    """ Load compose metadata over HTTP with bucko.transport """
+
+    @pytest.fixture
+    def server(self):
+        server = FixturesServer()
+        server.start()
+        yield server
+        server.stop()
+
+    def test_load(self, server):
+        compose = RepoCompose(server.url, INTERNAL_KEYS)
+        assert compose.compose_path == server.url
+        assert compose.info.get_variants()
+        assert compose.rpms.rpms
+
+    def test_compose_subdirectory(self, server):
+        server.prefix = '/compose'
+        compose = RepoCompose(server.url, INTERNAL_KEYS)
+        assert compose.compose_path == server.url + '/compose'
+        assert compose.rpms.rpms
+        assert compose.info.get_variants()
+
+    def test_retry(self, server):
+        server.failures = 1
+        calls = []
+        transport.add_hook(lambda *args: calls.append(args))
+        compose = RepoCompose(server.url, INTERNAL_KEYS)
+        assert compose.info.get_variants()
+        statuses = [status for (method, url, status, elapsed) in calls
+                    if method == 'GET']
+        assert statuses == [200]
+        assert server.requests.count('/metadata/composeinfo.json') == 2
+
+    def test_transport_only(self, server):
+        server.prefix = '/compose'
+        calls = []
+        transport.add_hook(lambda *args: calls.append(args))
+        compose = RepoCompose(server.url, INTERNAL_KEYS)
+        assert compose.rpms.rpms
+        # Every request went through our transport:
+        assert len(calls) == len(server.heads) + len(server.requests)
+        assert server.heads == ['/compose/metadata/composeinfo.json']
+        # We only download each metadata file once:
+        requests = list(server.requests)
+        assert compose.info is compose.info
+        assert compose.rpms is compose.rpms
+        assert server.requests == requests
+
+    def test_missing(self, server):
+        server.prefix = '/elsewhere'
+        with pytest.raises(RuntimeError):
+            RepoCompose(server.url, INTERNAL_KEYS)
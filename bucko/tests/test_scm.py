@@ -0,0 +1,44 @@
+import subprocess
+from bucko import scm
+
+URL = 'git://example.com/containers/rhceph'
+COMMIT = '0123456789abcdef0123456789abcdef01234567'
+
+
+def test_remote_ref():
+    assert scm.remote_ref('origin/ceph-8') == 'refs/heads/ceph-8'
+    assert scm.remote_ref('ceph-8') == 'refs/heads/ceph-8'
+    assert scm.remote_ref('refs/tags/v1') == 'refs/tags/v1'
+
+
+def test_resolve(monkeypatch):
+    calls = []
+
+    def check_output(cmd, timeout=None):
+        calls.append(cmd)
+        return ('%s\trefs/heads/ceph-8\n' % COMMIT).encode()
+    monkeypatch.setattr('subprocess.check_output', check_output)
+    assert scm.resolve(URL + '#origin/ceph-8') == URL + '#' + COMMIT
+    assert calls == [('git', 'ls-remote', URL, 'refs/heads/ceph-8')]
+
+
+def test_resolve_commit(monkeypatch):
+    monkeypatch.setattr('subprocess.check_output', None)
+    assert scm.resolve(URL + '#' + COMMIT) == URL + '#' + COMMIT
+
+
+def test_resolve_no_ref():
+    assert scm.resolve(URL) is None
+
+
+def test_resolve_missing_branch(monkeypatch):
+    monkeypatch.setattr('subprocess.check_output',
+                        lambda cmd, timeout=None: b'')
+    assert scm.resolve(URL + '#origin/ceph-9') is None
+
+
+def test_resolve_error(monkeypatch):
+    def check_output(cmd, timeout=None):
+        raise subprocess.CalledProcessError(128, cmd)
+    monkeypatch.setattr('subprocess.check_output', check_output)
+    assert scm.resolve(URL + '#origin/ceph-8') is None
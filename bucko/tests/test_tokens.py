@@ -0,0 +1,96 @@
+import base64
+import json
+import os
+import stat
+import time
+from bucko import tokens
+from bucko.tokens import TokenCache
+
+
+def make_jwt(claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode())
+    return 'eyJhbGciOiJub25lIn0.%s.sig' % payload.decode().rstrip('=')
+
+
+class TestExpiry(object):
+    def test_jwt_expiry(self):
+        token = make_jwt({'exp': 1700000000, 'sub': 'bucko'})
+        assert tokens.jwt_expiry(token) == 1700000000
+
+    def test_jwt_expiry_not_jwt(self):
+        assert tokens.jwt_expiry('opaque-token') is None
+        assert tokens.jwt_expiry(None) is None
+
+    def test_token_expiry_jwt(self):
+        token = make_jwt({'exp': 1700000000})
+        data = {'token': token, 'expires_in': 300}
+        assert tokens.token_expiry(data) == 1700000000
+
+    def test_token_expiry_expires_in(self):
+        data = {'token': 'opaque-token', 'expires_in': 300}
+        expiry = tokens.token_expiry(data)
+        assert time.time() + 290 < expiry <= time.time() + 300
+
+    def test_token_expiry_default(self):
+        expiry = tokens.token_expiry({'token': 'opaque-token'})
+        assert expiry <= time.time() + tokens.DEFAULT_EXPIRES_IN
+
+
+class TestTokenCache(object):
+    def test_get_set(self):
+        cache = TokenCache()
+        assert cache.get('registry.example.com', 'rhel7') is None
+        cache.set('registry.example.com', 'rhel7', 'abc', time.time() + 300)
+        assert cache.get('registry.example.com', 'rhel7') == 'abc'
+        assert cache.get('other.example.com', 'rhel7') is None
+
+    def test_refresh_before_expiry(self):
+        cache = TokenCache()
+        expires = time.time() + tokens.EXPIRY_MARGIN - 1
+        cache.set('registry.example.com', 'rhel7', 'abc', expires)
+        assert cache.get('registry.example.com', 'rhel7') is None
+
+    def test_set_many(self):
+        cache = TokenCache()
+        cache.set_many('registry.example.com', ['rhel7', 'rhel8'], 'abc',
+                       time.time() + 300)
+        assert cache.get('registry.example.com', 'rhel7') == 'abc'
+        assert cache.get('registry.example.com', 'rhel8') == 'abc'
+
+    def test_invalidate(self):
+        cache = TokenCache()
+        cache.set('registry.example.com', 'rhel7', 'abc', time.time() + 300)
+        cache.invalidate('registry.example.com', 'rhel7')
+        assert cache.get('registry.example.com', 'rhel7') is None
+        # Invalidating a missing token is fine:
+        cache.invalidate('registry.example.com', 'rhel7')
+
+    def test_realm(self):
+        cache = TokenCache()
+        assert cache.get_realm('registry.example.com') is None
+        cache.set_realm('registry.example.com', 'https://example.com/auth',
+                        None)
+        realm = cache.get_realm('registry.example.com')
+        assert realm == ('https://example.com/auth', None)
+
+    def test_persist(self, tmpdir):
+        path = str(tmpdir.join('tokens.json'))
+        cache = TokenCache(path)
+        cache.set_realm('registry.example.com', 'https://example.com/auth',
+                        'registry')
+        cache.set('registry.example.com', 'rhel7', 'abc', time.time() + 300)
+        cache.set('registry.example.com', 'old', 'def', time.time() - 1)
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        cache = TokenCache(path)
+        assert cache.get('registry.example.com', 'rhel7') == 'abc'
+        assert cache.get_realm('registry.example.com') == (
+            'https://example.com/auth', 'registry')
+        # We do not save expired tokens:
+        assert 'registry.example.com/old' not in cache.tokens
+
+
+def test_get_token_cache():
+    assert tokens.get_token_cache() is tokens.get_token_cache()
+    persistent = tokens.get_token_cache(persist=True)
+    assert persistent is not tokens.get_token_cache()
+    assert persistent.path.endswith('registry-tokens.json')
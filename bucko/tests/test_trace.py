@@ -0,0 +1,81 @@
+import json
+import time
+from bucko import trace
+
+
+def test_span():
+    with trace.span('koji getTaskInfo', 'koji', task=1234):
+        pass
+    spans = trace.spans()
+    assert len(spans) == 1
+    assert spans[0].name == 'koji getTaskInfo'
+    assert spans[0].category == 'koji'
+    assert spans[0].args == {'task': 1234}
+    assert spans[0].duration >= 0
+
+
+def test_span_exception():
+    try:
+        with trace.stage('load compose'):
+            raise RuntimeError('compose is not layered')
+    except RuntimeError:
+        pass
+    assert [s.name for s in trace.spans(trace.STAGE)] == ['load compose']
+
+
+def test_spans_category():
+    trace.record('load compose', trace.STAGE, time.monotonic(), 1.0)
+    trace.record('skopeo copy', 'cmd', time.monotonic(), 2.0)
+    assert [s.name for s in trace.spans('cmd')] == ['skopeo copy']
+
+
+def test_stage_durations():
+    start = time.monotonic()
+    trace.record('load compose', trace.STAGE, start, 1.5)
+    trace.record('Koji build', trace.STAGE, start, 600.0, branch='a')
+    trace.record('koji getTaskInfo', 'koji', start, 0.25)
+    trace.record('Koji build', trace.STAGE, start, 900.0, branch='b')
+    durations = trace.stage_durations()
+    assert list(durations.items()) == [('load compose', 1.5),
+                                       ('Koji build', 1500.0)]
+
+
+def test_http_request():
+    trace.http_request('GET', 'https://registry.example.com/v2/', 401, 0.5)
+    span = trace.spans('http')[0]
+    assert span.name == 'GET registry.example.com'
+    assert span.duration == 0.5
+    assert span.args == {'url': 'https://registry.example.com/v2/',
+                         'status': 401}
+
+
+def test_chrome_trace(tmpdir):
+    start = time.monotonic()
+    trace.record('Koji build', trace.STAGE, start + 1, 2.0)
+    trace.record('load compose', trace.STAGE, start, 0.5)
+    filename = str(tmpdir.join('trace.json'))
+    trace.write_chrome_trace(filename)
+    with open(filename) as f:
+        data = json.load(f)
+    events = data['traceEvents']
+    assert [e['name'] for e in events] == ['load compose', 'Koji build']
+    assert events[1]['ph'] == 'X'
+    assert events[1]['cat'] == 'stage'
+    assert events[1]['dur'] == 2000000
+    assert events[1]['ts'] - events[0]['ts'] == 1000000
+
+
+def test_summary():
+    start = time.monotonic()
+    trace.record('koji getTaskInfo', 'koji', start, 0.25)
+    trace.record('load compose', trace.STAGE, start, 1.5)
+    trace.record('skopeo copy', 'cmd', start, 30.0)
+    trace.record('koji getTaskInfo', 'koji', start, 0.75)
+    lines = trace.summary().splitlines()
+    assert lines[0].split() == ['category', 'name', 'count', 'total', 'max']
+    assert lines[1].split() == ['stage', 'load', 'compose', '1', '1.500s',
+                                '1.500s']
+    assert lines[2].split() == ['cmd', 'skopeo', 'copy', '1', '30.000s',
+                                '30.000s']
+    assert lines[3].split() == ['koji', 'koji', 'getTaskInfo', '2', '1.000s',
+                                '0.750s']
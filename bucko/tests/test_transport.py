@@ -0,0 +1,174 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+import pytest
+import requests
+from bucko import transport
+from bucko.tests.httpserver import ThreadingHTTPServer
+
+
+class FlakyServer(object):
+    """ Return 503 for the first "failures" requests to each path. """
+
+    def __init__(self, failures=1):
+        self.failures = failures
+        self.counts = {}
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                count = server.counts.get(self.path, 0) + 1
+                server.counts[self.path] = count
+                status = 503 if count <= server.failures else 200
+                body = b'try again' if status == 503 else b'ok'
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                if status == 503:
+                    self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_POST = do_GET
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://%s:%d' % (host, port)
+
+
+@pytest.fixture
+def server():
+    server = FlakyServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(transport.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+class TestSession(object):
+    def test_retries_unavailable(self, server):
+        session = transport.session(retries=2)
+        r = session.get(server.url + '/manifest')
+        assert r.status_code == 200
+        assert server.counts['/manifest'] == 2
+
+    def test_gives_up(self, server):
+        server.failures = 5
+        session = transport.session(retries=2)
+        r = session.get(server.url + '/manifest')
+        assert r.status_code == 503
+        assert server.counts['/manifest'] == 3
+
+    def test_does_not_retry_post(self, server):
+        session = transport.session(retries=2)
+        r = session.post(server.url + '/compose')
+        assert r.status_code == 503
+        assert server.counts['/compose'] == 1
+
+    def test_hooks(self, server):
+        calls = []
+        transport.add_hook(lambda *args: calls.append(args))
+        session = transport.session()
+        session.get(server.url + '/manifest')
+        assert len(calls) == 1
+        (method, url, status, elapsed) = calls[0]
+        assert method == 'GET'
+        assert url == server.url + '/manifest'
+        assert status == 200
+        assert elapsed >= 0
+
+    def test_hooks_connection_error(self, server):
+        calls = []
+        transport.add_hook(lambda *args: calls.append(args))
+        url = server.url
+        server.stop()
+        session = transport.session(retries=0)
+        with pytest.raises(requests.ConnectionError):
+            session.get(url + '/manifest')
+        assert calls[0][2] is None
+        server.start()
+
+    def test_remove_hook(self, server):
+        calls = []
+        transport.add_hook(calls.append)
+        transport.remove_hook(calls.append)
+        transport.session().get(server.url + '/manifest')
+        assert calls == []
+
+    def test_pool_sizes(self):
+        session = transport.session(pool_size=4,
+                                    pool_sizes={'registry.example.com': 16})
+        adapter = session.get_adapter('https://registry.example.com/v2/')
+        assert adapter._pool_maxsize == 16
+        adapter = session.get_adapter('https://odcs.example.com/api/1/')
+        assert adapter._pool_maxsize == 4
+
+    def test_default_timeout(self, monkeypatch):
+        adapter = transport.TransportAdapter(timeout=(1, 2))
+        sent = {}
+
+        def send(self, request, timeout=None, **kwargs):
+            sent['timeout'] = timeout
+            response = requests.Response()
+            response.status_code = 200
+            return response
+        monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', send)
+        request = requests.Request('GET', 'http://example.com/').prepare()
+        adapter.send(request)
+        assert sent['timeout'] == (1, 2)
+        adapter.send(request, timeout=5)
+        assert sent['timeout'] == 5
+
+
+class TestRetry(object):
+    def error(self, status):
+        response = requests.Response()
+        response.status_code = status
+        return requests.HTTPError(response=response)
+
+    def test_retry(self, no_sleep):
+        results = [requests.ConnectionError(), self.error(502), 'done']
+
+        def func(arg):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return '%s %s' % (result, arg)
+        assert transport.retry(func, 'polling') == 'done polling'
+        assert no_sleep == [0.5, 1.0]
+
+    def test_not_retryable(self, no_sleep):
+        def func():
+            raise self.error(404)
+        with pytest.raises(requests.HTTPError):
+            transport.retry(func)
+        assert no_sleep == []
+
+    def test_gives_up(self, no_sleep):
+        def func():
+            raise requests.ConnectionError()
+        with pytest.raises(requests.ConnectionError):
+            transport.retry(func)
+        assert len(no_sleep) == transport.RETRIES
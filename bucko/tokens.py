@@ -0,0 +1,129 @@
+import base64
+import json
+import os
+import threading
+import time
+from bucko.cache import cache_dir, read_json, write_private_json
+
+"""
+Cache container registry bearer tokens until they expire.
+"""
+
+# Refresh each token this many seconds before it expires.
+EXPIRY_MARGIN = 30
+
+# The token spec says that a token without "expires_in" lasts 60 seconds.
+DEFAULT_EXPIRES_IN = 60
+
+# Process-wide token caches, keyed by path (or None for memory-only).
+_token_caches = {}
+
+
+def get_token_cache(persist=False):
+    """
+    Return a process-wide token cache.
+
+    :param bool persist: also save tokens and realms in a private file for
+                         later bucko runs.
+    """
+    path = None
+    if persist:
+        path = os.path.join(cache_dir(), 'registry-tokens.json')
+    if path not in _token_caches:
+        _token_caches[path] = TokenCache(path)
+    return _token_caches[path]
+
+
+def jwt_expiry(token):
+    """
+    Return the "exp" claim from a JWT, or None if this is not a JWT.
+
+    We do not verify the JWT's signature. The registry will do that.
+    """
+    try:
+        _, payload, _ = token.split('.')
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload).decode())
+        return int(claims['exp'])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return None
+
+
+def token_expiry(data):
+    """
+    Return the Unix time when a token from a realm expires.
+
+    :param dict data: the JSON response from the token realm.
+    """
+    token = data.get('token') or data.get('access_token')
+    expiry = jwt_expiry(token)
+    if expiry:
+        return expiry
+    expires_in = data.get('expires_in') or DEFAULT_EXPIRES_IN
+    return time.time() + int(expires_in)
+
+
+class TokenCache(object):
+    """
+    Bearer tokens for each registry host and repository, plus the token
+    realm and service for each registry host.
+
+    If "path" is set, we load and save everything in that private file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        data = {}
+        if path:
+            data = read_json(path) or {}
+        self.tokens = data.get('tokens', {})
+        self.realms = data.get('realms', {})
+
+    def get(self, host, repository):
+        """ Return an unexpired token for this repository, or None. """
+        entry = self.tokens.get('%s/%s' % (host, repository))
+        if not entry:
+            return None
+        token, expires = entry
+        if expires - EXPIRY_MARGIN < time.time():
+            return None
+        return token
+
+    def set(self, host, repository, token, expires):
+        """ Store a token for this repository until "expires" (Unix time). """
+        self.set_many(host, [repository], token, expires)
+
+    def set_many(self, host, repositories, token, expires):
+        """ Store one token for several repositories. """
+        with self.lock:
+            for repository in repositories:
+                self.tokens['%s/%s' % (host, repository)] = (token, expires)
+            self.save()
+
+    def invalidate(self, host, repository):
+        """ Forget the token for this repository. """
+        with self.lock:
+            self.tokens.pop('%s/%s' % (host, repository), None)
+            self.save()
+
+    def get_realm(self, host):
+        """ Return a (realm, service) tuple for this host, or None. """
+        realm = self.realms.get(host)
+        if not realm:
+            return None
+        return tuple(realm)
+
+    def set_realm(self, host, realm, service):
+        with self.lock:
+            self.realms[host] = (realm, service)
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        tokens = {key: entry for key, entry in self.tokens.items()
+                  if entry[1] > now}
+        data = {'tokens': tokens, 'realms': self.realms}
+        write_private_json(self.path, data)
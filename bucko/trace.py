@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import json
+import os
+import threading
+import time
+
+"""
+Record how long each part of a bucko run takes.
+
+Wrap work in span() blocks. Pipeline stages use stage(). At the end of a
+run, write_chrome_trace() saves the spans in Chrome's trace event format
+(load it in chrome://tracing or https://ui.perfetto.dev), and summary()
+returns a text table of the time per span name.
+"""
+
+# Span category for main()'s pipeline stages.
+STAGE = 'stage'
+
+# Process-wide finished spans, and the time we started recording.
+_spans = []
+_epoch = time.monotonic()
+_lock = threading.Lock()
+
+
+class Span(object):
+    """
+    One timed operation.
+
+    :param str name: eg. "koji getTaskInfo"
+    :param str category: eg. "koji"
+    :param float start: time.monotonic() when this operation started
+    :param float duration: seconds
+    :param dict args: extra information for the trace viewer
+    """
+
+    def __init__(self, name, category, start, duration, args=None):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.duration = duration
+        self.args = args or {}
+        self.thread = threading.get_ident()
+
+    def event(self):
+        """ Return a Chrome "complete" trace event for this span. """
+        return {'name': self.name,
+                'cat': self.category,
+                'ph': 'X',
+                'ts': int((self.start - _epoch) * 1e6),
+                'dur': int(self.duration * 1e6),
+                'pid': os.getpid(),
+                'tid': self.thread,
+                'args': self.args}
+
+
+def record(name, category, start, duration, **args):
+    """ Record a span that we timed ourselves. """
+    span = Span(name, category, start, duration, args)
+    with _lock:
+        _spans.append(span)
+    return span
+
+
+@contextmanager
+def span(name, category='bucko', **args):
+    """ Record the time that this block takes. """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, category, start, time.monotonic() - start, **args)
+
+
+def stage(name):
+    """ Record the time that this pipeline stage takes. """
+    return span(name, STAGE)
+
+
+def http_request(method, url, status, elapsed):
+    """
+    Record a span for one HTTP request.
+
+    Add this to bucko.transport's hooks to trace registry and .repo
+    requests.
+    """
+    host = urlparse(url).netloc
+    record('%s %s' % (method, host), 'http', time.monotonic() - elapsed,
+           elapsed, url=url, status=status)
+
+
+def spans(category=None):
+    """ Return all the finished spans, or only the spans in a category. """
+    with _lock:
+        finished = list(_spans)
+    if category:
+        finished = [s for s in finished if s.category == category]
+    return finished
+
+
+def stage_durations():
+    """
+    Return the total seconds for each pipeline stage.
+
+    :returns: OrderedDict of stage names to seconds, in the order that each
+              stage first finished.
+    """
+    durations = OrderedDict()
+    for s in spans(STAGE):
+        durations[s.name] = durations.get(s.name, 0.0) + s.duration
+    return durations
+
+
+def chrome_trace():
+    """ Return all our spans as a Chrome trace event format document. """
+    events = [s.event() for s in sorted(spans(), key=lambda s: s.start)]
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(filename):
+    """ Write all our spans to a Chrome trace event format JSON file. """
+    with open(filename, 'w') as f:
+        json.dump(chrome_trace(), f)
+    return filename
+
+
+def summary():
+    """
+    Return a text table of the count and times for each span name.
+
+    Stages come first, in order, then every other span name by its total
+    time.
+    """
+    totals = OrderedDict()
+    for s in spans():
+        key = (s.category, s.name)
+        count, total, longest = totals.get(key, (0, 0.0, 0.0))
+        totals[key] = (count + 1, total + s.duration,
+                       max(longest, s.duration))
+    stages = [key for key in totals if key[0] == STAGE]
+    others = sorted((key for key in totals if key[0] != STAGE),
+                    key=lambda key: -totals[key][1])
+    header = ('category', 'name', 'count', 'total', 'max')
+    lines = ['%-8s %-40s %6s %9s %9s' % header]
+    for key in stages + others:
+        count, total, longest = totals[key]
+        lines.append('%-8s %-40s %6d %8.3fs %8.3fs'
+                     % (key[0], key[1], count, total, longest))
+    return '\n'.join(lines)
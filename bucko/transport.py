@@ -0,0 +1,161 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+"""
+Shared HTTP transport for bucko's clients.
+
+session() returns a requests.Session with pooled keep-alive connections,
+retries with exponential backoff for connection errors and 429 or 5xx
+responses, default timeouts, and gzip decoding (requests asks for gzip and
+deflate by default). Every request through these sessions calls the timing
+hooks from add_hook().
+
+odcs-client makes its own HTTP requests with the requests module
+functions. Wrap idempotent odcs-client calls with retry(). AsyncRegistry
+uses aiohttp, so it does not use these sessions at all.
+"""
+
+# Default number of pooled connections to each host.
+POOL_SIZE = 8
+
+# Number of times to retry a failed request.
+RETRIES = 3
+
+# Retries sleep for BACKOFF_FACTOR * 2 ** (retry number - 1) seconds.
+BACKOFF_FACTOR = 0.5
+
+# Default (connect, read) timeouts in seconds.
+TIMEOUT = (10, 60)
+
+# HTTP statuses that mean "try again later".
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# We only retry requests that are safe to repeat.
+RETRY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Process-wide timing hooks.
+_hooks = []
+
+
+def add_hook(callback):
+    """
+    Call this function after every request through our sessions.
+
+    :param callback: function that takes (method, url, status, elapsed)
+                     arguments. "status" is None if the request failed
+                     without a response. "elapsed" is the number of seconds
+                     until we received the response headers, including any
+                     retries.
+    """
+    _hooks.append(callback)
+
+
+def remove_hook(callback):
+    """ Stop calling this function after every request. """
+    _hooks.remove(callback)
+
+
+def run_hooks(method, url, status, elapsed):
+    for callback in list(_hooks):
+        callback(method, url, status, elapsed)
+
+
+def retry_policy(retries=RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """ Return a urllib3 Retry for our sessions. """
+    return Retry(total=retries,
+                 connect=retries,
+                 read=retries,
+                 status=retries,
+                 backoff_factor=backoff_factor,
+                 status_forcelist=RETRY_STATUSES,
+                 allowed_methods=RETRY_METHODS,
+                 raise_on_status=False,
+                 respect_retry_after_header=True)
+
+
+class TransportAdapter(HTTPAdapter):
+    """
+    HTTPAdapter with default timeouts and timing hooks.
+
+    :param int pool_size: number of connections to keep open for each host.
+    :param int retries: number of times to retry a failed request.
+    :param timeout: default timeout, in seconds, or a (connect, read) tuple.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, retries=RETRIES,
+                 timeout=TIMEOUT):
+        self.timeout = timeout
+        super(TransportAdapter, self).__init__(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry_policy(retries))
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        start = time.monotonic()
+        status = None
+        try:
+            response = super(TransportAdapter, self).send(
+                request, timeout=timeout, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            run_hooks(request.method, request.url, status,
+                      time.monotonic() - start)
+
+
+def session(pool_size=POOL_SIZE, retries=RETRIES, timeout=TIMEOUT,
+            pool_sizes=None):
+    """
+    Return a new requests.Session on our shared transport.
+
+    :param int pool_size: number of connections to keep open for each host.
+    :param int retries: number of times to retry a failed request.
+    :param timeout: default timeout, in seconds, or a (connect, read) tuple.
+    :param dict pool_sizes: pool sizes for particular hosts, eg.
+                            {"registry.example.com": 16}.
+    """
+    s = requests.Session()
+    adapter = TransportAdapter(pool_size, retries, timeout)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    for host, size in (pool_sizes or {}).items():
+        adapter = TransportAdapter(size, retries, timeout)
+        s.mount('https://%s/' % host, adapter)
+        s.mount('http://%s/' % host, adapter)
+    return s
+
+
+def http_url(url):
+    """ Return True if this is an HTTP(S) URL that our sessions can fetch. """
+    return url.startswith('http://') or url.startswith('https://')
+
+
+def retryable(error):
+    """ Return True if we should retry after this requests exception. """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        response = error.response
+        return response is not None and \
+            response.status_code in RETRY_STATUSES
+    return False
+
+
+def retry(func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs), retrying connection errors and 429 or 5xx
+    responses like our sessions do.
+
+    Only use this for requests that are safe to repeat.
+    """
+    for attempt in range(RETRIES + 1):
+        try:
+            return func(*args, **kwargs)
+        except requests.RequestException as e:
+            if attempt == RETRIES or not retryable(e):
+                raise
+        time.sleep(BACKOFF_FACTOR * 2 ** attempt)